@@ -122,6 +122,7 @@ CREATE TABLE `armies` (
   PRIMARY KEY (`id`),
   KEY `fk_armies_created_by` (`createdBy`),
   KEY `fk_armies_town_hall` (`townHall`),
+  KEY `idx_armies_updated_time_id` (`updatedTime`,`id`),
   CONSTRAINT `fk_armies_created_by` FOREIGN KEY (`createdBy`) REFERENCES `users` (`id`) ON DELETE CASCADE,
   CONSTRAINT `fk_armies_town_hall` FOREIGN KEY (`townHall`) REFERENCES `town_halls` (`level`)
 ) ENGINE=InnoDB AUTO_INCREMENT=10 DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
@@ -17,10 +17,33 @@ type GetArmiesOptions = {
 	ids?: number[];
 	/** Returns the armies made by this user */
 	username?: string;
-	/** Sort order */
-	sort?: 'new' | 'score';
+	/** Sort order ('updated' is oldest change first, with id as a tie breaker so it's stable for cursor paging) */
+	sort?: 'new' | 'score' | 'updated';
 	/** Only fetch armies for this town hall */
 	townHall?: number;
+	/** Only fetch armies updated at or after this time */
+	updatedSince?: Date;
+	/** Cursor used together with `updatedSince`: armies updated exactly at `updatedSince` must have an id greater than this */
+	afterId?: number;
+	/** Max number of armies to return */
+	limit?: number;
+};
+
+type IdCursorOptions = {
+	/** Cursor: only return armies with an id greater than this (ordered by id) */
+	afterId?: number;
+	/** Max number of armies to return */
+	limit?: number;
+};
+
+type ArmyScores = Pick<Army, 'id' | 'score' | 'votes' | 'pageViews' | 'openLinkClicks' | 'copyLinkClicks'>;
+
+type ArmiesVersion = {
+	count: number;
+	maxUpdatedTime: Date | null;
+	maxId: number | null;
+	/** Only set when `includeScores` is passed: changes whenever any vote or metric changes */
+	scores?: string;
 };
 
 type GetSavedArmiesOptions = {
@@ -84,10 +107,10 @@ export class ArmyAPI {
 	}
 
 	public async getArmies(req: RequestEvent, options: GetArmiesOptions = {}) {
-		const { ids, username, sort, townHall } = options;
+		const { ids, username, sort, townHall, updatedSince, afterId, limit } = options;
 		const userId = req.locals.user?.id ?? null;
 
-		const args: (number | number[] | string | null)[] = [userId, userId];
+		const args: (number | number[] | string | Date | null)[] = [userId, userId];
 		let query = `
 			SELECT
 				a.*,
@@ -226,6 +249,20 @@ export class ArmyAPI {
 			args.push(townHall);
 		}
 
+		if (updatedSince) {
+			if (afterId !== undefined) {
+				query += `
+					AND (a.updatedTime > ? OR (a.updatedTime = ? AND a.id > ?))
+				`;
+				args.push(updatedSince, updatedSince, afterId);
+			} else {
+				query += `
+					AND a.updatedTime >= ?
+				`;
+				args.push(updatedSince);
+			}
+		}
+
 		query += `
 			GROUP BY a.id
 		`;
@@ -234,12 +271,23 @@ export class ArmyAPI {
 			query += `
 				ORDER BY score DESC, a.createdTime DESC
 			`;
+		} else if (sort === 'updated') {
+			query += `
+				ORDER BY a.updatedTime ASC, a.id ASC
+			`;
 		} else {
 			query += `
 				ORDER BY a.createdTime DESC
 			`;
 		}
 
+		if (limit) {
+			query += `
+				LIMIT ?
+			`;
+			args.push(limit);
+		}
+
 		const armies = await this.server.db.query<Army>(query, args);
 
 		for (const army of armies) {
@@ -272,6 +320,143 @@ export class ArmyAPI {
 		return armies;
 	}
 
+	/**
+	 * Lightweight alternative to `getArmies` returning only the id and metrics of each army.
+	 * Metrics change without touching `updatedTime`, so this pages by id over every army.
+	 * The page of ids is selected first so votes and metrics are only aggregated for that page,
+	 * rather than scoring every army through `getArmyScoresQuery` on each request.
+	 */
+	public async getArmyScores(options: IdCursorOptions = {}) {
+		const { afterId, limit } = options;
+		const weights = await this.metrics.getMetricWeights();
+
+		const args: number[] = [];
+		let page = `
+			SELECT a.id
+			FROM armies a
+			WHERE TRUE
+		`;
+
+		if (afterId !== undefined) {
+			page += `
+				AND a.id > ?
+			`;
+			args.push(afterId);
+		}
+
+		page += `
+			ORDER BY a.id ASC
+		`;
+
+		if (limit) {
+			page += `
+				LIMIT ?
+			`;
+			args.push(limit);
+		}
+
+		const query = `
+			SELECT
+				am.id,
+				(
+					(am.votes * ${weights.vote}) +
+					(am.pageViews * ${weights.pageView}) +
+					(am.copyLinkClicks * ${weights.copyLinkClick}) +
+					(am.openLinkClicks * ${weights.openLinkClick})
+				) AS score,
+				am.votes,
+				am.pageViews,
+				am.openLinkClicks,
+				am.copyLinkClicks
+			FROM (
+				SELECT
+					p.id,
+					(SELECT COALESCE(SUM(av.vote), 0) FROM army_votes av WHERE av.armyId = p.id) AS votes,
+					COALESCE(metric_pv.value, 0) AS pageViews,
+					COALESCE(metric_ol.value, 0) AS openLinkClicks,
+					COALESCE(metric_cl.value, 0) AS copyLinkClicks
+				FROM (
+					${page}
+				) p
+				LEFT JOIN army_metrics metric_pv ON metric_pv.armyId = p.id AND metric_pv.name = 'page-view'
+				LEFT JOIN army_metrics metric_cl ON metric_cl.armyId = p.id AND metric_cl.name = 'copy-link-click'
+				LEFT JOIN army_metrics metric_ol ON metric_ol.armyId = p.id AND metric_ol.name = 'open-link-click'
+			) am
+			ORDER BY am.id ASC
+		`;
+
+		const rows = await this.server.db.query<ArmyScores>(query, args);
+		for (const row of rows) {
+			row.score = +row.score;
+			row.votes = +row.votes;
+			row.pageViews = +row.pageViews;
+			row.openLinkClicks = +row.openLinkClicks;
+			row.copyLinkClicks = +row.copyLinkClicks;
+		}
+		return rows;
+	}
+
+	/**
+	 * Returns the ids of all armies, ordered by id. Used by the Firestore sync to find deleted armies.
+	 */
+	public async getArmyIds(options: IdCursorOptions = {}) {
+		const { afterId, limit } = options;
+
+		const args: number[] = [];
+		let query = `
+			SELECT a.id
+			FROM armies a
+			WHERE TRUE
+		`;
+
+		if (afterId !== undefined) {
+			query += `
+				AND a.id > ?
+			`;
+			args.push(afterId);
+		}
+
+		query += `
+			ORDER BY a.id ASC
+		`;
+
+		if (limit) {
+			query += `
+				LIMIT ?
+			`;
+			args.push(limit);
+		}
+
+		return this.server.db.query<{ id: number }>(query, args);
+	}
+
+	/**
+	 * Cheap summary of the armies table, used as an HTTP validator (ETag/Last-Modified) by the export endpoint.
+	 * Any created, edited or deleted army changes `count`, `maxUpdatedTime` or `maxId`.
+	 * Votes and metrics don't touch `updatedTime`, so those are summarized separately when `includeScores` is set.
+	 */
+	public async getArmiesVersion(includeScores = false): Promise<ArmiesVersion> {
+		const [row] = await this.server.db.query<ArmiesVersion>(`
+			SELECT
+				COUNT(*) AS count,
+				MAX(updatedTime) AS maxUpdatedTime,
+				MAX(id) AS maxId
+			FROM armies
+		`);
+		const version: ArmiesVersion = { count: +row.count, maxUpdatedTime: row.maxUpdatedTime, maxId: row.maxId };
+		if (includeScores) {
+			const [scores] = await this.server.db.query<{ votes: number; voteSum: number; metrics: number; metricSum: number }>(`
+				SELECT
+					(SELECT COUNT(*) FROM army_votes) AS votes,
+					(SELECT COALESCE(SUM(vote), 0) FROM army_votes) AS voteSum,
+					(SELECT COUNT(*) FROM army_metrics) AS metrics,
+					(SELECT COALESCE(SUM(value), 0) FROM army_metrics) AS metricSum
+			`);
+			version.scores = `${scores.votes}:${scores.voteSum}:${scores.metrics}:${scores.metricSum}`;
+		}
+		return version;
+	}
+
 	public async getArmyScoresQuery() {
 		const weights = await this.metrics.getMetricWeights();
 		return `
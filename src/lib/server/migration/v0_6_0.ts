@@ -0,0 +1,9 @@
+import type { MigrationFn } from '@ninjalib/sql';
+
+// prettier-ignore
+export default function migration(runStep: MigrationFn) {
+    // Supports (updatedTime, id) cursor paging used by the army export endpoint
+    runStep(53, `
+        CREATE INDEX idx_armies_updated_time_id ON armies (updatedTime, id)
+    `);
+}
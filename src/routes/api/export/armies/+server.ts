@@ -1,13 +1,108 @@
 // 简化实现，避免类型依赖解析问题
-// 导出全部军队 JSON，供外部同步工具使用
-export const GET = async (req: any) => {
-  const server = req.locals.server;
-  const armies = await server.army.getArmies(req);
-  return new Response(JSON.stringify(armies), {
-    status: 200,
-    headers: { 'content-type': 'application/json' },
-  });
-};
+// 导出军队 JSON，供外部同步工具使用
+// 支持游标分页：按 (updatedTime, id) 升序，?since=ISO时间&afterId=上一页最后的id&limit=每页条数
+// ?fields=metrics 只返回 id 与计数器（score/votes/pageViews/openLinkClicks/copyLinkClicks），按 id 升序用 afterId 翻页
+// ?fields=ids 只返回 id（按 id 升序用 afterId 翻页），供同步工具对账删除
+// 支持条件请求：ETag 由军队数量/最大 updatedTime/最大 id（metrics 还包括投票与计数器汇总）和查询参数计算，未变化时返回 304
+// 按 Accept-Encoding 协商压缩（br 优先，其次 gzip），导出 JSON 重复字段多，压缩后通常只剩 1/10 左右
+import { createHash } from 'node:crypto';
+import { promisify } from 'node:util';
+import { brotliCompress, gzip, constants as zlibConstants } from 'node:zlib';
+import z from 'zod';
+import { endpoint } from '$server/utils';
+
+const EXPORT_MAX_LIMIT = 5000;
+// 小于该字节数的响应不压缩
+const COMPRESS_MIN_BYTES = 1024;
+
+const brotliCompressAsync = promisify(brotliCompress);
+const gzipAsync = promisify(gzip);
+
+const exportQuerySchema = z.object({
+  since: z.coerce.date().optional(),
+  afterId: z.coerce.number().int().optional(),
+  limit: z.coerce.number().int().min(1).max(EXPORT_MAX_LIMIT).optional(),
+  fields: z.enum(['metrics', 'ids']).optional(),
+});
 
+function isNotModified(request: Request, etag: string, lastModified: Date | null) {
+  const ifNoneMatch = request.headers.get('if-none-match');
+  if (ifNoneMatch) {
+    return ifNoneMatch.split(',').some((tag) => tag.trim() === etag || tag.trim() === '*');
+  }
+  const ifModifiedSince = request.headers.get('if-modified-since');
+  if (ifModifiedSince && lastModified) {
+    // HTTP 日期只精确到秒
+    const since = Date.parse(ifModifiedSince);
+    return !Number.isNaN(since) && Math.floor(lastModified.getTime() / 1000) * 1000 <= since;
+  }
+  return false;
+}
+
+function negotiateEncoding(request: Request): 'br' | 'gzip' | null {
+  const accepted = new Map<string, number>();
+  for (const part of (request.headers.get('accept-encoding') ?? '').split(',')) {
+    const [name, ...params] = part.trim().toLowerCase().split(';');
+    const q = params.map((p) => p.trim()).find((p) => p.startsWith('q='));
+    accepted.set(name, q ? Number(q.slice(2)) : 1);
+  }
+  for (const encoding of ['br', 'gzip'] as const) {
+    if ((accepted.get(encoding) ?? 0) > 0) {
+      return encoding;
+    }
+  }
+  return null;
+}
+
+async function compress(body: string, encoding: 'br' | 'gzip'): Promise<Buffer> {
+  if (encoding === 'br') {
+    // 默认质量 11 对几 MB 的导出太慢，4 的压缩率已接近 gzip -9
+    return brotliCompressAsync(body, {
+      params: {
+        [zlibConstants.BROTLI_PARAM_QUALITY]: 4,
+        [zlibConstants.BROTLI_PARAM_MODE]: zlibConstants.BROTLI_MODE_TEXT,
+        [zlibConstants.BROTLI_PARAM_SIZE_HINT]: Buffer.byteLength(body),
+      },
+    });
+  }
+  return gzipAsync(body);
+}
+
+export const GET = endpoint(async (req: any) => {
+  const server = req.locals.server;
+  const params = Object.fromEntries(req.url.searchParams);
+  const { since, afterId, limit, fields } = exportQuerySchema.parse(params);
 
+  const version = await server.army.getArmiesVersion(fields === 'metrics');
+  const etag = `W/"${createHash('sha1').update(JSON.stringify({ version, params })).digest('base64url')}"`;
+  // 计数器没有时间戳，metrics 导出只使用 ETag
+  const lastModified = fields === 'metrics' ? null : version.maxUpdatedTime;
+  const headers: Record<string, string> = { 'content-type': 'application/json', etag, 'cache-control': 'no-cache', vary: 'Accept-Encoding' };
+  if (lastModified) {
+    headers['last-modified'] = new Date(lastModified).toUTCString();
+  }
+  if (isNotModified(req.request, etag, lastModified ? new Date(lastModified) : null)) {
+    return new Response(null, { status: 304, headers });
+  }
 
+  let body: unknown;
+  if (fields === 'ids') {
+    body = await server.army.getArmyIds({ afterId, limit });
+  } else if (fields === 'metrics') {
+    body = await server.army.getArmyScores({ afterId, limit });
+  } else {
+    body = await server.army.getArmies(req, {
+      sort: 'updated',
+      updatedSince: since,
+      afterId: since ? afterId : undefined,
+      limit,
+    });
+  }
+  const json = JSON.stringify(body);
+  const encoding = negotiateEncoding(req.request);
+  if (encoding && json.length >= COMPRESS_MIN_BYTES) {
+    headers['content-encoding'] = encoding;
+    return new Response(await compress(json, encoding), { status: 200, headers });
+  }
+  return new Response(json, { status: 200, headers });
+});
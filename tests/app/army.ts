@@ -380,6 +380,67 @@ describe('Fetching', function () {
 		const armies = await server.army.getArmies(req);
 		assertArmies(armies, [data, data2]);
 	});
+
+	it('Should page armies by updated time and id', async function () {
+		const data = makeData({ name: 'test', townHall: 16 });
+		const data2 = makeData({ name: 'test2', townHall: 16 });
+		const data3 = makeData({ name: 'test3', townHall: 16 });
+		await server.army.saveArmy(req, data);
+		await server.army.saveArmy(req, data2);
+		await server.army.saveArmy(req, data3);
+
+		const page1 = await server.army.getArmies(req, { sort: 'updated', limit: 2 });
+		assertArmies(page1, [data, data2]);
+		assert.isBelow(page1[0].id, page1[1].id);
+
+		const last = page1[page1.length - 1];
+		const page2 = await server.army.getArmies(req, { sort: 'updated', updatedSince: last.updatedTime, afterId: last.id, limit: 2 });
+		assertArmies(page2, [data3]);
+	});
+
+	it('Should page army scores by id', async function () {
+		const id = await server.army.saveArmy(req, makeData({ name: 'test', townHall: 16 }));
+		const id2 = await server.army.saveArmy(req, makeData({ name: 'test2', townHall: 16 }));
+		const id3 = await server.army.saveArmy(req, makeData({ name: 'test3', townHall: 16 }));
+		await server.army.saveVote(req, { armyId: id2, vote: 1 });
+
+		const page1 = await server.army.getArmyScores({ limit: 2 });
+		assert.deepEqual(page1.map((row) => row.id), [id, id2]);
+		assert.strictEqual(page1[0].votes, 0);
+		assert.strictEqual(page1[1].votes, 1);
+		assert.deepEqual(Object.keys(page1[0]).sort(), ['copyLinkClicks', 'id', 'openLinkClicks', 'pageViews', 'score', 'votes']);
+
+		const page2 = await server.army.getArmyScores({ afterId: id2, limit: 2 });
+		assert.deepEqual(page2.map((row) => row.id), [id3]);
+	});
+
+	it('Should page army ids', async function () {
+		const id = await server.army.saveArmy(req, makeData({ name: 'test', townHall: 16 }));
+		const id2 = await server.army.saveArmy(req, makeData({ name: 'test2', townHall: 16 }));
+		const id3 = await server.army.saveArmy(req, makeData({ name: 'test3', townHall: 16 }));
+
+		const page1 = await server.army.getArmyIds({ limit: 2 });
+		assert.deepEqual(page1, [{ id }, { id: id2 }]);
+
+		const page2 = await server.army.getArmyIds({ afterId: id2, limit: 2 });
+		assert.deepEqual(page2, [{ id: id3 }]);
+	});
+
+	it('Should change armies version when armies or scores change', async function () {
+		const empty = await server.army.getArmiesVersion(true);
+		assert.equal(empty.count, 0);
+
+		const id = await server.army.saveArmy(req, makeData({ name: 'test', townHall: 16 }));
+		const created = await server.army.getArmiesVersion(true);
+		assert.equal(created.count, 1);
+		assert.equal(created.maxId, id);
+		assert.deepEqual(await server.army.getArmiesVersion(true), created);
+
+		await server.army.saveVote(req, { armyId: id, vote: 1 });
+		const voted = await server.army.getArmiesVersion(true);
+		assert.equal(voted.maxId, created.maxId);
+		assert.notEqual(voted.scores, created.scores);
+	});
 });
 
 describe('Army comments', function () {
@@ -0,0 +1,155 @@
+import { describe, it, beforeAll, afterAll } from 'vitest';
+import { execFileSync } from 'node:child_process';
+import { mkdtempSync, rmSync, writeFileSync } from 'node:fs';
+import { tmpdir } from 'node:os';
+import { join } from 'node:path';
+import { fileURLToPath } from 'node:url';
+import { assert } from '../testutil';
+import type { StaticGameData } from '$types';
+import { ArmyModel, UnitModel, PetModel, EquipmentModel } from '$models';
+import { generateLink } from '$client/army';
+import { db } from '$server/db';
+import { Server } from '$server/api/Server';
+
+/**
+ * Round trips links made by the frontend's `generateLink` through the Python codec in `tools/copy_link.py`,
+ * which the Firestore sync uses to write `copyLink` and which decodes links for bulk imports.
+ */
+
+const CODEC = fileURLToPath(new URL('../../tools/copy_link.py', import.meta.url));
+const PYTHON = process.env.PYTHON ?? 'python3';
+
+let gameData: StaticGameData;
+let server: Server;
+let tmpDir: string;
+
+beforeAll(async function () {
+	server = new Server(db);
+	await server.init();
+	gameData = server.army.gameData;
+	tmpDir = mkdtempSync(join(tmpdir(), 'copy-link-'));
+});
+
+afterAll(async function () {
+	await server.dispose();
+	rmSync(tmpDir, { recursive: true, force: true });
+});
+
+type Fixture = (model: ArmyModel) => void;
+
+// Heroes here always have equipment (`generateLink` only attaches a pet to a hero that already has equipment),
+// and are listed in the order they appear in the link
+const FIXTURES: Record<string, Fixture> = {
+	'troops only': (model) => {
+		model.addUnit(UnitModel.requireTroopByName('Barbarian', gameData), 'armyCamp', 10);
+		model.addUnit(UnitModel.requireTroopByName('Archer', gameData), 'armyCamp', 2);
+	},
+	'spells only': (model) => {
+		model.addUnit(UnitModel.requireSpellByName('Lightning', gameData), 'armyCamp', 11);
+	},
+	'troops, siege and spells': (model) => {
+		model.addUnit(UnitModel.requireTroopByName('Balloon', gameData), 'armyCamp', 24);
+		model.addUnit(UnitModel.requireTroopByName('Wall Wrecker', gameData), 'armyCamp', 1);
+		model.addUnit(UnitModel.requireTroopByName('Baby Dragon', gameData), 'armyCamp', 4);
+		model.addUnit(UnitModel.requireSpellByName('Lightning', gameData), 'armyCamp', 3);
+	},
+	'clan castle': (model) => {
+		model.addUnit(UnitModel.requireTroopByName('Super Barbarian', gameData), 'armyCamp', 8);
+		model.addUnit(UnitModel.requireTroopByName('Golem', gameData), 'clanCastle', 1);
+		model.addUnit(UnitModel.requireTroopByName('Battle Drill', gameData), 'clanCastle', 1);
+		model.addUnit(UnitModel.requireSpellByName('Lightning', gameData), 'clanCastle', 2);
+	},
+	'heroes with pets and equipment': (model) => {
+		model.addEquipment(EquipmentModel.requireByName('Barbarian Puppet', gameData));
+		model.addEquipment(EquipmentModel.requireByName('Rage Vial', gameData));
+		model.addEquipment(EquipmentModel.requireByName('Archer Puppet', gameData));
+		model.addEquipment(EquipmentModel.requireByName('Eternal Tome', gameData));
+		model.addEquipment(EquipmentModel.requireByName('Rocket Spear', gameData));
+		model.addPet(PetModel.requireByName('Lassi', gameData), 'Barbarian King');
+		model.addPet(PetModel.requireByName('Spirit Fox', gameData), 'Archer Queen');
+		model.addPet(PetModel.requireByName('Mighty Yak', gameData), 'Royal Champion');
+		model.addUnit(UnitModel.requireTroopByName('Giant', gameData), 'armyCamp', 12);
+	},
+	'everything': (model) => {
+		model.addEquipment(EquipmentModel.requireByName('Earthquake Boots', gameData));
+		model.addEquipment(EquipmentModel.requireByName('Barbarian Puppet', gameData));
+		model.addPet(PetModel.requireByName('Lassi', gameData), 'Barbarian King');
+		model.addUnit(UnitModel.requireTroopByName('Super Archer', gameData), 'clanCastle', 2);
+		model.addUnit(UnitModel.requireSpellByName('Lightning', gameData), 'clanCastle', 1);
+		model.addUnit(UnitModel.requireTroopByName('Super Miner', gameData), 'armyCamp', 10);
+		model.addUnit(UnitModel.requireTroopByName('Super Valkyrie', gameData), 'armyCamp', 4);
+		model.addUnit(UnitModel.requireTroopByName('Battle Drill', gameData), 'armyCamp', 1);
+		model.addUnit(UnitModel.requireSpellByName('Lightning', gameData), 'armyCamp', 2);
+	},
+};
+
+/** Army in the export endpoint's shape, which is what the codec encodes */
+function exportShape(model: ArmyModel) {
+	return {
+		units: model.allUnits.map((unit) => ({ home: unit.home, type: unit.info.type, clashId: +unit.info.clashId, amount: unit.amount })),
+		pets: model.pets.map((pet) => ({ hero: pet.hero, clashId: +pet.info.clashId })),
+		equipment: model.equipment.map((eq) => ({ hero: eq.info.hero, clashId: +eq.info.clashId })),
+	};
+}
+
+const SECTION_ORDER = ['clanCastle:Troop', 'clanCastle:Spell', 'armyCamp:Troop', 'armyCamp:Spell'];
+
+/**
+ * Decoded units come back in link order (cc troops, cc spells, troops, spells).
+ * Sieges share the troop section of a link, so they decode as troops.
+ */
+function decodedShape(model: ArmyModel) {
+	const army = exportShape(model);
+	const units = army.units
+		.map((unit) => (unit.type === 'Siege' ? { ...unit, type: 'Troop' } : unit))
+		.map((unit, i) => ({ unit, i, section: SECTION_ORDER.indexOf(`${unit.home}:${unit.type}`) }))
+		.sort((a, b) => a.section - b.section || a.i - b.i)
+		.map(({ unit }) => unit);
+	return { ...army, units };
+}
+
+function runCodec(args: string[]): string[] {
+	return execFileSync(PYTHON, [CODEC, ...args], { encoding: 'utf8' }).trim().split('\n');
+}
+
+function makeFixtures() {
+	return Object.entries(FIXTURES).map(([name, fill]) => {
+		const model = new ArmyModel(gameData);
+		fill(model);
+		return { name, model, link: generateLink(model) };
+	});
+}
+
+describe('Copy link codec', function () {
+	it('should encode armies into the same links as generateLink', function () {
+		const fixtures = makeFixtures();
+		const armiesFile = join(tmpDir, 'armies.json');
+		writeFileSync(armiesFile, JSON.stringify(fixtures.map(({ model }) => exportShape(model))));
+		const links = runCodec(['--encode', armiesFile]);
+		assert.lengthOf(links, fixtures.length);
+		fixtures.forEach(({ name, link }, i) => assert.equal(links[i], link, name));
+	});
+
+	it('should decode generateLink links back into the same armies', function () {
+		const fixtures = makeFixtures();
+		const decoded = runCodec(fixtures.map(({ link }) => link)).map((line) => JSON.parse(line));
+		assert.lengthOf(decoded, fixtures.length);
+		fixtures.forEach(({ name, model }, i) => assert.deepEqual(decoded[i], decodedShape(model), name));
+	});
+
+	it('should re-encode decoded links unchanged', function () {
+		const fixtures = makeFixtures();
+		const decoded = runCodec(fixtures.map(({ link }) => link));
+		const decodedFile = join(tmpDir, 'decoded.json');
+		writeFileSync(decodedFile, `[${decoded.join(',')}]`);
+		assert.deepEqual(
+			runCodec(['--encode', decodedFile]),
+			fixtures.map(({ link }) => link)
+		);
+	});
+
+	it('should pass the codec self-test', function () {
+		const [summary] = runCodec(['--self-test']);
+		assert.match(summary, /^Self-test passed/);
+	});
+});
@@ -0,0 +1,338 @@
+import hashlib
+import heapq
+import json
+import sqlite3
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from urllib.parse import quote, unquote
+
+
+# 榜单索引：按大本营等级、标签以及全部军队维护 top-N 军队摘要文档，列表页（"TH16 最高分"、"标签 X"）读一个文档即可
+#   分组（bucket）文档 id：all、th-{等级}、tag-{百分号编码的标签}；每个分组按 score / votes / recent（updatedTime）各保留一份排行
+#   每份排行在本地保留 depth（默认 2N）个候选 (值, id)，降序，发布前 N 个
+#   全量构建：一次遍历，每个 (分组, 排序) 一个大小为 depth 的有界最小堆
+#   增量更新：只处理本次变化的军队。候选列表之外的军队排名都低于列表末尾（阈值），
+#     变化后排到阈值之下的条目移出列表，其余与原候选合并取前 depth；
+#     候选不足 N 而分组中还有其他军队时，才从本地摘要表重新填充该分组（一次遍历该分组）
+# 本地状态（SQLite）：每个军队的摘要、标签归属、各分组的候选与已发布内容的哈希
+
+SORTS = ("score", "votes", "recent")
+
+# 状态格式版本；与 top_n/depth 一起记录在 meta 中，变化时从本地摘要表重建标签归属与候选
+# 2：标签分组 id 由替换 / 改为百分号编码
+INDEX_VERSION = 2
+
+
+def _ts(value: Optional[str]) -> float:
+    if not value:
+        return 0.0
+    try:
+        if value.endswith("Z"):
+            value = value[:-1] + "+00:00"
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        return 0.0
+
+
+def army_summary(doc: Dict[str, Any]) -> Dict[str, Any]:
+    # 由 transform_army 生成的 Firestore 文档提取摘要；ts 只用于排序，不发布
+    metrics = doc.get("metrics") or {}
+    return {
+        "id": int(doc["id"]),
+        "name": doc.get("name"),
+        "townHall": doc.get("townHall"),
+        "banner": doc.get("banner"),
+        "tags": list(doc.get("tags") or []),
+        "createdByUsername": doc.get("createdByUsername"),
+        "updatedTime": doc.get("updatedTime"),
+        "score": metrics.get("score") or 0,
+        "votes": metrics.get("votes") or 0,
+        "ts": _ts(doc.get("updatedTime") or doc.get("createdTime")),
+    }
+
+
+def _tag_id(tag: Any) -> str:
+    # Firestore 文档 id 不能含 /；百分号编码（% 本身也编码）保证不同标签不会得到相同的 id，unquote 可还原
+    return quote(str(tag), safe="")
+
+
+def bucket_keys(summary: Dict[str, Any]) -> List[str]:
+    keys = ["all"]
+    if summary.get("townHall") is not None:
+        keys.append(f"th-{summary['townHall']}")
+    keys.extend(f"tag-{_tag_id(tag)}" for tag in summary.get("tags") or ())
+    return keys
+
+
+def _sort_key(summary: Dict[str, Any], sort: str) -> Tuple[float, int]:
+    value = summary["ts"] if sort == "recent" else summary[sort]
+    return (float(value or 0), summary["id"])
+
+
+class ArmyIndexes:
+    def __init__(self, path: str, top_n: int = 50, depth: Optional[int] = None) -> None:
+        self.path = path
+        self.top_n = top_n
+        self.depth = max(depth or top_n * 2, top_n)
+        self.refills = 0
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS armies (id INTEGER PRIMARY KEY, town_hall INTEGER, data TEXT NOT NULL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS armies_town_hall ON armies (town_hall)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS army_tags (tag TEXT NOT NULL, id INTEGER NOT NULL, PRIMARY KEY (tag, id))")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, count INTEGER NOT NULL, data TEXT NOT NULL, published TEXT, pending INTEGER NOT NULL DEFAULT 1)")
+        # 本轮变化：id -> (变化前摘要, 变化后摘要)，None 表示不存在/已删除；flush 时合并进各分组
+        self._changes: Dict[int, Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]] = {}
+        params = json.dumps({"version": INDEX_VERSION, "topN": self.top_n, "depth": self.depth})
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'params'").fetchone()
+        if row is None or row[0] != params:
+            if row is not None:
+                self.conn.execute("DELETE FROM army_tags")
+                self._rebuild_buckets(self._retagged(self._iter_summaries("SELECT data FROM armies", ())))
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('params', ?)", (params,))
+            self.conn.commit()
+
+    def __len__(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM armies").fetchone()[0]
+
+    def observe(self, docs: Iterable[Dict[str, Any]]) -> int:
+        # 记录一块转换后的文档，返回摘要有变化的数量；摘要没变（只改了兵种等）的军队不影响排行
+        summaries = {s["id"]: s for s in (army_summary(doc) for doc in docs)}
+        old = self._load(list(summaries))
+        changed = [s for army_id, s in summaries.items() if old.get(army_id) != s]
+        for summary in changed:
+            self._record(summary["id"], old.get(summary["id"]), summary)
+        return len(changed)
+
+    def observe_metrics(self, rows: Iterable[Tuple[int, Dict[str, Any]]]) -> int:
+        # --metrics-only：只更新已有摘要的 score/votes；本地没有的军队由常规同步加入
+        rows = list(rows)
+        old = self._load([army_id for army_id, _ in rows])
+        changed = 0
+        for army_id, metrics in rows:
+            current = old.get(army_id)
+            if current is None:
+                continue
+            updated = dict(current, score=metrics.get("score") or 0, votes=metrics.get("votes") or 0)
+            if updated != current:
+                self._record(army_id, current, updated)
+                changed += 1
+        return changed
+
+    def remove(self, ids: Iterable[int]) -> None:
+        ids = list(ids)
+        old = self._load(ids)
+        for army_id in ids:
+            if army_id in old:
+                self._record(army_id, old[army_id], None)
+
+    def rebuild(self, docs: Iterable[Dict[str, Any]]) -> int:
+        # 从完整文档集（如 Firestore 集合）重建本地状态与全部分组；已发布但不再存在的分组在 flush 时删除
+        self._changes.clear()
+        self.conn.execute("DELETE FROM armies")
+        self.conn.execute("DELETE FROM army_tags")
+        count = 0
+
+        def summaries() -> Iterable[Dict[str, Any]]:
+            nonlocal count
+            for doc in docs:
+                summary = army_summary(doc)
+                self._store(summary)
+                count += 1
+                yield summary
+
+        self._rebuild_buckets(summaries())
+        return count
+
+    def flush(self) -> List[Tuple[str, Optional[Dict[str, Any]], str]]:
+        # 把本轮变化合并进各分组，返回内容有变化、需要写入的索引文档：(文档 id, 文档或 None 表示删除, 内容哈希)
+        by_bucket: Dict[str, List[Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]]] = {}
+        for old, new in self._changes.values():
+            for key in set(bucket_keys(old) if old else ()) | set(bucket_keys(new) if new else ()):
+                by_bucket.setdefault(key, []).append((old, new))
+        self._changes.clear()
+        for key, changes in by_bucket.items():
+            self._merge(key, changes)
+
+        # 只渲染有变化（pending）的分组；内容哈希与已发布的相同时不再写入
+        writes: List[Tuple[str, Optional[Dict[str, Any]], str]] = []
+        unchanged: List[str] = []
+        for key, count, data, published in self.conn.execute("SELECT key, count, data, published FROM buckets WHERE pending = 1").fetchall():
+            if count == 0:
+                if published is not None:
+                    writes.append((key, None, ""))
+                else:
+                    self.conn.execute("DELETE FROM buckets WHERE key = ?", (key,))
+                continue
+            doc = self._render(key, count, json.loads(data))
+            digest = hashlib.blake2b(json.dumps(doc, sort_keys=True, ensure_ascii=False).encode("utf-8"), digest_size=16).hexdigest()
+            if digest == published:
+                unchanged.append(key)
+                continue
+            doc["updatedAt"] = datetime.now(timezone.utc).isoformat()
+            writes.append((key, doc, digest))
+        self.conn.executemany("UPDATE buckets SET pending = 0 WHERE key = ?", [(key,) for key in unchanged])
+        self.conn.commit()
+        return writes
+
+    def mark_published(self, writes: List[Tuple[str, Optional[Dict[str, Any]], str]]) -> None:
+        # 索引文档写入 Firestore 成功后调用；失败的文档保持 pending，下次 flush 会再次返回
+        with self.conn:
+            for key, doc, digest in writes:
+                if doc is None:
+                    self.conn.execute("DELETE FROM buckets WHERE key = ? AND count = 0", (key,))
+                else:
+                    self.conn.execute("UPDATE buckets SET published = ?, pending = 0 WHERE key = ?", (digest, key))
+
+    def close(self) -> None:
+        self.conn.commit()
+        self.conn.close()
+
+    def _record(self, army_id: int, old: Optional[Dict[str, Any]], new: Optional[Dict[str, Any]]) -> None:
+        # 同一轮内多次变化时保留最早的旧值，合并时才能正确计算分组归属的变化
+        first = self._changes.get(army_id)
+        self._changes[army_id] = (first[0] if first else old, new)
+        if new is None:
+            self.conn.execute("DELETE FROM armies WHERE id = ?", (army_id,))
+            self.conn.execute("DELETE FROM army_tags WHERE id = ?", (army_id,))
+        else:
+            self._store(new)
+
+    def _store(self, summary: Dict[str, Any]) -> None:
+        army_id = summary["id"]
+        self.conn.execute(
+            "INSERT OR REPLACE INTO armies (id, town_hall, data) VALUES (?, ?, ?)",
+            (army_id, summary.get("townHall"), json.dumps(summary, ensure_ascii=False)),
+        )
+        self.conn.execute("DELETE FROM army_tags WHERE id = ?", (army_id,))
+        self._store_tags(summary)
+
+    def _store_tags(self, summary: Dict[str, Any]) -> None:
+        army_id = summary["id"]
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO army_tags (tag, id) VALUES (?, ?)", [(key[4:], army_id) for key in bucket_keys(summary) if key.startswith("tag-")]
+        )
+
+    def _retagged(self, summaries: Iterable[Dict[str, Any]]) -> Iterable[Dict[str, Any]]:
+        # 状态格式升级：按当前的分组 id 重新记录标签归属
+        for summary in summaries:
+            self._store_tags(summary)
+            yield summary
+
+    def _load(self, ids: List[int]) -> Dict[int, Dict[str, Any]]:
+        found: Dict[int, Dict[str, Any]] = {}
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            for (data,) in self.conn.execute(f"SELECT data FROM armies WHERE id IN ({placeholders})", chunk):
+                summary = json.loads(data)
+                found[summary["id"]] = summary
+        return found
+
+    def _iter_summaries(self, sql: str, params: Tuple[Any, ...]) -> Iterable[Dict[str, Any]]:
+        for (data,) in self.conn.execute(sql, params).fetchall():
+            yield json.loads(data)
+
+    def _bucket_members(self, key: str) -> Iterable[Dict[str, Any]]:
+        if key == "all":
+            return self._iter_summaries("SELECT data FROM armies", ())
+        if key.startswith("th-"):
+            return self._iter_summaries("SELECT data FROM armies WHERE town_hall = ?", (int(key[3:]),))
+        return self._iter_summaries("SELECT a.data FROM army_tags t JOIN armies a ON a.id = t.id WHERE t.tag = ?", (key[4:],))
+
+    def _rebuild_buckets(self, summaries: Iterable[Dict[str, Any]]) -> None:
+        # 一次遍历：每个 (分组, 排序) 一个有界最小堆，堆顶是当前第 depth 名，新条目更大时替换堆顶
+        heaps: Dict[str, Dict[str, List[Tuple[float, int]]]] = {}
+        counts: Dict[str, int] = {}
+        depth = self.depth
+        for summary in summaries:
+            keys = [_sort_key(summary, sort) for sort in SORTS]
+            for bucket in bucket_keys(summary):
+                counts[bucket] = counts.get(bucket, 0) + 1
+                bucket_heaps = heaps.get(bucket)
+                if bucket_heaps is None:
+                    bucket_heaps = heaps[bucket] = {sort: [] for sort in SORTS}
+                for sort, key in zip(SORTS, keys):
+                    heap = bucket_heaps[sort]
+                    if len(heap) < depth:
+                        heapq.heappush(heap, key)
+                    elif key > heap[0]:
+                        heapq.heapreplace(heap, key)
+        # 不再存在的分组保留为 count=0，已发布的由 flush 删除
+        self.conn.execute("UPDATE buckets SET count = 0, data = '{}', pending = 1")
+        for bucket, bucket_heaps in heaps.items():
+            data = {sort: sorted(heap, reverse=True) for sort, heap in bucket_heaps.items()}
+            self._save_bucket(bucket, counts[bucket], data)
+
+    def _save_bucket(self, key: str, count: int, data: Dict[str, List[Tuple[float, int]]]) -> None:
+        self.conn.execute(
+            "INSERT INTO buckets (key, count, data) VALUES (?, ?, ?) ON CONFLICT(key) DO UPDATE SET count = excluded.count, data = excluded.data, pending = 1",
+            (key, count, json.dumps(data)),
+        )
+
+    def _merge(self, key: str, changes: List[Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]]) -> None:
+        row = self.conn.execute("SELECT count, data FROM buckets WHERE key = ?", (key,)).fetchone()
+        count, stored = (row[0], json.loads(row[1])) if row else (0, {})
+        previous_count = count
+        changed_ids = set()
+        members: List[Dict[str, Any]] = []
+        for old, new in changes:
+            army_id = (new or old)["id"]
+            changed_ids.add(army_id)
+            was_member = old is not None and key in bucket_keys(old)
+            is_member = new is not None and key in bucket_keys(new)
+            count += int(is_member) - int(was_member)
+            if is_member:
+                members.append(new)
+
+        data: Dict[str, List[Tuple[float, int]]] = {}
+        shortest = self.depth
+        for sort in SORTS:
+            candidates = [tuple(entry) for entry in stored.get(sort) or ()]
+            # 原候选不是分组的全部时，列表之外的军队都排在阈值之下，变化后低于阈值的条目无法确定名次，移出列表
+            threshold = candidates[-1] if candidates and len(candidates) < previous_count else None
+            kept = [c for c in candidates if c[1] not in changed_ids]
+            for member in members:
+                member_key = _sort_key(member, sort)
+                if threshold is None or member_key >= threshold:
+                    kept.append(member_key)
+            data[sort] = heapq.nlargest(self.depth, kept)
+            shortest = min(shortest, len(data[sort]))
+
+        if shortest < min(self.top_n, count):
+            # 候选不足：从本地摘要表重新填充该分组
+            self.refills += 1
+            self._rebuild_bucket(key)
+            return
+        self._save_bucket(key, count, data)
+
+    def _rebuild_bucket(self, key: str) -> None:
+        heaps: Dict[str, List[Tuple[float, int]]] = {sort: [] for sort in SORTS}
+        count = 0
+        for summary in self._bucket_members(key):
+            count += 1
+            for sort in SORTS:
+                heap = heaps[sort]
+                entry = _sort_key(summary, sort)
+                if len(heap) < self.depth:
+                    heapq.heappush(heap, entry)
+                elif entry > heap[0]:
+                    heapq.heapreplace(heap, entry)
+        self._save_bucket(key, count, {sort: sorted(heap, reverse=True) for sort, heap in heaps.items()})
+
+    def _render(self, key: str, count: int, data: Dict[str, List[List[Any]]]) -> Dict[str, Any]:
+        top = {sort: [int(entry[1]) for entry in (data.get(sort) or [])[: self.top_n]] for sort in SORTS}
+        summaries = self._load(sorted({army_id for ids in top.values() for army_id in ids}))
+        doc: Dict[str, Any] = {"count": count, "topN": self.top_n}
+        if key == "all":
+            doc["kind"] = "all"
+        elif key.startswith("th-"):
+            doc.update(kind="townHall", townHall=int(key[3:]))
+        else:
+            # 文档里保存原始标签名（文档 id 是编码后的）
+            doc.update(kind="tag", tag=unquote(key[4:]))
+        doc["top"] = {
+            sort: [{k: v for k, v in summaries[army_id].items() if k != "ts"} for army_id in ids if army_id in summaries]
+            for sort, ids in top.items()
+        }
+        return doc
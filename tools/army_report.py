@@ -0,0 +1,233 @@
+import argparse
+import json
+import logging
+import sys
+import time
+import traceback
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from columnar_snapshot import load_snapshot
+
+try:
+    import numpy as np
+    import pyarrow.compute as pc
+except ImportError:
+    # 需要 pip install pyarrow numpy
+    np = None
+    pc = None
+
+
+# 列式快照的常用统计（读取 firestore_uploader.py --columnar 写出的 armies / army_items）
+#   分类列读成字典编码，统计在字典下标上用 numpy 向量化完成（bincount / 基数排序），不逐行遍历；
+#   首次统计时把 army_items 汇总成 (大本营等级, kind, home, name) 的计数立方体，之后百万军队规模的查询在毫秒级
+#   python army_report.py snapshot/ --report usage --town-hall 16 --kind troop --top 20
+
+# 兵种/法术/攻城机器默认只统计军营（同一兵种也可能出现在援军中）
+UNIT_KINDS = ("troop", "spell", "siege")
+
+
+def _code(values: List[Any], value: Any) -> int:
+    # 字典中不存在的取值返回 -1
+    try:
+        return values.index(value)
+    except ValueError:
+        return -1
+
+
+class ArmyReport:
+    # 快照上的统计；numpy 列与使用率立方体在首次用到时计算并缓存，之后的每次查询只在小数组上切片
+    def __init__(self, armies: Any, items: Any) -> None:
+        self.armies = armies
+        self.items = items
+        self._cache: Dict[Tuple[str, str], Any] = {}
+        self._usage: Optional[Tuple[Any, Any]] = None
+        self._scores: Optional[Tuple[Any, Any]] = None
+
+    @classmethod
+    def load(cls, directory: str) -> "ArmyReport":
+        armies, items = load_snapshot(directory)
+        return cls(armies, items)
+
+    def _codes(self, table: str, column: str) -> Tuple[Any, List[Any]]:
+        # 字典编码列 -> (下标数组, 字典取值)；空值下标为 -1
+        key = (table, column)
+        if key not in self._cache:
+            col = getattr(self, table).column(column)
+            if col.num_chunks == 0:
+                self._cache[key] = (np.zeros(0, dtype=np.int32), [])
+            else:
+                arr = col.chunk(0)
+                self._cache[key] = (pc.fill_null(arr.indices, -1).to_numpy(), arr.dictionary.to_pylist())
+        return self._cache[key]
+
+    def _numbers(self, table: str, column: str) -> Any:
+        key = (table, column)
+        if key not in self._cache:
+            col = getattr(self, table).column(column)
+            self._cache[key] = pc.fill_null(col.chunk(0), 0).to_numpy() if col.num_chunks else np.zeros(0, dtype=np.int64)
+        return self._cache[key]
+
+    def _town_hall_counts(self) -> Any:
+        # 大本营等级是很小的整数，直接用 bincount 分组（下标即等级）
+        return np.bincount(self._numbers("armies", "townHall").astype(np.int64))
+
+    def unit_usage(self, town_hall: Optional[int] = None, kind: str = "troop", home: Optional[str] = None, top: int = 20) -> List[Dict[str, Any]]:
+        # 使用率：包含该项的军队数、占该大本营等级军队的比例、平均数量
+        counts, amounts = self._usage_cube()
+        _, kind_values = self._codes("items", "kind")
+        _, home_values = self._codes("items", "home")
+        _, name_values = self._codes("items", "name")
+        if home is None and kind in UNIT_KINDS:
+            home = "armyCamp"
+        k = _code(kind_values, kind)
+        if k < 0:
+            return []
+        homes = slice(None) if home is None else _code(home_values, home)
+        if homes == -1:
+            return []
+        levels = slice(None) if town_hall is None else town_hall
+        if town_hall is not None and not 0 <= town_hall < counts.shape[0]:
+            return []
+        by_name = counts[levels, k, homes].reshape(-1, counts.shape[3]).sum(axis=0)
+        amount_by_name = amounts[levels, k, homes].reshape(-1, counts.shape[3]).sum(axis=0)
+        army_counts = self._town_hall_counts()
+        if town_hall is None:
+            total = int(army_counts.sum())
+        else:
+            total = int(army_counts[town_hall]) if town_hall < len(army_counts) else 0
+        order = np.argsort(-by_name, kind="stable")[:top]
+        return [
+            {
+                "name": name_values[i],
+                "armies": int(by_name[i]),
+                "share": round(float(by_name[i]) / total, 4) if total else 0.0,
+                "avgAmount": round(float(amount_by_name[i]) / float(by_name[i]), 2),
+            }
+            for i in order
+            if by_name[i] > 0
+        ]
+
+    def _usage_cube(self) -> Tuple[Any, Any]:
+        # 一次遍历 army_items：按 (大本营等级, kind, home, name) 组合下标 bincount，得到行数与数量之和的四维数组
+        if self._usage is None:
+            town_halls = self._numbers("items", "townHall").astype(np.int32)
+            kinds, kind_values = self._codes("items", "kind")
+            homes, home_values = self._codes("items", "home")
+            names, name_values = self._codes("items", "name")
+            shape = (int(town_halls.max()) + 1 if len(town_halls) else 1, max(len(kind_values), 1), max(len(home_values), 1), max(len(name_values), 1))
+            size = shape[0] * shape[1] * shape[2] * shape[3]
+            # 立方体很小（几万格），组合下标用 int32 计算
+            key = town_halls * (shape[1] * shape[2] * shape[3])
+            key += kinds.astype(np.int32) * (shape[2] * shape[3])
+            key += homes.astype(np.int32) * shape[3]
+            key += names.astype(np.int32)
+            amount = self._numbers("items", "amount")
+            if (kinds < 0).any() or (homes < 0).any() or (names < 0).any():
+                keep = (kinds >= 0) & (homes >= 0) & (names >= 0)
+                key, amount = key[keep], amount[keep]
+            counts = np.bincount(key, minlength=size).reshape(shape)
+            amounts = np.bincount(key, weights=amount, minlength=size).reshape(shape)
+            self._usage = (counts, amounts)
+        return self._usage
+
+    def score_distribution(self, town_hall: Optional[int] = None, percentiles: Sequence[float] = (50, 90, 99)) -> List[Dict[str, Any]]:
+        # 每个大本营等级的分数分布：军队数、均值、百分位、最大值
+        scores, starts = self._scores_by_town_hall()
+        army_counts = self._town_hall_counts()
+        levels = range(len(army_counts)) if town_hall is None else [town_hall] if town_hall < len(army_counts) else []
+        result = []
+        for level in levels:
+            group = scores[starts[level]:starts[level] + army_counts[level]]
+            if not len(group):
+                continue
+            entry: Dict[str, Any] = {"townHall": int(level), "armies": len(group), "mean": round(float(group.mean()), 3)}
+            for p, value in zip(percentiles, np.percentile(group, percentiles)):
+                entry[f"p{p:g}"] = round(float(value), 3)
+            entry["max"] = round(float(group.max()), 3)
+            result.append(entry)
+        return result
+
+    def _scores_by_town_hall(self) -> Tuple[Any, Any]:
+        # 按等级稳定排序（int16 走基数排序）后每个等级是一段连续区间
+        if self._scores is None:
+            town_halls = self._numbers("armies", "townHall")
+            order = np.argsort(town_halls, kind="stable")
+            scores = self._numbers("armies", "score").astype(np.float64)[order]
+            starts = np.concatenate(([0], np.cumsum(self._town_hall_counts())[:-1]))
+            self._scores = (scores, starts)
+        return self._scores
+
+    def copy_click_rates(self, town_hall: Optional[int] = None) -> List[Dict[str, Any]]:
+        # 每个大本营等级的复制链接率：copyLinkClicks / pageViews（及打开链接率）
+        town_halls = self._numbers("armies", "townHall").astype(np.int64)
+        army_counts = self._town_hall_counts()
+        sums = {
+            column: np.bincount(town_halls, weights=self._numbers("armies", column), minlength=len(army_counts))
+            for column in ("pageViews", "copyLinkClicks", "openLinkClicks")
+        }
+        result = []
+        for level in np.nonzero(army_counts)[0]:
+            if town_hall is not None and level != town_hall:
+                continue
+            views = sums["pageViews"][level]
+            result.append({
+                "townHall": int(level),
+                "armies": int(army_counts[level]),
+                "pageViews": int(views),
+                "copyLinkClicks": int(sums["copyLinkClicks"][level]),
+                "openLinkClicks": int(sums["openLinkClicks"][level]),
+                "copyRate": round(float(sums["copyLinkClicks"][level] / views), 4) if views else 0.0,
+                "openRate": round(float(sums["openLinkClicks"][level] / views), 4) if views else 0.0,
+            })
+        return result
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description="Vectorized reports over the columnar army snapshot")
+    parser.add_argument("snapshot", help="列式快照目录（firestore_uploader.py --columnar 的输出）")
+    parser.add_argument("--report", default="all", choices=["usage", "scores", "copy-rates", "all"], help="要输出的统计")
+    parser.add_argument("--town-hall", type=int, default=None, help="只统计该大本营等级")
+    parser.add_argument("--kind", default="troop", choices=["troop", "spell", "siege", "hero", "pet", "equipment"], help="usage 统计的类别")
+    parser.add_argument("--home", default=None, choices=["armyCamp", "clanCastle"], help="usage 统计兵种/法术/攻城机器的位置（默认军营）")
+    parser.add_argument("--top", type=int, default=20, help="usage 输出前 N 项")
+    parser.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"], help="日志级别")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        level=getattr(logging, args.log_level.upper(), logging.INFO),
+        format="%(asctime)s %(levelname)s: %(message)s",
+        datefmt="%H:%M:%S",
+    )
+    if np is None:
+        logging.error("army_report.py requires numpy and pyarrow: pip install pyarrow numpy")
+        return 1
+
+    try:
+        t0 = time.perf_counter()
+        report = ArmyReport.load(args.snapshot)
+        logging.info(
+            f"Loaded {report.armies.num_rows} armies and {report.items.num_rows} items from {args.snapshot} in {time.perf_counter() - t0:.2f}s"
+        )
+    except Exception as e:
+        logging.error(f"Failed to load snapshot {args.snapshot}: {e}")
+        logging.debug(traceback.format_exc())
+        return 1
+
+    reports = {
+        "usage": lambda: report.unit_usage(args.town_hall, args.kind, args.home, args.top),
+        "scores": lambda: report.score_distribution(args.town_hall),
+        "copy-rates": lambda: report.copy_click_rates(args.town_hall),
+    }
+    output: Dict[str, Any] = {}
+    for name, run in reports.items():
+        if args.report not in ("all", name):
+            continue
+        t0 = time.perf_counter()
+        output[name] = run()
+        logging.info(f"Report {name}: {(time.perf_counter() - t0) * 1000:.1f}ms")
+    print(json.dumps(output, ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,441 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+import copy_link
+from firestore_uploader import (
+    ArmyRecord,
+    _WatermarkTracker,
+    _filter_armies_since,
+    generate_copy_link,
+    transform_army,
+    upload_armies,
+)
+from local_firestore import LocalFirestore
+
+
+# 与 migration 中 clashId 一致的游戏数据子集，生成的数据形状与 getArmies 导出接口相同
+TROOPS: Dict[str, int] = {
+    "Barbarian": 0,
+    "Archer": 1,
+    "Goblin": 2,
+    "Giant": 3,
+    "Wall Breaker": 4,
+    "Balloon": 5,
+    "Wizard": 6,
+    "Healer": 7,
+    "Dragon": 8,
+    "P.E.K.K.A": 9,
+    "Minion": 10,
+    "Hog Rider": 11,
+    "Valkyrie": 12,
+    "Golem": 13,
+    "Witch": 15,
+    "Lava Hound": 17,
+    "Bowler": 22,
+    "Baby Dragon": 23,
+    "Miner": 24,
+    "Yeti": 53,
+    "Electro Dragon": 59,
+}
+SIEGES: Dict[str, int] = {
+    "Wall Wrecker": 51,
+    "Battle Blimp": 52,
+    "Stone Slammer": 62,
+    "Siege Barracks": 75,
+    "Log Launcher": 87,
+}
+SPELLS: Dict[str, int] = {
+    "Lightning": 0,
+    "Healing": 1,
+    "Rage": 2,
+    "Jump": 3,
+    "Freeze": 5,
+    "Poison": 9,
+    "Earthquake": 10,
+    "Haste": 11,
+    "Clone": 16,
+    "Skeleton": 17,
+    "Bat": 28,
+    "Invisibility": 35,
+}
+PETS: Dict[str, int] = {
+    "Lassi": 0,
+    "Mighty Yak": 1,
+    "Electro Owl": 2,
+    "Unicorn": 3,
+    "Phoenix": 4,
+    "Poison Lizard": 7,
+    "Diggy": 8,
+    "Frosty": 9,
+    "Spirit Fox": 10,
+    "Angry Jelly": 11,
+    "Sneezy": 16,
+}
+EQUIPMENT: Dict[str, Dict[str, int]] = {
+    "Barbarian King": {"Barbarian Puppet": 0, "Rage Vial": 1, "Earthquake Boots": 8, "Vampstache": 11, "Giant Gauntlet": 10, "Spiky Ball": 14, "Snake Bracelet": 32},
+    "Archer Queen": {"Archer Puppet": 2, "Invisibility Vial": 3, "Giant Arrow": 17, "Healer Puppet": 20, "Frozen Arrow": 15, "Magic Mirror": 39, "Action Figure": 48},
+    "Grand Warden": {"Eternal Tome": 4, "Life Gem": 5, "Rage Gem": 24, "Healing Tome": 34, "Fireball": 22, "Lavaloon Puppet": 41},
+    "Royal Champion": {"Royal Gem": 7, "Seeking Shield": 6, "Hog Rider Doll": 9, "Haste Vial": 12, "Rocket Spear": 13, "Electro Boots": 40},
+    "Minion Prince": {"Henchmen Puppet": 42, "Dark Orb": 43, "Metal Pants": 44, "Noble Iron": 47, "Dark Crown": 35},
+}
+BANNERS = ["fire-and-ice", "samurai", "dark-days", "bridge", "fire-warden", "gold-statues", "goblin-fight", "clashiversary", "th-16", "chess"]
+ARMY_TAGS = ["CWL/War", "Legends League", "Farming", "Beginner Friendly", "Spam"]
+
+BENCHMARKS = ["records", "transform", "copy_link", "copy_link_decode", "filter", "watermark", "upload"]
+
+
+def _iso(dt: datetime) -> str:
+    # 与 MySQL JSON 导出一致：毫秒精度 + Z
+    return dt.strftime("%Y-%m-%dT%H:%M:%S.") + f"{dt.microsecond // 1000:03d}Z"
+
+
+def iter_synthetic_armies(n: int, seed: int = 1, start: Optional[datetime] = None) -> Iterator[Dict[str, Any]]:
+    # 按导出接口的顺序 (updatedTime, id) 生成 n 支军队；约 1/8 的军队与上一条同一时间，覆盖游标的 id 判定
+    rng = random.Random(seed)
+    updated = start or datetime(2024, 1, 1, tzinfo=timezone.utc)
+    unit_row = 0
+    for army_id in range(1, n + 1):
+        if rng.random() >= 0.125:
+            updated += timedelta(seconds=rng.randint(1, 600))
+        created = updated - timedelta(days=rng.randint(0, 90))
+
+        units: List[Dict[str, Any]] = []
+
+        def add_units(pool: Dict[str, int], count: int, home: str, unit_type: str, amount: Callable[[], int]) -> None:
+            nonlocal unit_row
+            for name in rng.sample(list(pool), count):
+                unit_row += 1
+                units.append({
+                    "id": unit_row,
+                    "home": home,
+                    "armyId": army_id,
+                    "unitId": pool[name] + 1,
+                    "amount": amount(),
+                    "name": name,
+                    "type": unit_type,
+                    "clashId": pool[name],
+                    "housingSpace": 1,
+                    "productionBuilding": "Barrack",
+                    "isSuper": 0,
+                    "isFlying": 0,
+                    "isJumper": 0,
+                    "airTargets": 1,
+                    "groundTargets": 1,
+                })
+
+        add_units(TROOPS, rng.randint(3, 8), "armyCamp", "Troop", lambda: rng.randint(1, 30))
+        add_units(SPELLS, rng.randint(2, 4), "armyCamp", "Spell", lambda: rng.randint(1, 5))
+        if rng.random() < 0.7:
+            add_units(SIEGES, 1, "clanCastle", "Siege", lambda: 1)
+        add_units(TROOPS, rng.randint(0, 3), "clanCastle", "Troop", lambda: rng.randint(1, 6))
+        add_units(SPELLS, rng.randint(0, 2), "clanCastle", "Spell", lambda: 1)
+
+        pets: List[Dict[str, Any]] = []
+        equipment: List[Dict[str, Any]] = []
+        pet_names = rng.sample(list(PETS), 4)
+        for i, hero in enumerate(rng.sample(list(EQUIPMENT), rng.randint(0, 4))):
+            for name in rng.sample(list(EQUIPMENT[hero]), 2):
+                equipment.append({
+                    "id": len(equipment) + 1,
+                    "armyId": army_id,
+                    "equipmentId": EQUIPMENT[hero][name] + 1,
+                    "hero": hero,
+                    "name": name,
+                    "clashId": EQUIPMENT[hero][name],
+                    "epic": 0,
+                })
+            if rng.random() < 0.8:
+                pets.append({
+                    "id": len(pets) + 1,
+                    "hero": hero,
+                    "armyId": army_id,
+                    "petId": PETS[pet_names[i]] + 1,
+                    "name": pet_names[i],
+                    "clashId": PETS[pet_names[i]],
+                })
+
+        votes = rng.randint(0, 50)
+        yield {
+            "id": army_id,
+            "name": f"Synthetic army {army_id}",
+            "townHall": rng.randint(9, 17),
+            "banner": rng.choice(BANNERS),
+            "createdBy": rng.randint(1, 5000),
+            "createdTime": _iso(created),
+            "updatedTime": _iso(updated),
+            "score": round(votes * rng.random() * 10, 4),
+            "votes": votes,
+            "pageViews": rng.randint(0, 5000),
+            "openLinkClicks": rng.randint(0, 500),
+            "copyLinkClicks": rng.randint(0, 500),
+            "username": f"user{rng.randint(1, 5000)}",
+            "units": units or None,
+            "equipment": equipment or None,
+            "pets": pets or None,
+            "tags": rng.sample(ARMY_TAGS, rng.randint(0, 3)) or None,
+            "comments": None,
+            "guide": None,
+            "userVote": 0,
+            "userBookmarked": 0,
+        }
+
+
+def write_synthetic_export(path: str, n: int, seed: int = 1) -> None:
+    # 逐条写出导出接口格式的 JSON 数组，1M 级别也不需要把全部军队放进内存
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("[")
+        for i, army in enumerate(iter_synthetic_armies(n, seed)):
+            if i:
+                f.write(",")
+            f.write(json.dumps(army, ensure_ascii=False))
+        f.write("]")
+
+
+def _time_runs(fn: Callable[[], Any], repeat: int) -> List[float]:
+    runs: List[float] = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        runs.append(time.perf_counter() - t0)
+    return runs
+
+
+def _result(name: str, size: int, runs: List[float], **extra: Any) -> Dict[str, Any]:
+    best = min(runs)
+    entry: Dict[str, Any] = {
+        "name": name,
+        "size": size,
+        "runs": [round(r, 6) for r in runs],
+        "best_s": round(best, 6),
+        "median_s": round(statistics.median(runs), 6),
+        "per_item_us": round(best / size * 1e6, 3) if size else None,
+        "items_per_s": round(size / best, 1) if best > 0 else None,
+    }
+    entry.update(extra)
+    return entry
+
+
+def run_benchmarks(
+    sizes: List[int],
+    only: Optional[List[str]] = None,
+    repeat: int = 3,
+    seed: int = 1,
+    pool_size: int = 10000,
+    batch_sizes: Optional[List[int]] = None,
+    concurrencies: Optional[List[int]] = None,
+    workers: int = 1,
+    latency_ms: float = 0.0,
+    failure_rate: float = 0.0,
+) -> List[Dict[str, Any]]:
+    selected = only or BENCHMARKS
+    results: List[Dict[str, Any]] = []
+    # transform/copy_link 在固定大小的军队池上循环计时，避免 1M 级别时把完整军队全部驻留内存
+    pool = list(iter_synthetic_armies(pool_size, seed)) if {"transform", "copy_link", "copy_link_decode"} & set(selected) else []
+    links = copy_link.encode_many(pool) if "copy_link_decode" in selected else []
+
+    for size in sizes:
+        logging.info(f"Running benchmarks for {size} armies...")
+        if "transform" in selected:
+            def bench_transform() -> None:
+                for i in range(size):
+                    transform_army(pool[i % pool_size])
+            results.append(_result("transform", size, _time_runs(bench_transform, repeat)))
+
+        if "copy_link" in selected:
+            def bench_copy_link() -> None:
+                for i in range(size):
+                    generate_copy_link(pool[i % pool_size])
+            results.append(_result("copy_link", size, _time_runs(bench_copy_link, repeat)))
+
+        if "copy_link_decode" in selected:
+            def bench_copy_link_decode() -> None:
+                for i in range(size):
+                    copy_link.decode(links[i % pool_size])
+            results.append(_result("copy_link_decode", size, _time_runs(bench_copy_link_decode, repeat)))
+
+        if {"records", "filter", "watermark"} & set(selected):
+            # 过滤与水位线只读取 id/时间字段，用精简军队即可覆盖到 1M
+            armies = [
+                {"id": a["id"], "createdTime": a["createdTime"], "updatedTime": a["updatedTime"]}
+                for a in iter_synthetic_armies(size, seed)
+            ]
+            if "records" in selected:
+                results.append(_result("records", size, _time_runs(lambda: [ArmyRecord(a) for a in armies], repeat)))
+            records = [ArmyRecord(a) for a in armies]
+            del armies
+            if "filter" in selected:
+                mid = records[size // 2]
+
+                def bench_filter() -> None:
+                    for _ in _filter_armies_since(records, mid.iso, mid.id):
+                        pass
+                results.append(_result("filter", size, _time_runs(bench_filter, repeat), since=mid.iso, after_id=mid.id))
+            if "watermark" in selected:
+                def bench_watermark() -> None:
+                    tracker = _WatermarkTracker()
+                    for r in records:
+                        tracker.observe(r)
+                results.append(_result("watermark", size, _time_runs(bench_watermark, repeat)))
+            del records
+
+        if "upload" in selected:
+            with tempfile.TemporaryDirectory(prefix="bench_uploader_") as tmp:
+                export_path = os.path.join(tmp, "armies.json")
+                write_synthetic_export(export_path, size, seed)
+                # batch_size × concurrency 网格，便于在本地后端的模拟延迟下找到吞吐最高的组合
+                for batch_size in batch_sizes or [400]:
+                    for concurrency in concurrencies or [4]:
+                        stats: Dict[str, int] = {}
+
+                        def bench_upload() -> None:
+                            # 每轮使用全新的内存库，等同于首次全量同步
+                            db = LocalFirestore(latency_ms=latency_ms, failure_rate=failure_rate, seed=seed)
+                            try:
+                                _, uploaded, failed = upload_armies(
+                                    base_url="",
+                                    service_account="",
+                                    source_file=export_path,
+                                    db=db,
+                                    fs_migration=False,
+                                    use_manifest=False,
+                                    state_file=os.path.join(tmp, "state.txt"),
+                                    batch_size=batch_size,
+                                    concurrency=concurrency,
+                                    workers=workers,
+                                )
+                            finally:
+                                db.close()
+                            if uploaded != size or failed:
+                                raise RuntimeError(f"Upload benchmark wrote {uploaded}/{size} documents ({failed} failed)")
+                            stats.update(commits=db.commits, requests=db.requests, failures=db.failures)
+
+                        # 压测期间屏蔽上传流程自身的 INFO 日志
+                        level = logging.getLogger().level
+                        logging.getLogger().setLevel(logging.WARNING)
+                        try:
+                            runs = _time_runs(bench_upload, repeat)
+                        finally:
+                            logging.getLogger().setLevel(level)
+                        results.append(_result(
+                            "upload", size, runs,
+                            batch_size=batch_size, concurrency=concurrency, workers=workers,
+                            latency_ms=latency_ms, failure_rate=failure_rate, **stats,
+                        ))
+    return results
+
+
+def compare_results(current: List[Dict[str, Any]], baseline: List[Dict[str, Any]], threshold: float) -> List[str]:
+    # 按 (name, size) 对比最佳耗时，返回变慢超过阈值的条目
+    def key(r: Dict[str, Any]) -> Any:
+        return (r["name"], r["size"], r.get("batch_size"), r.get("concurrency"))
+
+    base = {key(r): r for r in baseline}
+    regressions: List[str] = []
+    for r in current:
+        old = base.get(key(r))
+        if not old or not old.get("best_s"):
+            continue
+        ratio = r["best_s"] / old["best_s"]
+        line = f"{r['name']:<10} {r['size']:>9}  {old['best_s']:.4f}s -> {r['best_s']:.4f}s  x{ratio:.2f}"
+        if ratio > 1 + threshold:
+            regressions.append(line)
+            logging.warning(f"REGRESSION {line}")
+        else:
+            logging.info(line)
+    return regressions
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the Firestore army sync tool on synthetic exports")
+    parser.add_argument("--sizes", default="1000,10000,100000", help="军队数量列表（逗号分隔），如 1000,10000,100000,1000000")
+    parser.add_argument("--only", default=None, help=f"只运行指定的基准（逗号分隔）：{','.join(BENCHMARKS)}")
+    parser.add_argument("--repeat", type=int, default=3, help="每项重复次数，结果取最佳与中位数")
+    parser.add_argument("--seed", type=int, default=1, help="合成数据随机种子（相同种子生成相同数据）")
+    parser.add_argument("--pool-size", type=int, default=10000, help="transform/copy_link/copy_link_decode 循环使用的军队池大小")
+    parser.add_argument("--batch-size", default="400", help="端到端上传的批次大小，可逗号分隔多个值做网格对比")
+    parser.add_argument("--concurrency", default="4", help="端到端上传的在途批次数，可逗号分隔多个值做网格对比")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="本地后端每个请求模拟的往返延迟（毫秒）")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="本地后端写入请求的模拟瞬时失败概率（0~1）")
+    parser.add_argument("--workers", type=int, default=1, help="端到端上传的转换进程数")
+    parser.add_argument("--output", default=None, help="结果 JSON 写入的文件，默认输出到标准输出")
+    parser.add_argument("--compare", default=None, help="与之前保存的结果 JSON 对比，变慢超过阈值时返回非 0")
+    parser.add_argument("--threshold", type=float, default=0.1, help="对比时允许的变慢比例（0.1 = 10%%）")
+    parser.add_argument("--generate", default=None, help="仅生成合成导出文件（取 --sizes 的第一个值），可配合 firestore_uploader.py --source-file 使用")
+    parser.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"], help="日志级别")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        level=getattr(logging, args.log_level.upper(), logging.INFO),
+        format="%(asctime)s %(levelname)s: %(message)s",
+        datefmt="%H:%M:%S",
+    )
+
+    sizes = [int(s) for s in args.sizes.split(",") if s.strip()]
+    if args.generate:
+        write_synthetic_export(args.generate, sizes[0], args.seed)
+        logging.info(f"Wrote {sizes[0]} synthetic armies to {args.generate}")
+        return 0
+
+    only = [s.strip() for s in args.only.split(",")] if args.only else None
+    unknown = [s for s in only or [] if s not in BENCHMARKS]
+    if unknown:
+        logging.error(f"Unknown benchmark(s): {', '.join(unknown)}")
+        return 2
+
+    results = run_benchmarks(
+        sizes,
+        only=only,
+        repeat=max(1, args.repeat),
+        seed=args.seed,
+        pool_size=args.pool_size,
+        batch_sizes=[int(s) for s in args.batch_size.split(",") if s.strip()],
+        concurrencies=[int(s) for s in args.concurrency.split(",") if s.strip()],
+        workers=args.workers,
+        latency_ms=args.latency_ms,
+        failure_rate=args.failure_rate,
+    )
+    report = {
+        "meta": {
+            "createdAt": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "platform": platform.platform(),
+            "cpuCount": os.cpu_count(),
+            "seed": args.seed,
+            "repeat": args.repeat,
+            "poolSize": args.pool_size,
+            "latencyMs": args.latency_ms,
+            "failureRate": args.failure_rate,
+        },
+        "results": results,
+    }
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+        logging.info(f"Wrote benchmark results to {args.output}")
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare_results(results, baseline.get("results") or [], args.threshold)
+        if regressions:
+            logging.error(f"{len(regressions)} benchmark(s) regressed by more than {args.threshold:.0%}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,480 @@
+import argparse
+import gzip
+import hashlib
+import json
+import logging
+import math
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Any, Dict, List, Optional, Tuple
+
+from PIL import Image
+
+
+# 静态资源构建：把 source-assets 下的原图转换成 static 下网站使用的各尺寸 webp
+#   每个子目录一组规则：输出后缀 -> 目标宽度（按比例缩放、高度向上取整；None 表示保持原尺寸）
+#   用进程池并行编码；清单记录每个原图的内容哈希、规则指纹和输出，未变化的原图直接跳过
+# 目录不递归（heroes 与 heroes/equipment 分开配置）；discord 表情是手动上传到 Discord 的，不在这里构建
+# 图集：部队/法术、宠物、装备的小图另外打包成 static/atlases/{name}.webp，坐标索引写入 static/atlases/index.json，
+#   军队卡片用一张图集代替几十个 *_small.webp 请求（上传脚本 --icon-atlas 输出图集引用）
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_SOURCE_DIR = os.path.join(ROOT_DIR, "source-assets")
+DEFAULT_OUTPUT_DIR = os.path.join(ROOT_DIR, "static")
+DEFAULT_MANIFEST = os.path.join(DEFAULT_SOURCE_DIR, ".asset_manifest.json")
+
+SOURCE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+
+# 与 static 中现有文件的尺寸一致（如 units/{name}_small.webp、heroes/equipment/{name}_small.webp）
+ASSET_SETS: Dict[str, Dict[str, Optional[int]]] = {
+    "units": {"": None, "_small": 150},
+    "heroes": {"": None},
+    "heroes/equipment": {"": 300, "_small": 150},
+    "heroes/pets": {"": None},
+    "town-halls": {"": 300, "_large": 600, "_small": 100},
+    "banners": {"": 1400, "_large": 1920, "_small": 1000},
+    "ui": {"": None},
+}
+
+# 单个文件覆盖所在目录的规则（相对 source-assets 的路径）
+ASSET_OVERRIDES: Dict[str, Dict[str, Optional[int]]] = {
+    "ui/header-barbarian.png": {"": 700, "_large": None},
+    "ui/league-king.png": {"": 700, "_large": None},
+}
+
+# 图集名 -> 原图子目录与图标宽度（与卡片使用的小图同尺寸）
+ATLASES: Dict[str, Dict[str, Any]] = {
+    "units": {"dir": "units", "width": 150},
+    "pets": {"dir": "heroes/pets", "width": 120},
+    "equipment": {"dir": "heroes/equipment", "width": 150},
+}
+ATLAS_DIR = "atlases"
+ATLAS_INDEX = f"{ATLAS_DIR}/index.json"
+ATLAS_MAX_WIDTH = 2048
+# 图标之间留空，缩放显示时不会采样到相邻图标
+ATLAS_PADDING = 2
+
+# 导出接口中的 type -> 图集（宠物与装备没有 type 字段，分别记为 Pet / Equipment）
+ATLAS_TYPES: Dict[str, str] = {"Troop": "units", "Spell": "units", "Siege": "units", "Pet": "pets", "Equipment": "equipment"}
+
+DEFAULT_QUALITY = 80
+
+# 清单格式/编码方式变化时递增，所有原图会重新构建
+MANIFEST_VERSION = 1
+
+
+def variants_for(rel_path: str) -> Dict[str, Optional[int]]:
+    override = ASSET_OVERRIDES.get(rel_path)
+    if override is not None:
+        return override
+    return ASSET_SETS[os.path.dirname(rel_path)]
+
+
+def output_paths(rel_path: str, variants: Dict[str, Optional[int]]) -> List[str]:
+    # 保留原文件名，只改后缀为 .webp；输出路径相对 static
+    base = os.path.splitext(rel_path)[0]
+    return [f"{base}{suffix}.webp" for suffix in variants]
+
+
+def config_fingerprint(variants: Dict[str, Optional[int]], quality: int) -> str:
+    payload = json.dumps({"version": MANIFEST_VERSION, "variants": variants, "quality": quality}, sort_keys=True)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()[:16]
+
+
+def file_hash(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def scan_sources(source_dir: str, only: Optional[List[str]] = None) -> List[str]:
+    # 按子目录顺序列出原图（相对 source-assets 的路径，统一用 / 分隔）
+    found: List[str] = []
+    for subdir in only or list(ASSET_SETS):
+        directory = os.path.join(source_dir, subdir)
+        if not os.path.isdir(directory):
+            logging.warning(f"Source directory not found, skipping: {directory}")
+            continue
+        for filename in sorted(os.listdir(directory)):
+            if filename.lower().endswith(SOURCE_EXTENSIONS) and os.path.isfile(os.path.join(directory, filename)):
+                found.append(f"{subdir}/{filename}")
+    return found
+
+
+def _target_size(size: Tuple[int, int], width: Optional[int]) -> Tuple[int, int]:
+    w, h = size
+    if width is None or width == w:
+        return w, h
+    return width, max(1, math.ceil(h * width / w))
+
+
+def build_one(source_dir: str, output_dir: str, rel_path: str, variants: Dict[str, Optional[int]], quality: int) -> Tuple[float, List[str]]:
+    # 在子进程中运行：原图只解码一次，依次缩放并编码各尺寸；先写临时文件再替换，中断时不会留下半个 webp
+    t0 = time.perf_counter()
+    written: List[str] = []
+    with Image.open(os.path.join(source_dir, rel_path)) as img:
+        img.load()
+        if img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGBA" if "A" in img.getbands() or "transparency" in img.info else "RGB")
+        for (suffix, width), out_rel in zip(variants.items(), output_paths(rel_path, variants)):
+            size = _target_size(img.size, width)
+            resized = img if size == img.size else img.resize(size, Image.LANCZOS)
+            out_path = os.path.join(output_dir, out_rel)
+            os.makedirs(os.path.dirname(out_path), exist_ok=True)
+            tmp = f"{out_path}.tmp"
+            resized.save(tmp, "WEBP", quality=quality)
+            os.replace(tmp, out_path)
+            written.append(out_rel)
+    return time.perf_counter() - t0, written
+
+
+def pack_shelves(sizes: List[Tuple[str, int, int]], max_width: int = ATLAS_MAX_WIDTH, padding: int = ATLAS_PADDING) -> Tuple[int, int, Dict[str, Tuple[int, int, int, int]]]:
+    # 按行（shelf）装箱：从高到低排序后逐行放置，行宽接近总面积的平方根，图集接近正方形
+    # 返回 (图集宽, 图集高, {名称: (x, y, w, h)})
+    if not sizes:
+        return 0, 0, {}
+    area = sum((w + padding) * (h + padding) for _, w, h in sizes)
+    widest = max(w for _, w, _ in sizes) + padding
+    sheet_width = min(max_width, max(widest, math.ceil(math.sqrt(area))))
+    placed: Dict[str, Tuple[int, int, int, int]] = {}
+    x = y = shelf_height = used_width = 0
+    for name, w, h in sorted(sizes, key=lambda item: (-item[2], item[0])):
+        if x and x + w + padding > sheet_width:
+            y += shelf_height
+            x = shelf_height = 0
+        placed[name] = (x, y, w, h)
+        x += w + padding
+        used_width = max(used_width, x)
+        shelf_height = max(shelf_height, h + padding)
+    return used_width - padding, y + shelf_height - padding, placed
+
+
+def build_atlas(source_dir: str, output_dir: str, name: str, rel_paths: List[str], width: int, quality: int) -> Tuple[float, Dict[str, Any]]:
+    # 在子进程中运行：缩放全部图标并打包成一张 webp，返回该图集的索引条目（精灵名为去掉扩展名的文件名）
+    t0 = time.perf_counter()
+    icons: Dict[str, Any] = {}
+    for rel_path in rel_paths:
+        with Image.open(os.path.join(source_dir, rel_path)) as img:
+            img = img.convert("RGBA")
+            size = _target_size(img.size, width)
+            icons[os.path.splitext(os.path.basename(rel_path))[0]] = img if size == img.size else img.resize(size, Image.LANCZOS)
+    sheet_width, sheet_height, placed = pack_shelves([(n, icon.width, icon.height) for n, icon in icons.items()])
+    sheet = Image.new("RGBA", (max(1, sheet_width), max(1, sheet_height)), (0, 0, 0, 0))
+    for sprite, (x, y, _, _) in placed.items():
+        sheet.paste(icons[sprite], (x, y))
+
+    image_rel = f"{ATLAS_DIR}/{name}.webp"
+    out_path = os.path.join(output_dir, image_rel)
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    tmp = f"{out_path}.tmp"
+    sheet.save(tmp, "WEBP", quality=quality)
+    os.replace(tmp, out_path)
+    entry = {
+        "image": image_rel,
+        "hash": file_hash(out_path)[:8],
+        "width": sheet.width,
+        "height": sheet.height,
+        "sprites": {sprite: {"x": x, "y": y, "w": w, "h": h} for sprite, (x, y, w, h) in sorted(placed.items())},
+    }
+    return time.perf_counter() - t0, entry
+
+
+def load_clash_ids(path: str) -> Dict[str, Dict[str, Dict[str, str]]]:
+    # 从导出接口同格式的 JSON（可为 .gz，如同步快照）收集 clashId -> 名称：{图集: {type: {clashId: 名称}}}
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as f:
+        armies = json.load(f)
+    found: Dict[str, Dict[str, Dict[str, str]]] = {}
+
+    def add(kind: Optional[str], clash_id: Any, name: Optional[str]) -> None:
+        atlas = ATLAS_TYPES.get(kind or "")
+        if atlas and name and clash_id is not None:
+            found.setdefault(atlas, {}).setdefault(kind, {})[str(clash_id)] = name
+
+    for army in armies:
+        for u in army.get("units") or ():
+            add(u.get("type"), u.get("clashId"), u.get("name"))
+        for p in army.get("pets") or ():
+            add("Pet", p.get("clashId"), p.get("name"))
+        for e in army.get("equipment") or ():
+            add("Equipment", e.get("clashId"), e.get("name"))
+    return found
+
+
+def _load_index(path: str) -> Dict[str, Any]:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            index = json.load(f)
+        if index.get("version") == MANIFEST_VERSION:
+            return index
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        logging.warning(f"Failed to read atlas index {path}, writing a new one: {e}")
+    return {"version": MANIFEST_VERSION, "atlases": {}}
+
+
+def _write_index(path: str, index: Dict[str, Any]) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(index, f, ensure_ascii=False, separators=(",", ":"), sort_keys=True)
+        f.write("\n")
+    os.replace(tmp, path)
+
+
+def _atlas_key(width: int, quality: int, members: List[Tuple[str, str]]) -> str:
+    payload = json.dumps(
+        {"version": MANIFEST_VERSION, "width": width, "quality": quality, "maxWidth": ATLAS_MAX_WIDTH, "padding": ATLAS_PADDING, "members": members}
+    )
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()[:16]
+
+
+class AssetManifest:
+    # 本地清单（JSON）：原图路径 -> 大小/mtime/内容哈希/规则指纹/输出列表
+    # 大小和 mtime 都没变时不读文件内容；变了才计算哈希，内容相同（如重新 checkout）只刷新 stat
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        self.atlases: Dict[str, Dict[str, Any]] = {}
+        if os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                if data.get("version") == MANIFEST_VERSION:
+                    self.entries = data.get("sources") or {}
+                    self.atlases = data.get("atlases") or {}
+                else:
+                    logging.info(f"Asset manifest version changed, rebuilding all assets: {path}")
+            except (OSError, ValueError) as e:
+                logging.warning(f"Failed to read asset manifest {path}, rebuilding all assets: {e}")
+
+    def is_current(self, source_path: str, rel_path: str, fingerprint: str, output_dir: str) -> bool:
+        entry = self.entries.get(rel_path)
+        if not entry or entry.get("config") != fingerprint:
+            return False
+        if not all(os.path.exists(os.path.join(output_dir, out)) for out in entry.get("outputs") or ()):
+            return False
+        st = os.stat(source_path)
+        if entry.get("size") == st.st_size and entry.get("mtime") == st.st_mtime_ns:
+            return True
+        if entry.get("size") != st.st_size or entry.get("hash") != file_hash(source_path):
+            return False
+        entry["mtime"] = st.st_mtime_ns
+        return True
+
+    def source_hash(self, source_path: str, rel_path: str) -> str:
+        entry = self.entries.get(rel_path)
+        st = os.stat(source_path)
+        if entry and entry.get("size") == st.st_size and entry.get("mtime") == st.st_mtime_ns:
+            return entry["hash"]
+        return file_hash(source_path)
+
+    def record(self, source_path: str, rel_path: str, fingerprint: str, outputs: List[str]) -> None:
+        st = os.stat(source_path)
+        self.entries[rel_path] = {
+            "size": st.st_size,
+            "mtime": st.st_mtime_ns,
+            "hash": file_hash(source_path),
+            "config": fingerprint,
+            "outputs": outputs,
+        }
+
+    def save(self) -> None:
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            data = {"version": MANIFEST_VERSION, "sources": dict(sorted(self.entries.items())), "atlases": self.atlases}
+            json.dump(data, f, ensure_ascii=False, indent=1)
+            f.write("\n")
+        os.replace(tmp, self.path)
+
+
+def build_assets(
+    source_dir: str = DEFAULT_SOURCE_DIR,
+    output_dir: str = DEFAULT_OUTPUT_DIR,
+    manifest_path: str = DEFAULT_MANIFEST,
+    only: Optional[List[str]] = None,
+    quality: int = DEFAULT_QUALITY,
+    workers: Optional[int] = None,
+    force: bool = False,
+    adopt: bool = False,
+    prune: bool = False,
+    dry_run: bool = False,
+    atlases: bool = True,
+    clash_ids_path: Optional[str] = None,
+) -> Tuple[int, int, int]:
+    # 返回 (构建数, 跳过数, 失败数)，图集计入构建数
+    t0 = time.perf_counter()
+    manifest = AssetManifest(manifest_path)
+    sources = scan_sources(source_dir, only)
+
+    pending: List[Tuple[str, Dict[str, Optional[int]], str]] = []
+    adopted = 0
+    for rel_path in sources:
+        source_path = os.path.join(source_dir, rel_path)
+        variants = variants_for(rel_path)
+        fingerprint = config_fingerprint(variants, quality)
+        if not force and manifest.is_current(source_path, rel_path, fingerprint, output_dir):
+            continue
+        outputs = output_paths(rel_path, variants)
+        if adopt and all(os.path.exists(os.path.join(output_dir, out)) for out in outputs):
+            # 把已有输出（如仓库中已提交的 webp）记为当前原图的构建结果，不重新编码
+            manifest.record(source_path, rel_path, fingerprint, outputs)
+            adopted += 1
+            continue
+        pending.append((rel_path, variants, fingerprint))
+    skipped = len(sources) - len(pending)
+
+    # 图集：成员原图内容或打包参数变化时整张重建
+    index_path = os.path.join(output_dir, ATLAS_INDEX)
+    index = _load_index(index_path)
+    index_changed = False
+    pending_atlases: List[Tuple[str, List[str], int, str]] = []
+    for name, atlas in ATLASES.items() if atlases else ():
+        if only and atlas["dir"] not in only:
+            continue
+        members = [rel for rel in sources if os.path.dirname(rel) == atlas["dir"]]
+        key = _atlas_key(atlas["width"], quality, [(rel, manifest.source_hash(os.path.join(source_dir, rel), rel)) for rel in members])
+        exists = name in index["atlases"] and os.path.exists(os.path.join(output_dir, f"{ATLAS_DIR}/{name}.webp"))
+        if not force and exists and (manifest.atlases.get(name) or {}).get("key") == key:
+            continue
+        if adopt and exists:
+            manifest.atlases[name] = {"key": key}
+            adopted += 1
+            continue
+        pending_atlases.append((name, members, atlas["width"], key))
+    if clash_ids_path:
+        for name, by_type in load_clash_ids(clash_ids_path).items():
+            entry = index["atlases"].setdefault(name, {})
+            clash_ids = entry.setdefault("clashIds", {})
+            for kind, ids in by_type.items():
+                clash_ids.setdefault(kind, {}).update(ids)
+        index_changed = True
+
+    # 清单中原图已删除的条目：--prune 时一并删除它们生成的输出
+    scanned_dirs = set(only or ASSET_SETS)
+    present = set(sources)
+    removed = [rel for rel in manifest.entries if os.path.dirname(rel) in scanned_dirs and rel not in present]
+
+    if dry_run:
+        for rel_path, variants, _ in pending:
+            logging.info(f"Would build {rel_path} -> {', '.join(output_paths(rel_path, variants))}")
+        for name, members, _, _ in pending_atlases:
+            logging.info(f"Would build atlas {ATLAS_DIR}/{name}.webp from {len(members)} icons")
+        for rel_path in removed:
+            logging.info(f"Source removed: {rel_path}{' (outputs would be deleted)' if prune else ''}")
+        logging.info(f"[DRY RUN] {len(pending)} to build, {len(pending_atlases)} atlases to build, {skipped} up to date ({adopted} adopted)")
+        return len(pending) + len(pending_atlases), skipped, 0
+
+    for rel_path in removed:
+        entry = manifest.entries.pop(rel_path)
+        if prune:
+            for out in entry.get("outputs") or ():
+                out_path = os.path.join(output_dir, out)
+                if os.path.exists(out_path):
+                    os.remove(out_path)
+                    logging.info(f"Deleted {out}")
+
+    built = built_atlases = failed = 0
+    try:
+        if pending or pending_atlases:
+            with ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1) as pool:
+                # 图集最大，先提交，与单图编码并行
+                futures = {
+                    pool.submit(build_atlas, source_dir, output_dir, name, members, width, quality): ("atlas", name, key)
+                    for name, members, width, key in pending_atlases
+                }
+                for rel_path, variants, fingerprint in pending:
+                    futures[pool.submit(build_one, source_dir, output_dir, rel_path, variants, quality)] = ("source", rel_path, fingerprint)
+                for future in as_completed(futures):
+                    kind, target, fingerprint = futures[future]
+                    try:
+                        seconds, result = future.result()
+                    except Exception as e:
+                        failed += 1
+                        logging.error(f"Failed to build {target}: {e}")
+                        logging.debug(traceback.format_exc())
+                        continue
+                    if kind == "atlas":
+                        # 保留已收集的 clashId 映射
+                        previous = index["atlases"].get(target) or {}
+                        index["atlases"][target] = dict(result, clashIds=previous.get("clashIds") or {})
+                        index_changed = True
+                        manifest.atlases[target] = {"key": fingerprint}
+                        built_atlases += 1
+                        logging.info(f"Built atlas {result['image']} ({len(result['sprites'])} icons, {result['width']}x{result['height']}, {seconds * 1000:.0f}ms)")
+                        continue
+                    manifest.record(os.path.join(source_dir, target), target, fingerprint, result)
+                    built += 1
+                    logging.info(f"Built {target} -> {', '.join(result)} ({seconds * 1000:.0f}ms)")
+    finally:
+        # 中断时也保存已完成的部分，下次只构建剩下的原图
+        manifest.save()
+        if index_changed:
+            _write_index(index_path, index)
+
+    logging.info(
+        f"Built {built} assets and {built_atlases} atlases, {skipped} up to date ({adopted} adopted), {failed} failed in {time.perf_counter() - t0:.3f}s. "
+        + ("✅" if failed == 0 else "❌")
+    )
+    return built + built_atlases, skipped, failed
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description="Build the site's webp assets from source-assets")
+    parser.add_argument("--source", default=DEFAULT_SOURCE_DIR, help="原图目录，默认仓库中的 source-assets")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT_DIR, help="输出目录，默认仓库中的 static")
+    parser.add_argument("--manifest", default=DEFAULT_MANIFEST, help="构建清单路径，默认 source-assets/.asset_manifest.json")
+    parser.add_argument("--only", default=None, help=f"只构建指定子目录（逗号分隔）：{','.join(ASSET_SETS)}")
+    parser.add_argument("--quality", type=int, default=DEFAULT_QUALITY, help="webp 压缩质量 (0~100)")
+    parser.add_argument("--workers", type=int, default=None, help="编码进程数，默认为 CPU 核数")
+    parser.add_argument("--force", action="store_true", help="忽略清单，全部重新构建")
+    parser.add_argument("--adopt", action="store_true", help="输出已存在的原图直接记入清单而不重新编码（新克隆仓库后运行一次）")
+    parser.add_argument("--prune", action="store_true", help="删除清单中原图已不存在的输出文件")
+    parser.add_argument("--dry-run", action="store_true", help="只列出需要构建的原图，不写入任何文件")
+    parser.add_argument("--no-atlas", action="store_true", help="不构建部队/宠物/装备图集")
+    parser.add_argument(
+        "--clash-ids", default=None, help="从导出接口同格式的 JSON（可为 .gz）收集 clashId -> 名称，写入图集索引，供按 clashId 查找图标"
+    )
+    parser.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"], help="日志级别")
+    args = parser.parse_args(argv)
+
+    only = [s.strip().strip("/") for s in args.only.split(",") if s.strip()] if args.only else None
+    unknown = [s for s in only or [] if s not in ASSET_SETS]
+    if unknown:
+        parser.error(f"Unknown asset directories: {', '.join(unknown)}")
+    if not 0 <= args.quality <= 100:
+        parser.error("--quality must be between 0 and 100")
+    if args.workers is not None and args.workers < 1:
+        parser.error("--workers must be positive")
+
+    logging.basicConfig(
+        level=getattr(logging, args.log_level.upper(), logging.INFO),
+        format="%(asctime)s %(levelname)s: %(message)s",
+        datefmt="%H:%M:%S",
+    )
+
+    _, _, failed = build_assets(
+        source_dir=args.source,
+        output_dir=args.output,
+        manifest_path=args.manifest,
+        only=only,
+        quality=args.quality,
+        workers=args.workers,
+        force=args.force,
+        adopt=args.adopt,
+        prune=args.prune,
+        dry_run=args.dry_run,
+        atlases=not args.no_atlas,
+        clash_ids_path=args.clash_ids,
+    )
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
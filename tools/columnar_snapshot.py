@@ -0,0 +1,319 @@
+import os
+from array import array
+from datetime import datetime
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:
+    # 只有 --columnar 与 army_report.py 需要 pyarrow
+    pa = None
+    pc = None
+    pq = None
+
+
+# 列式快照：把同步流水线中 transform_army 生成的文档按列写成 Arrow IPC 或 Parquet，供离线分析（army_report.py）
+#   armies.{parquet,arrow}      每个军队一行：基本信息、计数器、标签
+#   army_items.{parquet,arrow}  展开的组成：每个兵种/法术/攻城机器/英雄/宠物/装备一行，以 armyId 关联，冗余 townHall 便于直接过滤
+# 快照覆盖整个军队集合：每次运行只记录提交成功的变化，结束时按 id 与已有快照合并——常规同步写入的军队替换同 id 的旧行，
+# --metrics-only 刷新旧行的计数器，--reconcile 删除的军队被丢弃，其余旧行逐批复制；增量运行与 --watch 不会用一小段增量覆盖全量快照
+# 每 batch_rows 个军队写出一个 row group / record batch，内存与军队总数无关；先写临时文件，成功结束后再替换
+
+FORMATS = ("parquet", "arrow")
+
+# 分类列取值很少，读取时按字典编码（见 load_snapshot）
+DICTIONARY_COLUMNS = {"armies": ["banner"], "army_items": ["kind", "home", "name", "hero"]}
+
+# --metrics-only 刷新的计数器列
+METRIC_COLUMNS = ("score", "votes", "pageViews", "openLinkClicks", "copyLinkClicks")
+
+# composition 中的分组 -> kind
+UNIT_KINDS = (("troops", "troop"), ("spells", "spell"), ("sieges", "siege"))
+
+if pa is not None:
+    ARMIES_SCHEMA = pa.schema([
+        ("id", pa.int64()),
+        ("name", pa.string()),
+        ("townHall", pa.int16()),
+        ("banner", pa.string()),
+        ("createdByUsername", pa.string()),
+        ("createdTime", pa.timestamp("ms", tz="UTC")),
+        ("updatedTime", pa.timestamp("ms", tz="UTC")),
+        ("score", pa.float64()),
+        ("votes", pa.int32()),
+        ("pageViews", pa.int64()),
+        ("openLinkClicks", pa.int64()),
+        ("copyLinkClicks", pa.int64()),
+        ("tags", pa.list_(pa.string())),
+        ("copyLink", pa.string()),
+    ])
+    ITEMS_SCHEMA = pa.schema([
+        ("armyId", pa.int64()),
+        ("townHall", pa.int16()),
+        # troop / spell / siege / hero / pet / equipment
+        ("kind", pa.string()),
+        # armyCamp / clanCastle / hero（宠物和装备属于英雄）
+        ("home", pa.string()),
+        ("name", pa.string()),
+        # 宠物和装备所属的英雄
+        ("hero", pa.string()),
+        ("clashId", pa.int32()),
+        ("amount", pa.int16()),
+    ])
+    SCHEMAS = {"armies": ARMIES_SCHEMA, "army_items": ITEMS_SCHEMA}
+
+
+def _require_pyarrow() -> None:
+    if pa is None:
+        raise RuntimeError("Columnar snapshots require pyarrow: pip install pyarrow numpy")
+
+
+def _ms(value: Optional[str]) -> Optional[int]:
+    if not value:
+        return None
+    try:
+        if value.endswith("Z"):
+            value = value[:-1] + "+00:00"
+        return int(datetime.fromisoformat(value).timestamp() * 1000)
+    except ValueError:
+        return None
+
+
+def snapshot_paths(directory: str, fmt: str) -> Dict[str, str]:
+    return {name: os.path.join(directory, f"{name}.{fmt}") for name in ("armies", "army_items")}
+
+
+class ColumnarSnapshot:
+    def __init__(self, directory: str, fmt: str = "parquet", batch_rows: int = 65536) -> None:
+        _require_pyarrow()
+        if fmt not in FORMATS:
+            raise ValueError(f"Unknown columnar format {fmt!r}, expected one of {', '.join(FORMATS)}")
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.fmt = fmt
+        self.batch_rows = max(1, batch_rows)
+        self.paths = snapshot_paths(directory, fmt)
+        # 合并前已有的快照（任一格式），None 表示这是第一次写入
+        self.previous = _existing_paths(directory)
+        self.armies = 0
+        self.items = 0
+        self.updated = 0
+        self.refreshed = 0
+        self.removed = 0
+        self._ids: Set[int] = set()
+        self._removed: Set[int] = set()
+        # 计数器更新按列存成紧凑数组（百万军队约 50MB），合并时向量化替换
+        self._metric_ids: "array[int]" = array("q")
+        self._metric_values: Dict[str, Any] = {column: array("d" if column == "score" else "q") for column in METRIC_COLUMNS}
+        self._writers: Dict[str, Any] = {}
+        self._columns: Dict[str, Dict[str, List[Any]]] = {name: {field: [] for field in schema.names} for name, schema in SCHEMAS.items()}
+
+    def write(self, docs: List[Dict[str, Any]]) -> None:
+        armies = self._columns["armies"]
+        items = self._columns["army_items"]
+        for doc in docs:
+            army_id = doc.get("id")
+            if army_id in self._ids:
+                # 导出中每个军队只出现一次；万一重复也只写一行，合并时不会出现同 id 的多行
+                continue
+            self._ids.add(army_id)
+            self.updated += 1
+            town_hall = doc.get("townHall")
+            metrics = doc.get("metrics") or {}
+            armies["id"].append(army_id)
+            armies["name"].append(doc.get("name"))
+            armies["townHall"].append(town_hall)
+            armies["banner"].append(doc.get("banner"))
+            armies["createdByUsername"].append(doc.get("createdByUsername"))
+            armies["createdTime"].append(_ms(doc.get("createdTime")))
+            armies["updatedTime"].append(_ms(doc.get("updatedTime")))
+            armies["score"].append(float(metrics.get("score") or 0))
+            armies["votes"].append(metrics.get("votes") or 0)
+            armies["pageViews"].append(metrics.get("pageViews") or 0)
+            armies["openLinkClicks"].append(metrics.get("openLinkClicks") or 0)
+            armies["copyLinkClicks"].append(metrics.get("copyLinkClicks") or 0)
+            armies["tags"].append(list(doc.get("tags") or []))
+            armies["copyLink"].append(doc.get("copyLink"))
+
+            composition = doc.get("composition") or {}
+            rows: List[Tuple[str, str, Any, Any, Any, Any]] = []
+            for home in ("armyCamp", "clanCastle"):
+                groups = composition.get(home) or {}
+                for group, kind in UNIT_KINDS:
+                    for unit in groups.get(group) or ():
+                        rows.append((kind, home, unit.get("name"), None, unit.get("clashId"), unit.get("amount")))
+            for hero in composition.get("heroes") or ():
+                hero_name = hero.get("name")
+                rows.append(("hero", "hero", hero_name, None, hero.get("clashId"), 1))
+                pet = hero.get("pet")
+                if pet:
+                    rows.append(("pet", "hero", pet.get("name"), hero_name, pet.get("clashId"), 1))
+                for equipment in hero.get("equipment") or ():
+                    rows.append(("equipment", "hero", equipment.get("name"), hero_name, equipment.get("clashId"), 1))
+            for kind, home, name, hero_name, clash_id, amount in rows:
+                items["armyId"].append(army_id)
+                items["townHall"].append(town_hall)
+                items["kind"].append(kind)
+                items["home"].append(home)
+                items["name"].append(name)
+                items["hero"].append(hero_name)
+                items["clashId"].append(clash_id)
+                items["amount"].append(amount)
+        if len(armies["id"]) >= self.batch_rows:
+            self._flush()
+
+    def remove(self, ids: Iterable[int]) -> None:
+        # 已在网站删除的军队（--reconcile）：合并时丢弃它们的旧行
+        for army_id in ids:
+            if army_id not in self._removed:
+                self._removed.add(army_id)
+                self.removed += 1
+
+    def update_metrics(self, rows: Iterable[Tuple[int, Dict[str, Any]]]) -> None:
+        # --metrics-only：(id, 计数器)；合并时刷新已有军队的计数器列，快照中没有的 id 忽略
+        for army_id, metrics in rows:
+            self._metric_ids.append(army_id)
+            for column, values in self._metric_values.items():
+                values.append(metrics.get(column) or 0)
+
+    @property
+    def changed(self) -> bool:
+        return bool(self._ids or self._removed or self._metric_ids)
+
+    def close(self, ok: bool = True) -> bool:
+        # 返回是否写出了新快照；ok=False（同步出错、导出未变化）或没有任何变化时丢弃临时文件，保留上一次的快照
+        ok = ok and (bool(self._ids) or (self.previous is not None and self.changed))
+        try:
+            if ok:
+                self._flush(force=True)
+                self._merge_previous()
+        finally:
+            for writer in self._writers.values():
+                writer.close()
+        for name, path in self.paths.items():
+            if ok:
+                os.replace(path + ".tmp", path)
+                # 换了格式时删除另一种格式的旧快照，load_snapshot 不会读到过期数据
+                for fmt in FORMATS:
+                    stale = snapshot_paths(self.directory, fmt)[name]
+                    if fmt != self.fmt and os.path.exists(stale):
+                        os.remove(stale)
+            elif os.path.exists(path + ".tmp"):
+                os.remove(path + ".tmp")
+        return ok
+
+    def _merge_previous(self) -> None:
+        # 把旧快照中本次没有重写、也没有删除的军队逐批复制到新文件（旧快照可以是另一种格式）
+        if self.previous is None:
+            return
+        excluded = pa.array(sorted(self._ids | self._removed), pa.int64())
+        metrics = self._metric_arrays()
+        for name, key in (("armies", "id"), ("army_items", "armyId")):
+            count = 0
+            for batch in _read_batches(self.previous[name], self.batch_rows):
+                table = pa.Table.from_batches([batch], schema=SCHEMAS[name])
+                if len(excluded):
+                    table = table.filter(pc.invert(pc.is_in(table.column(key), value_set=excluded)))
+                if name == "armies" and metrics is not None:
+                    table = self._refresh_metrics(table, *metrics)
+                if table.num_rows:
+                    self._writer(name).write_table(table)
+                    count += table.num_rows
+            if name == "armies":
+                self.armies += count
+            else:
+                self.items += count
+
+    def _metric_arrays(self) -> Optional[Tuple[Any, Dict[str, Any]]]:
+        if not self._metric_ids:
+            return None
+        ids = pa.array(self._metric_ids, pa.int64())
+        values = {
+            column: pa.array(data, pa.float64() if column == "score" else pa.int64()).cast(ARMIES_SCHEMA.field(column).type)
+            for column, data in self._metric_values.items()
+        }
+        return ids, values
+
+    def _refresh_metrics(self, table: Any, ids: Any, values: Dict[str, Any]) -> Any:
+        # index_in 找到每行在更新列表中的位置（没有更新为 null），命中的行取新值，其余保留原值
+        positions = pc.index_in(table.column("id"), value_set=ids)
+        hits = len(positions) - positions.null_count
+        if not hits:
+            return table
+        self.refreshed += hits
+        found = pc.is_valid(positions)
+        for column, data in values.items():
+            i = table.schema.get_field_index(column)
+            table = table.set_column(i, column, pc.if_else(found, pc.take(data, positions), table.column(column)))
+        return table
+
+    def _flush(self, force: bool = False) -> None:
+        for name, schema in SCHEMAS.items():
+            columns = self._columns[name]
+            count = len(columns[schema.names[0]])
+            if not count and not (force and name not in self._writers):
+                continue
+            table = pa.Table.from_pydict(columns, schema=schema)
+            self._writer(name).write_table(table)
+            if name == "armies":
+                self.armies += count
+            else:
+                self.items += count
+            for values in columns.values():
+                values.clear()
+
+    def _writer(self, name: str) -> Any:
+        writer = self._writers.get(name)
+        if writer is None:
+            tmp = self.paths[name] + ".tmp"
+            if self.fmt == "parquet":
+                writer = pq.ParquetWriter(tmp, SCHEMAS[name], compression="zstd")
+            else:
+                # 不压缩：army_report.py 以内存映射方式直接读取
+                writer = pa.ipc.new_file(tmp, SCHEMAS[name])
+            self._writers[name] = writer
+        return writer
+
+
+def _existing_paths(directory: str) -> Optional[Dict[str, str]]:
+    # 目录中已有的完整快照（两张表同一格式）；优先 Parquet，与 load_snapshot 一致
+    for fmt in FORMATS:
+        paths = snapshot_paths(directory, fmt)
+        if all(os.path.exists(path) for path in paths.values()):
+            return paths
+    return None
+
+
+def _read_batches(path: str, batch_rows: int) -> Iterator[Any]:
+    # 逐批读取旧快照，合并时内存只与 batch_rows 有关
+    if path.endswith(".parquet"):
+        yield from pq.ParquetFile(path).iter_batches(batch_size=batch_rows)
+        return
+    with pa.memory_map(path) as source:
+        reader = pa.ipc.open_file(source)
+        for i in range(reader.num_record_batches):
+            yield reader.get_batch(i)
+
+
+def load_snapshot(directory: str) -> Tuple[Any, Any]:
+    # 读取 (armies, army_items)；Parquet 与 Arrow 文件都支持，分类列统一成单个字典
+    _require_pyarrow()
+    tables = []
+    for name in ("armies", "army_items"):
+        for fmt in FORMATS:
+            path = snapshot_paths(directory, fmt)[name]
+            if os.path.exists(path):
+                break
+        else:
+            raise FileNotFoundError(f"No {name}.parquet or {name}.arrow in {directory}")
+        if fmt == "parquet":
+            table = pq.read_table(path, read_dictionary=DICTIONARY_COLUMNS[name])
+        else:
+            table = pa.ipc.open_file(pa.memory_map(path)).read_all()
+            for column in DICTIONARY_COLUMNS[name]:
+                i = table.schema.get_field_index(column)
+                table = table.set_column(i, column, table.column(column).dictionary_encode())
+        tables.append(table.unify_dictionaries().combine_chunks())
+    return tables[0], tables[1]
@@ -0,0 +1,352 @@
+import argparse
+import gc
+import json
+import random
+import re
+import sys
+import time
+import urllib.parse
+from typing import Any, Dict, Iterable, List, Optional
+
+
+# Clash of Clans 复制军队链接（CopyArmy）编解码，与前端 src/lib/client/army.ts 的 generateLink / parseLink 对应
+# army= 参数由若干段组成，生成时顺序固定：h 英雄、i 部落城堡部队、d 部落城堡法术、u 部队、s 法术
+#   英雄段：{英雄id}[m{n}][p{宠物id}][e{装备1}[_{装备2}]]，多个英雄用 - 分隔
+#   部队/法术段：{数量}x{id}，用 - 分隔（攻城机器与部队同段）
+# 解码结果与导出接口的军队形状一致：units（home/type/clashId/amount）、pets 与 equipment（hero/clashId），
+# 可以直接再交给 encode；攻城机器无法从链接区分，统一解码为 Troop
+
+COPY_LINK_PREFIX = "https://link.clashofclans.com/?action=CopyArmy&army="
+
+# 英雄 clashId 映射，需与前端保持一致
+HERO_CLASH_IDS: Dict[str, int] = {
+    "Barbarian King": 0,
+    "Archer Queen": 1,
+    "Grand Warden": 2,
+    "Royal Champion": 4,
+    "Minion Prince": 6,
+}
+
+# 预先计算的查找表：英雄名 -> 链接中的 id 字符串，id -> 英雄名
+_HERO_CODES: Dict[str, str] = {name: str(clash_id) for name, clash_id in HERO_CLASH_IDS.items()}
+_HERO_NAMES: Dict[int, str] = {clash_id: name for name, clash_id in HERO_CLASH_IDS.items()}
+
+# (home, type) -> 段序号（0 为英雄段），与 _SECTION_LETTERS 对应
+_UNIT_SECTIONS: Dict[tuple, int] = {
+    ("clanCastle", "Troop"): 1,
+    ("clanCastle", "Siege"): 1,
+    ("clanCastle", "Spell"): 2,
+    ("armyCamp", "Troop"): 3,
+    ("armyCamp", "Siege"): 3,
+    ("armyCamp", "Spell"): 4,
+}
+_SECTION_LETTERS = "hidus"
+_DECODE_SECTIONS: Dict[str, tuple] = {
+    "i": ("clanCastle", "Troop"),
+    "d": ("clanCastle", "Spell"),
+    "u": ("armyCamp", "Troop"),
+    "s": ("armyCamp", "Spell"),
+}
+
+_SPLIT_RE = re.compile(r"([hidus])")
+_TOKEN_RE = re.compile(r"(\d+)x(\d+)")
+_HERO_RE = re.compile(r"(\d+)(?:m\d+)?(?:p(\d+))?(?:e(\d+)(?:_(\d+))?)?")
+
+
+# 编解码缓存，同一批军队中的部队写法大量重复（常见的法术、部落城堡组合），命中时省去格式化/解析；超过上限时整体清空
+#   编码：(amount, clashId) -> 部队写法
+#   解码：段字母 -> {部队写法: 解码结果模板}，英雄写法 -> (宠物模板, 装备模板)；返回时复制模板（dict.copy），调用方拿到的都是新 dict，
+#   也省去逐个部队在 Python 中构造 dict
+_CACHE_LIMIT = 65536
+_TOKEN_CACHE: Dict[tuple, str] = {}
+_UNIT_CACHES: Dict[str, Dict[str, Dict[str, Any]]] = {kind: {} for kind in _DECODE_SECTIONS}
+_HERO_CACHE: Dict[str, tuple] = {}
+
+
+class CopyLinkError(ValueError):
+    pass
+
+
+def _cache_put(cache: Dict[Any, Any], key: Any, value: Any) -> Any:
+    if len(cache) >= _CACHE_LIMIT:
+        cache.clear()
+    cache[key] = value
+    return value
+
+
+def group_assets_by_hero(pets: List[Dict[str, Any]], equipment: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    # 根据宠物和装备推导使用到的英雄集合：{英雄名: {"equipment": [...], "pet": {...}}}，保持出现顺序
+    by_hero: Dict[str, Dict[str, Any]] = {}
+    for eq in equipment or []:
+        hero = eq.get("hero")
+        if not hero:
+            continue
+        h = by_hero.setdefault(hero, {})
+        h.setdefault("equipment", []).append(eq)
+
+    for p in pets or []:
+        hero = p.get("hero")
+        if not hero:
+            continue
+        h = by_hero.setdefault(hero, {})
+        # 只取一个宠物（与前端生成逻辑一致）
+        if "pet" not in h:
+            h["pet"] = p
+    return by_hero
+
+
+def encode_army(army: Dict[str, Any], by_hero: Optional[Dict[str, Dict[str, Any]]] = None) -> str:
+    # 只生成 army= 参数部分；英雄按装备、宠物的出现顺序分组，每个英雄取第一个宠物和前两件装备
+    # by_hero 可传入调用方已用 group_assets_by_hero 分好组的结果（上传脚本的英雄卡片与链接共用一次分组）
+    if by_hero is None:
+        by_hero = group_assets_by_hero(army.get("pets") or [], army.get("equipment") or [])
+
+    sections: List[List[str]] = [[], [], [], [], []]
+    hero_parts = sections[0]
+    for name, data in by_hero.items():
+        code = _HERO_CODES.get(name)
+        if code is None:
+            continue
+        pet = data.get("pet")
+        if pet and pet.get("clashId") is not None:
+            code += f"p{int(pet['clashId'])}"
+        eqs = data.get("equipment")
+        if eqs:
+            code += f"e{int(eqs[0].get('clashId'))}"
+            if len(eqs) > 1 and eqs[1].get("clashId") is not None:
+                code += f"_{int(eqs[1]['clashId'])}"
+        hero_parts.append(code)
+
+    lookup = _UNIT_SECTIONS.get
+    tokens = _TOKEN_CACHE
+    for u in army.get("units") or ():
+        clash_id = u.get("clashId")
+        if clash_id is None:
+            continue
+        section = lookup((u.get("home"), u.get("type")))
+        if section is not None:
+            key = (u.get("amount", 0), clash_id)
+            token = tokens.get(key)
+            if token is None:
+                token = _cache_put(tokens, key, f"{int(key[0])}x{int(clash_id)}")
+            sections[section].append(token)
+
+    return "".join(letter + "-".join(parts) for letter, parts in zip(_SECTION_LETTERS, sections) if parts)
+
+
+def encode(army: Dict[str, Any], by_hero: Optional[Dict[str, Dict[str, Any]]] = None) -> str:
+    return COPY_LINK_PREFIX + encode_army(army, by_hero)
+
+
+def army_code(link: str) -> str:
+    # 从完整链接（任意语言路径，如 /en?action=CopyArmy&army=...）中取出 army= 参数；不含 ? 的字符串视为参数本身
+    start = link.find("army=")
+    if start >= 0:
+        code = link[start + 5:]
+        end = code.find("&")
+        if end >= 0:
+            code = code[:end]
+    elif "?" in link or "/" in link:
+        raise CopyLinkError(f"Copy link has no army parameter: {link!r}")
+    else:
+        code = link
+    if "%" in code:
+        code = urllib.parse.unquote(code)
+    return code.strip()
+
+
+def _unit_template(code: str, kind: str, body: str, token: str) -> Dict[str, Any]:
+    token_match = _TOKEN_RE.fullmatch(token)
+    if token_match is None:
+        raise CopyLinkError(f"Invalid {kind!r} section {body!r} in army code {code!r}")
+    home, unit_type = _DECODE_SECTIONS[kind]
+    template = {"home": home, "type": unit_type, "clashId": int(token_match[2]), "amount": int(token_match[1])}
+    return _cache_put(_UNIT_CACHES[kind], token, template)
+
+
+def _parse_hero(code: str, part: str) -> tuple:
+    hero_match = _HERO_RE.fullmatch(part)
+    if hero_match is None:
+        raise CopyLinkError(f"Invalid hero {part!r} in army code {code!r}")
+    hero_id, pet_id, eq1, eq2 = hero_match.groups()
+    hero = _HERO_NAMES.get(int(hero_id))
+    if hero is None:
+        raise CopyLinkError(f"Unknown hero id {hero_id} in army code {code!r}")
+    pets = () if pet_id is None else ({"hero": hero, "clashId": int(pet_id)},)
+    equipment = tuple({"hero": hero, "clashId": int(e)} for e in (eq1, eq2) if e is not None)
+    return _cache_put(_HERO_CACHE, part, (pets, equipment))
+
+
+def decode(link: str) -> Dict[str, Any]:
+    code = army_code(link)
+    parts = _SPLIT_RE.split(code)
+    if parts[0] or len(parts) < 3:
+        raise CopyLinkError(f"Invalid army code: {code!r}")
+    units: List[Dict[str, Any]] = []
+    pets: List[Dict[str, Any]] = []
+    equipment: List[Dict[str, Any]] = []
+    copy = dict.copy
+    for i in range(1, len(parts), 2):
+        kind, body = parts[i], parts[i + 1]
+        if kind == "h":
+            for part in body.split("-"):
+                parsed = _HERO_CACHE.get(part)
+                if parsed is None:
+                    parsed = _parse_hero(code, part)
+                pets += map(copy, parsed[0])
+                equipment += map(copy, parsed[1])
+        else:
+            tokens = body.split("-")
+            templates = list(map(_UNIT_CACHES[kind].get, tokens))
+            if None in templates:
+                templates = [t if t is not None else _unit_template(code, kind, body, token) for t, token in zip(templates, tokens)]
+            units += map(copy, templates)
+    return {"units": units, "pets": pets, "equipment": equipment}
+
+
+def encode_many(armies: Iterable[Dict[str, Any]]) -> List[str]:
+    prefix = COPY_LINK_PREFIX
+    return [prefix + encode_army(army) for army in armies]
+
+
+def decode_many(links: Iterable[str], strict: bool = True) -> List[Optional[Dict[str, Any]]]:
+    # strict=False 时无效链接返回 None（批量导入时逐条跳过，而不是整体失败）
+    # 批量解码一次创建大量小 dict，循环垃圾回收会反复扫描已解码的结果；解码结果不含循环引用，期间暂停 gc
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        if strict:
+            return [decode(link) for link in links]
+        results: List[Optional[Dict[str, Any]]] = []
+        for link in links:
+            try:
+                results.append(decode(link))
+            except CopyLinkError:
+                results.append(None)
+        return results
+    finally:
+        if enabled:
+            gc.enable()
+
+
+# 自检用例：README 与 src/lib/client/army.ts 注释中的示例链接，以及覆盖全部段与英雄写法的链接
+SELF_TEST_LINKS: List[str] = [
+    "https://link.clashofclans.com/en?action=CopyArmy&army=u10x0-2x3s1x9-3x2",
+    "https://link.clashofclans.com/?action=CopyArmy&army=h0p1e1_8-1p3e17_39-2e4_5-4e7-6p16e42_43i1x51-2x23d1x9-1x2u8x24-4x59-1x62s3x2-2x10",
+    "https://link.clashofclans.com/?action=CopyArmy&army=h1e2i5x0d1x0u30x1-1x7",
+    "https://link.clashofclans.com/?action=CopyArmy&army=s11x0",
+]
+
+
+def self_test() -> List[str]:
+    # 返回失败信息列表，空列表表示通过
+    failures: List[str] = []
+    readme = decode(SELF_TEST_LINKS[0])
+    expected = [("armyCamp", "Troop", 0, 10), ("armyCamp", "Troop", 3, 2), ("armyCamp", "Spell", 9, 1), ("armyCamp", "Spell", 2, 3)]
+    got = [(u["home"], u["type"], u["clashId"], u["amount"]) for u in readme["units"]]
+    if got != expected:
+        failures.append(f"README example decoded to {got}, expected {expected}")
+    for link in SELF_TEST_LINKS:
+        army = decode(link)
+        again = encode(army)
+        if army_code(again) != army_code(link):
+            failures.append(f"Round trip changed {army_code(link)!r} into {army_code(again)!r}")
+        if decode(again) != army:
+            failures.append(f"Round trip changed the decoded army of {link!r}")
+    if encode_many(decode_many(SELF_TEST_LINKS)) != [encode(decode(link)) for link in SELF_TEST_LINKS]:
+        failures.append("Bulk API disagrees with single encode/decode")
+    for bad in ["", "u10x", "u10x0-", "h9e1", "x1x1", "https://link.clashofclans.com/?action=CopyArmy", "h0e1_u1x1"]:
+        try:
+            decode(bad)
+            failures.append(f"Invalid link {bad!r} was accepted")
+        except CopyLinkError:
+            pass
+    if decode_many(["u1x0", "u1x"], strict=False)[1] is not None:
+        failures.append("decode_many(strict=False) did not return None for an invalid link")
+    return failures
+
+
+def _bench_armies(count: int, seed: int = 1) -> List[Dict[str, Any]]:
+    # 随机组合的军队（只含编码用到的字段）：部队/法术/攻城机器的 id 与数量、英雄的宠物与装备都随机，
+    # 重复的段与英雄写法和真实数据相近地少，缓存命中率不会虚高
+    rng = random.Random(seed)
+    heroes = list(HERO_CLASH_IDS)
+    armies = []
+    for _ in range(count):
+        units = []
+        for home, unit_type, low, high, max_amount in (
+            ("armyCamp", "Troop", 3, 8, 40),
+            ("armyCamp", "Spell", 1, 4, 6),
+            ("armyCamp", "Siege", 0, 1, 1),
+            ("clanCastle", "Troop", 0, 3, 10),
+            ("clanCastle", "Spell", 0, 2, 2),
+        ):
+            for clash_id in rng.sample(range(100), rng.randint(low, high)):
+                units.append({"home": home, "type": unit_type, "clashId": clash_id, "amount": rng.randint(1, max_amount)})
+        pets = []
+        equipment = []
+        for hero in rng.sample(heroes, rng.randint(0, len(heroes))):
+            if rng.random() < 0.8:
+                pets.append({"hero": hero, "clashId": rng.randrange(12)})
+            for clash_id in rng.sample(range(50), rng.randint(0, 2)):
+                equipment.append({"hero": hero, "clashId": clash_id})
+        armies.append({"units": units, "pets": pets, "equipment": equipment})
+    return armies
+
+
+def _clear_caches() -> None:
+    for cache in (_TOKEN_CACHE, _HERO_CACHE, *_UNIT_CACHES.values()):
+        cache.clear()
+
+
+def _bench(count: int) -> Dict[str, float]:
+    # 随机军队 -> 链接 -> 军队，每一轮开始前清空缓存，测的是冷缓存下的吞吐
+    armies = _bench_armies(count)
+    _clear_caches()
+    t0 = time.perf_counter()
+    links = encode_many(armies)
+    t1 = time.perf_counter()
+    _clear_caches()
+    t2 = time.perf_counter()
+    decode_many(links)
+    t3 = time.perf_counter()
+    return {
+        "links": count,
+        "avgLength": round(sum(map(len, links)) / max(count, 1), 1),
+        "encodePerSecond": round(count / (t1 - t0)),
+        "decodePerSecond": round(count / (t3 - t2)),
+    }
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description="Encode/decode Clash of Clans CopyArmy links")
+    parser.add_argument("links", nargs="*", help="要解码的链接（或 army= 参数），输出导出接口形状的 JSON")
+    parser.add_argument("--encode", default=None, help="把 JSON 文件（导出接口同格式的军队数组）中的军队编码为链接，每行一个")
+    parser.add_argument("--self-test", action="store_true", help="用示例链接做解码与往返一致性检查")
+    parser.add_argument("--bench", type=int, default=0, help="用 N 个随机军队（冷缓存）测编码与解码的每秒条数")
+    args = parser.parse_args(argv)
+
+    if args.self_test:
+        failures = self_test()
+        for failure in failures:
+            print(f"FAIL: {failure}", file=sys.stderr)
+        print(f"Self-test {'failed' if failures else 'passed'} ({len(SELF_TEST_LINKS)} links)")
+        if failures:
+            return 1
+    if args.bench:
+        print(json.dumps(_bench(args.bench)))
+    if args.encode:
+        with open(args.encode, "r", encoding="utf-8") as f:
+            for link in encode_many(json.load(f)):
+                print(link)
+    try:
+        for army in decode_many(args.links):
+            print(json.dumps(army, ensure_ascii=False))
+    except CopyLinkError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
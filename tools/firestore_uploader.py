@@ -1,39 +1,443 @@
 import argparse
+import bisect
+import codecs
+import gzip
+import hashlib
+import http.client
+import itertools
 import logging
 import json
+import multiprocessing
+import os
+import queue
+import random
+import sqlite3
 import sys
+import threading
 import time
 import urllib.request
 import urllib.parse
 import traceback
-from typing import Any, Dict, List, Optional, Tuple
+import zlib
+from array import array
+from collections import deque
+from contextlib import ExitStack, contextmanager
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from typing import Any, BinaryIO, Callable, Deque, Dict, Iterable, Iterator, List, Optional, Tuple
 from datetime import datetime, timezone
 
-import firebase_admin
-from firebase_admin import credentials, firestore
+import copy_link
+from army_indexes import ArmyIndexes
+from columnar_snapshot import ColumnarSnapshot
+from copy_link import HERO_CLASH_IDS, group_assets_by_hero
+from local_firestore import LocalFirestore, NotFoundError, TransientWriteError
+from mariadb_source import MariaDBSource
+from sync_metrics import SyncMetrics
 
+try:
+    import firebase_admin
+    from firebase_admin import credentials, firestore
+    from google.api_core import exceptions as google_exceptions
+except ImportError:
+    # 只用本地后端（--local-db）或 --sink-file 时不需要 firebase_admin
+    firebase_admin = None
+    google_exceptions = None
 
-# 英雄 clashId 映射，需与前端保持一致
-HERO_CLASH_IDS: Dict[str, int] = {
-    "Barbarian King": 0,
-    "Archer Queen": 1,
-    "Grand Warden": 2,
-    "Royal Champion": 4,
-    "Minion Prince": 6,
-}
+try:
+    import brotli
+except ImportError:
+    # 没有 brotli 时只协商 gzip
+    brotli = None
 
+# 请求导出接口时声明可接受的压缩格式
+ACCEPT_ENCODING = "br, gzip" if brotli is not None else "gzip"
 
-def http_get_json(url: str, timeout: int = 30) -> Any:
-    logging.debug(f"HTTP GET {url}")
-    req = urllib.request.Request(url, headers={"Accept": "application/json"})
-    with urllib.request.urlopen(req, timeout=timeout) as resp:
+
+class ExportClient:
+    # 常驻（--watch）模式的导出接口客户端：按 scheme+host 复用 keep-alive 连接，
+    # 并记录每个 URL 的 ETag/Last-Modified，条件请求命中 304 时不下载、不解析
+    # 新取得的校验值先放在 pending，本轮同步成功后 commit() 才生效；失败时 discard()，下一轮重新拉取以便重试失败的批次
+    def __init__(self, timeout: int = 30) -> None:
+        self.timeout = timeout
+        self.requests = 0
+        self.connections = 0
+        self.not_modified = False
+        self.not_modified_count = 0
+        self._conns: Dict[Tuple[str, str], http.client.HTTPConnection] = {}
+        self._validators: Dict[str, Dict[str, str]] = {}
+        self._pending: Dict[str, Dict[str, str]] = {}
+
+    def _connection(self, key: Tuple[str, str]) -> http.client.HTTPConnection:
+        conn = self._conns.get(key)
+        if conn is None:
+            scheme, netloc = key
+            conn_cls = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+            conn = self._conns[key] = conn_cls(netloc, timeout=self.timeout)
+        return conn
+
+    def _drop(self, key: Tuple[str, str]) -> None:
+        conn = self._conns.pop(key, None)
+        if conn is not None:
+            conn.close()
+
+    def _send(self, key: Tuple[str, str], path: str, headers: Dict[str, str]) -> http.client.HTTPResponse:
+        for attempt in range(2):
+            conn = self._connection(key)
+            if conn.sock is None:
+                self.connections += 1
+            try:
+                conn.request("GET", path, headers=headers)
+                return conn.getresponse()
+            except (http.client.RemoteDisconnected, http.client.CannotSendRequest, ConnectionResetError, BrokenPipeError):
+                # 服务端已关闭空闲的 keep-alive 连接：重新连接后重发一次（GET 是幂等的）
+                self._drop(key)
+                if attempt:
+                    raise
+        raise AssertionError("unreachable")
+
+    @contextmanager
+    def get(self, url: str, conditional: bool = False) -> Iterator[Optional[http.client.HTTPResponse]]:
+        # 返回可流式读取的响应；conditional=True 且该 URL 有校验值时发送条件请求，304 时返回 None
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = urllib.parse.urlunsplit(("", "", parts.path or "/", parts.query, ""))
+        headers = {"Accept": "application/json", "Accept-Encoding": ACCEPT_ENCODING}
+        validators = self._validators.get(url) if conditional else None
+        if validators:
+            if "etag" in validators:
+                headers["If-None-Match"] = validators["etag"]
+            if "last-modified" in validators:
+                headers["If-Modified-Since"] = validators["last-modified"]
+        self.requests += 1
+        self.not_modified = False
+        resp = self._send(key, path, headers)
+        if resp.status == 304:
+            resp.read()
+            self.not_modified = True
+            self.not_modified_count += 1
+            logging.debug(f"Export not modified: {url}")
+            yield None
+            return
         if resp.status != 200:
+            resp.read()
             raise RuntimeError(f"GET {url} failed with status {resp.status}")
-        raw = resp.read().decode("utf-8")
+        complete = False
+        try:
+            yield resp
+            # 读完剩余字节（如数组后的换行），连接才能复用
+            resp.read()
+            complete = True
+        finally:
+            if not complete:
+                # 提前中止时响应体没有读完，该连接不能再发下一个请求
+                self._drop(key)
+        if conditional:
+            received = {name: resp.headers[name] for name in ("etag", "last-modified") if resp.headers.get(name)}
+            if received:
+                self._pending[url] = received
+
+    def commit(self) -> None:
+        self._validators.update(self._pending)
+        self._pending.clear()
+
+    def discard(self) -> None:
+        self._pending.clear()
+
+    def close(self) -> None:
+        for key in list(self._conns):
+            self._drop(key)
+
+
+class _ContentDecoder:
+    # 按 Content-Encoding 增量解压响应体，对下游表现为普通二进制流；wire_bytes 统计实际传输（压缩后）的字节数
+    def __init__(self, stream: BinaryIO, encoding: str) -> None:
+        self.stream = stream
+        self.encoding = encoding
+        self.wire_bytes = 0
+        self._buf = bytearray()
+        self._eof = False
+        self._decompress: Optional[Callable[[bytes], bytes]] = None
+        self._flush: Callable[[], bytes] = bytes
+        if encoding == "gzip":
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            self._decompress, self._flush = decompressor.decompress, decompressor.flush
+        elif encoding == "deflate":
+            decompressor = zlib.decompressobj()
+            self._decompress, self._flush = decompressor.decompress, decompressor.flush
+        elif encoding == "br":
+            if brotli is None:
+                raise RuntimeError("Export is brotli-compressed but the brotli module is not installed")
+            self._decompress = brotli.Decompressor().process
+        elif encoding != "identity":
+            raise RuntimeError(f"Unsupported Content-Encoding: {encoding}")
+
+    def read(self, size: int = -1) -> bytes:
+        if self._decompress is None:
+            chunk = self.stream.read(size)
+            self.wire_bytes += len(chunk)
+            return chunk
+        while not self._eof and (size < 0 or len(self._buf) < size):
+            # 压缩比通常在 10 倍左右，按请求大小的一部分读取压缩数据
+            chunk = self.stream.read(max(size // 4, 16 * 1024) if size > 0 else 64 * 1024)
+            if not chunk:
+                self._buf += self._flush()
+                self._eof = True
+                break
+            self.wire_bytes += len(chunk)
+            self._buf += self._decompress(chunk)
+        if size < 0 or size >= len(self._buf):
+            out = bytes(self._buf)
+            self._buf.clear()
+        else:
+            out = bytes(self._buf[:size])
+            del self._buf[:size]
+        return out
+
+
+@contextmanager
+def open_export_url(
+    url: str,
+    timeout: int = 30,
+    client: Optional[ExportClient] = None,
+    conditional: bool = False,
+    metrics: Optional[SyncMetrics] = None,
+) -> Iterator[Optional[BinaryIO]]:
+    # 有 client 时走 keep-alive 连接（可能返回 None 表示 304），否则每次请求新建连接；响应体按 Content-Encoding 透明解压
+    with ExitStack() as stack:
+        if client is not None:
+            resp = stack.enter_context(client.get(url, conditional=conditional))
+            if resp is None:
+                yield None
+                return
+        else:
+            req = urllib.request.Request(url, headers={"Accept": "application/json", "Accept-Encoding": ACCEPT_ENCODING})
+            resp = stack.enter_context(urllib.request.urlopen(req, timeout=timeout))
+            if resp.status != 200:
+                raise RuntimeError(f"GET {url} failed with status {resp.status}")
+        body = _ContentDecoder(resp, (resp.headers.get("Content-Encoding") or "identity").strip().lower())
+        try:
+            yield body
+        finally:
+            if metrics is not None:
+                metrics.inc("bytes_transferred", body.wire_bytes)
+
+
+def http_get_json(
+    url: str,
+    timeout: int = 30,
+    metrics: Optional[SyncMetrics] = None,
+    client: Optional[ExportClient] = None,
+    conditional: bool = False,
+) -> Any:
+    # 条件请求命中 304 时返回 None
+    logging.debug(f"HTTP GET {url}")
+    t0 = time.perf_counter()
+    with open_export_url(url, timeout, client, conditional, metrics) as resp:
+        if resp is None:
+            return None
+        body = resp.read()
+    t1 = time.perf_counter()
+    raw = body.decode("utf-8")
+    try:
+        return json.loads(raw)
+    except json.JSONDecodeError:
+        raise RuntimeError(f"Invalid JSON from {url}: {raw[:200]}")
+    finally:
+        if metrics is not None:
+            metrics.observe("fetch", t1 - t0)
+            metrics.observe("parse", time.perf_counter() - t1)
+            metrics.inc("bytes_downloaded", len(body))
+            metrics.inc("export_pages")
+
+
+def iter_json_array(stream: BinaryIO, chunk_size: int = 64 * 1024) -> Iterator[Any]:
+    # 增量解析顶层 JSON 数组：每解析出一个元素就立即 yield，内存只保留当前未消费的缓冲区
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    buf = ""
+    pos = 0
+    eof = False
+
+    def fill() -> bool:
+        nonlocal buf, pos, eof
+        if eof:
+            return False
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            eof = True
+            buf = buf[pos:] + utf8.decode(b"", final=True)
+        else:
+            buf = buf[pos:] + utf8.decode(chunk)
+        pos = 0
+        return True
+
+    def skip(chars: str) -> Optional[str]:
+        # 跳过空白（及分隔符），返回下一个有效字符；数据不足时继续读取
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in chars:
+                pos += 1
+            if pos < len(buf):
+                return buf[pos]
+            if not fill():
+                return None
+
+    ws = " \t\r\n"
+    if skip(ws) != "[":
+        raise ValueError("Expected a top-level JSON array")
+    pos += 1
+    if skip(ws) == "]":
+        return
+    while True:
+        if skip(ws) is None:
+            raise ValueError("Unexpected end of JSON array")
+        while True:
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                # 元素跨越了数据块边界，读入更多数据后重试
+                if not fill():
+                    raise
+                continue
+            # 数字可能恰好在数据块边界被截断（如 "4" 之后还有 ".5"），确认后再提交
+            if (end == len(buf) or buf[end] in "0123456789.eE+-") and fill():
+                continue
+            break
+        pos = end
+        yield item
+        ch = skip(ws)
+        if ch == ",":
+            pos += 1
+        elif ch == "]":
+            return
+        elif ch is None:
+            raise ValueError("Unexpected end of JSON array")
+        else:
+            raise ValueError(f"Expected ',' or ']' in JSON array, got {ch!r}")
+
+
+class _TimedReader:
+    # 包装二进制流：累计 read() 的耗时与字节数，用于区分网络等待与解析耗时
+    def __init__(self, stream: BinaryIO) -> None:
+        self.stream = stream
+        self.seconds = 0.0
+        self.bytes = 0
+
+    def read(self, size: int = -1) -> bytes:
+        t0 = time.perf_counter()
+        chunk = self.stream.read(size)
+        self.seconds += time.perf_counter() - t0
+        self.bytes += len(chunk)
+        return chunk
+
+
+def iter_json_array_timed(
+    stream: BinaryIO,
+    metrics: Optional[SyncMetrics] = None,
+    open_seconds: float = 0.0,
+) -> Iterator[Any]:
+    # iter_json_array + 指标：fetch = 建立连接 + 读取耗时，parse = 其余解码耗时，整页结束时各记一次
+    if metrics is None:
+        yield from iter_json_array(stream)
+        return
+    reader = _TimedReader(stream)
+    items = iter_json_array(reader)
+    parse_seconds = 0.0
+    try:
+        while True:
+            t0 = time.perf_counter()
+            read_before = reader.seconds
+            try:
+                item = next(items)
+            except StopIteration:
+                break
+            finally:
+                parse_seconds += time.perf_counter() - t0 - (reader.seconds - read_before)
+            yield item
+    finally:
+        metrics.observe("fetch", open_seconds + reader.seconds)
+        metrics.observe("parse", parse_seconds)
+        metrics.inc("bytes_downloaded", reader.bytes)
+        metrics.inc("export_pages")
+
+
+def http_iter_json_array(
+    url: str,
+    timeout: int = 30,
+    metrics: Optional[SyncMetrics] = None,
+    client: Optional[ExportClient] = None,
+    conditional: bool = False,
+) -> Iterator[Any]:
+    # 流式读取导出接口：边下载边解析，下游可以在下载完成前开始处理；条件请求命中 304 时不产出任何元素
+    logging.debug(f"HTTP GET (stream) {url}")
+    t0 = time.perf_counter()
+    with open_export_url(url, timeout, client, conditional, metrics) as resp:
+        if resp is None:
+            return
         try:
-            return json.loads(raw)
-        except json.JSONDecodeError:
-            raise RuntimeError(f"Invalid JSON from {url}: {raw[:200]}")
+            yield from iter_json_array_timed(resp, metrics, open_seconds=time.perf_counter() - t0)
+        except ValueError as e:
+            raise RuntimeError(f"Invalid JSON from {url}: {e}")
+
+
+def iter_export_pages(
+    export_url: str,
+    since_iso: Optional[str] = None,
+    after_id: Optional[int] = None,
+    page_size: int = 1000,
+    stream: bool = True,
+    metrics: Optional[SyncMetrics] = None,
+    fields: Optional[str] = None,
+    client: Optional[ExportClient] = None,
+) -> Iterator[Any]:
+    # 按 (updatedTime, id) 游标分页拉取导出接口，下一页游标取上一页最后一条记录
+    # fields="metrics"/"ids" 时导出接口只返回 id（+ 计数器），按 id 升序翻页（游标只有 afterId）
+    # 传入 client 时第一页发送条件请求：ETag 覆盖整个导出集，第一页 304 即表示没有任何变化，直接结束
+    by_id = fields in ("metrics", "ids")
+    first_page = True
+    while True:
+        params: Dict[str, Any] = {}
+        if page_size > 0:
+            params["limit"] = page_size
+        if fields:
+            params["fields"] = fields
+        if by_id:
+            if after_id is not None:
+                params["afterId"] = after_id
+        elif since_iso:
+            params["since"] = since_iso
+            if after_id is not None:
+                params["afterId"] = after_id
+        url = export_url + ("?" + urllib.parse.urlencode(params) if params else "")
+        conditional, first_page = first_page, False
+        if stream:
+            page: Iterable[Any] = http_iter_json_array(url, metrics=metrics, client=client, conditional=conditional)
+        else:
+            page = http_get_json(url, metrics=metrics, client=client, conditional=conditional)
+            if page is None:
+                return
+            if not isinstance(page, list):
+                raise RuntimeError("Exported armies JSON is not a list")
+
+        count = 0
+        last: Any = None
+        for army in page:
+            count += 1
+            last = army
+            yield army
+
+        if page_size <= 0 or count < page_size:
+            return
+        if count > page_size:
+            logging.warning(f"Export endpoint returned {count} armies for limit={page_size}; assuming it does not support paging")
+            return
+        next_since = None if by_id else (last.get('updatedTime') or last.get('createdTime'))
+        next_id = int(last.get('id', -1))
+        if (not by_id and not next_since) or (next_since, next_id) == (since_iso, after_id):
+            logging.warning(f"Export cursor did not advance at since={since_iso} afterId={after_id}; stopping")
+            return
+        since_iso, after_id = next_since, next_id
+        logging.debug(f"Next export page: since={since_iso} afterId={after_id}")
 
 
 def unit_icon_name(unit_name: str) -> str:
@@ -56,24 +460,54 @@ def equipment_icon_name(equipment_name: str) -> str:
     return f"heroes/equipment/{equipment_name}_small.webp"
 
 
-def build_heroes_from_assets(pets: List[Dict[str, Any]], equipment: List[Dict[str, Any]]):
-    # 根据宠物和装备推导使用到的英雄集合，并组合每个英雄的宠物和最多两件装备
-    by_hero: Dict[str, Dict[str, Any]] = {}
-    for eq in equipment or []:
-        hero = eq.get("hero")
-        if not hero:
-            continue
-        h = by_hero.setdefault(hero, {})
-        h.setdefault("equipment", []).append(eq)
+class IconAtlas:
+    # build_assets.py 生成的图集索引（atlases/index.json）：按名称（或名称缺失时按 type + clashId）查找图标在图集中的位置
+    # 引用形如 {"sheet": "atlases/units.webp?v=内容哈希", "x", "y", "w", "h"}；图集更新后 v 变化，文档哈希随之变化会被重写
+    def __init__(self, index: Dict[str, Any]) -> None:
+        self._refs: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self._names: Dict[Tuple[str, str], str] = {}
+        for atlas_name, atlas in (index.get("atlases") or {}).items():
+            sheet = f"{atlas.get('image')}?v={atlas.get('hash', '')}"
+            for sprite, rect in (atlas.get("sprites") or {}).items():
+                self._refs[(atlas_name, sprite)] = {"sheet": sheet, "x": rect["x"], "y": rect["y"], "w": rect["w"], "h": rect["h"]}
+            for kind, ids in (atlas.get("clashIds") or {}).items():
+                for clash_id, sprite in ids.items():
+                    self._names[(kind, clash_id)] = sprite
 
-    for p in pets or []:
-        hero = p.get("hero")
-        if not hero:
-            continue
-        h = by_hero.setdefault(hero, {})
-        # 只取一个宠物（与前端生成逻辑一致）
-        if "pet" not in h:
-            h["pet"] = p
+    @classmethod
+    def load(cls, path: str) -> "IconAtlas":
+        with open(path, "r", encoding="utf-8") as f:
+            return cls(json.load(f))
+
+    def __len__(self) -> int:
+        return len(self._refs)
+
+    def ref(self, atlas_name: str, kind: str, name: Optional[str], clash_id: Any) -> Optional[Dict[str, Any]]:
+        found = self._refs.get((atlas_name, name)) if name else None
+        if found is None and clash_id is not None:
+            sprite = self._names.get((kind, str(clash_id)))
+            found = self._refs.get((atlas_name, sprite)) if sprite else None
+        return dict(found) if found is not None else None
+
+
+def _icon(icon_atlas: Optional[IconAtlas], atlas_name: str, kind: str, item: Dict[str, Any], path: str) -> Any:
+    # 传入图集时输出图集引用，图集中没有的图标仍输出单个文件路径
+    if icon_atlas is not None:
+        found = icon_atlas.ref(atlas_name, kind, item.get("name"), item.get("clashId"))
+        if found is not None:
+            return found
+    return path
+
+
+def build_heroes_from_assets(
+    pets: List[Dict[str, Any]],
+    equipment: List[Dict[str, Any]],
+    by_hero: Optional[Dict[str, Dict[str, Any]]] = None,
+    icon_atlas: Optional[IconAtlas] = None,
+):
+    # 组合每个英雄的宠物和最多两件装备；by_hero 可由调用方预先分组后传入，避免重复计算
+    if by_hero is None:
+        by_hero = group_assets_by_hero(pets, equipment)
 
     result: List[Dict[str, Any]] = []
     for hero_name, data in by_hero.items():
@@ -86,7 +520,7 @@ def build_heroes_from_assets(pets: List[Dict[str, Any]], equipment: List[Dict[st
             entry["pet"] = {
                 "name": data["pet"].get("name"),
                 "clashId": data["pet"].get("clashId"),
-                "icon": pet_icon_name(data["pet"].get("name")),
+                "icon": _icon(icon_atlas, "pets", "Pet", data["pet"], pet_icon_name(data["pet"].get("name"))),
             }
         eq_list = data.get("equipment") or []
         if eq_list:
@@ -95,7 +529,7 @@ def build_heroes_from_assets(pets: List[Dict[str, Any]], equipment: List[Dict[st
                 {
                     "name": e.get("name"),
                     "clashId": e.get("clashId"),
-                    "icon": equipment_icon_name(e.get("name")),
+                    "icon": _icon(icon_atlas, "equipment", "Equipment", e, equipment_icon_name(e.get("name"))),
                 }
                 for e in eq_list[:2]
             ]
@@ -103,7 +537,7 @@ def build_heroes_from_assets(pets: List[Dict[str, Any]], equipment: List[Dict[st
     return result
 
 
-def split_units(army_units: List[Dict[str, Any]]):
+def split_units(army_units: List[Dict[str, Any]], icon_atlas: Optional[IconAtlas] = None):
     camp = {"troops": [], "spells": [], "siges": [], "sieges": []}
     cc = {"troops": [], "spells": [], "siges": [], "sieges": []}
 
@@ -113,7 +547,7 @@ def split_units(army_units: List[Dict[str, Any]]):
             "type": u.get("type"),
             "amount": u.get("amount"),
             "clashId": u.get("clashId"),
-            "icon": unit_icon_name(u.get("name")),
+            "icon": _icon(icon_atlas, "units", u.get("type"), u, unit_icon_name(u.get("name"))),
         }
 
     for u in army_units or []:
@@ -129,74 +563,31 @@ def split_units(army_units: List[Dict[str, Any]]):
     return camp, cc
 
 
-def generate_copy_link(army: Dict[str, Any]) -> str:
-    # 复刻前端 generateLink 逻辑
-    def build_units_str(units: List[Dict[str, Any]]) -> str:
-        parts = [f"{int(u.get('amount', 0))}x{int(u.get('clashId'))}" for u in units if u.get("clashId") is not None]
-        return "-".join(parts)
+def generate_copy_link(army: Dict[str, Any], by_hero: Optional[Dict[str, Dict[str, Any]]] = None) -> str:
+    # 复刻前端 generateLink 逻辑，编码实现见 copy_link.py；by_hero 为调用方已分好组的英雄（可复用）
+    return copy_link.encode(army, by_hero)
 
-    # 构建英雄段：从 equipment/pets 推导
-    pets: List[Dict[str, Any]] = army.get("pets") or []
-    equipment: List[Dict[str, Any]] = army.get("equipment") or []
-    by_hero: Dict[str, Dict[str, Any]] = {}
-    for eq in equipment:
-        hero = eq.get("hero")
-        if not hero:
-            continue
-        h = by_hero.setdefault(hero, {})
-        h.setdefault("eq", []).append(eq)
-    for p in pets:
-        hero = p.get("hero")
-        if not hero:
-            continue
-        h = by_hero.setdefault(hero, {})
-        if "pet" not in h:
-            h["pet"] = p
-
-    heroes_segment = ""
-    if by_hero:
-        hero_parts: List[str] = []
-        for hero_name, data in by_hero.items():
-            base = str(HERO_CLASH_IDS.get(hero_name))
-            if not base or base == "None":
-                continue
-            if data.get("pet") and data["pet"].get("clashId") is not None:
-                base += f"p{int(data['pet']['clashId'])}"
-            eqs = data.get("eq") or []
-            if eqs:
-                base += f"e{int(eqs[0].get('clashId'))}"
-                if len(eqs) > 1 and eqs[1].get("clashId") is not None:
-                    base += f"_{int(eqs[1]['clashId'])}"
-            hero_parts.append(base)
-        if hero_parts:
-            heroes_segment = "h" + "-".join(hero_parts)
-
-    # 分桶部队
-    units: List[Dict[str, Any]] = army.get("units") or []
-    cc_troops = [u for u in units if u.get("home") == "clanCastle" and u.get("type") in ("Troop", "Siege")]
-    cc_spells = [u for u in units if u.get("home") == "clanCastle" and u.get("type") == "Spell"]
-    camp_troops = [u for u in units if u.get("home") == "armyCamp" and u.get("type") in ("Troop", "Siege")]
-    camp_spells = [u for u in units if u.get("home") == "armyCamp" and u.get("type") == "Spell"]
-
-    parts: List[str] = []
-    if heroes_segment:
-        parts.append(heroes_segment)
-    if cc_troops:
-        parts.append("i" + build_units_str(cc_troops))
-    if cc_spells:
-        parts.append("d" + build_units_str(cc_spells))
-    if camp_troops:
-        parts.append("u" + build_units_str(camp_troops))
-    if camp_spells:
-        parts.append("s" + build_units_str(camp_spells))
-
-    return "https://link.clashofclans.com/?action=CopyArmy&army=" + "".join(parts)
-
-
-def transform_army(army: Dict[str, Any]) -> Dict[str, Any]:
-    camp, cc = split_units(army.get("units") or [])
-    heroes = build_heroes_from_assets(army.get("pets") or [], army.get("equipment") or [])
-    copy_link = generate_copy_link(army)
+
+def army_metrics(army: Dict[str, Any]) -> Dict[str, Any]:
+    # 计数器字段：完整导出与 ?fields=metrics 导出中的字段名相同
+    return {
+        "score": army.get("score") or 0,
+        "votes": army.get("votes") or 0,
+        "pageViews": army.get("pageViews") or 0,
+        "openLinkClicks": army.get("openLinkClicks") or 0,
+        "copyLinkClicks": army.get("copyLinkClicks") or 0,
+    }
+
+
+def transform_army(army: Dict[str, Any], icon_atlas: Optional[IconAtlas] = None) -> Dict[str, Any]:
+    # icon_atlas 传入时部队/宠物/装备图标输出图集引用（--icon-atlas），否则为单个文件路径
+    camp, cc = split_units(army.get("units") or [], icon_atlas)
+    pets = army.get("pets") or []
+    equipment = army.get("equipment") or []
+    # 英雄分组只算一次，英雄卡片与复制链接共用
+    by_hero = group_assets_by_hero(pets, equipment)
+    heroes = build_heroes_from_assets(pets, equipment, by_hero, icon_atlas=icon_atlas)
+    link = generate_copy_link(army, by_hero)
 
     doc: Dict[str, Any] = {
         "id": army.get("id"),
@@ -207,19 +598,13 @@ def transform_army(army: Dict[str, Any]) -> Dict[str, Any]:
         "createdByUsername": army.get("username"),
         "createdTime": army.get("createdTime"),
         "updatedTime": army.get("updatedTime"),
-        "metrics": {
-            "score": army.get("score") or 0,
-            "votes": army.get("votes") or 0,
-            "pageViews": army.get("pageViews") or 0,
-            "openLinkClicks": army.get("openLinkClicks") or 0,
-            "copyLinkClicks": army.get("copyLinkClicks") or 0,
-        },
+        "metrics": army_metrics(army),
         "composition": {
             "armyCamp": camp,
             "clanCastle": cc,
             "heroes": heroes,
         },
-        "copyLink": copy_link,
+        "copyLink": link,
     }
     return doc
 
@@ -230,43 +615,436 @@ def _parse_dt(value: Optional[str]) -> Optional[float]:
     # 返回 epoch 秒（float），便于比较
     try:
         # 兼容带 'Z' 的 ISO 字符串
-        if isinstance(value, str) and value.endswith('Z'):
-            value = value.replace('Z', '+00:00')
-        from datetime import datetime
-        dt = datetime.fromisoformat(value)  # 支持 'YYYY-MM-DDTHH:MM:SS.sss+00:00'
-        return dt.timestamp()
+        if value.endswith('Z'):
+            value = value[:-1] + '+00:00'
+        return datetime.fromisoformat(value).timestamp()  # 支持 'YYYY-MM-DDTHH:MM:SS.sss+00:00'
     except Exception:
         logging.debug(f"Failed to parse datetime: {value}")
         return None
 
 
-def _filter_armies_since(armies: List[Dict[str, Any]], since_iso: Optional[str]) -> List[Dict[str, Any]]:
+class ArmyRecord:
+    # 导出军队的紧凑记录：入口处一次性解析时间与 id，过滤/水位线/marker 计算都直接比较数值
+    __slots__ = ("id", "ts", "iso", "army")
+
+    def __init__(self, army: Dict[str, Any]) -> None:
+        self.army = army
+        self.id = int(army.get('id', -1))
+        self.iso: Optional[str] = army.get('updatedTime') or army.get('createdTime')
+        self.ts = _parse_dt(self.iso)
+
+
+def _filter_armies_since(
+    records: Iterable[ArmyRecord],
+    since_iso: Optional[str],
+    after_id: Optional[int] = None,
+) -> Iterator[ArmyRecord]:
+    # 单次遍历：时间 > since 的保留；时间恰好等于 since 的，若给了 after_id 则只保留 id 更大的
     if not since_iso:
-        return armies
+        yield from records
+        return
     since_ts = _parse_dt(since_iso)
     if since_ts is None:
         logging.warning(f"--since provided but unparsable: {since_iso}, ignoring filter.")
-        return armies
-    filtered: List[Dict[str, Any]] = []
-    for a in armies:
-        ts = _parse_dt(a.get('updatedTime')) or _parse_dt(a.get('createdTime'))
-        if ts is None:
+        yield from records
+        return
+    for r in records:
+        ts = r.ts
+        if ts is None or ts < since_ts:
             continue
-        if ts >= since_ts:
-            filtered.append(a)
-    return filtered
+        if ts == since_ts and after_id is not None and r.id <= after_id:
+            continue
+        yield r
+
+
+class _WatermarkTracker:
+    # 流式累计水位线：最大时间，以及该时间下的最大 id（作为下次增量的游标）
+    def __init__(self) -> None:
+        self.max_ts = -1.0
+        self.max_iso: Optional[str] = None
+        self.max_id = -1
+
+    def observe(self, record: ArmyRecord) -> None:
+        ts = record.ts
+        if ts is None:
+            return
+        if ts > self.max_ts:
+            self.max_ts = ts
+            self.max_iso = record.iso
+            self.max_id = record.id
+        elif ts == self.max_ts and record.id > self.max_id:
+            self.max_id = record.id
+
+
+# 配额/争用类错误：退避后重试同一批次
+RETRYABLE_COMMIT_ERRORS: Tuple[type, ...] = (TransientWriteError,)
+if google_exceptions is not None:
+    RETRYABLE_COMMIT_ERRORS += (
+        google_exceptions.ResourceExhausted,
+        google_exceptions.Aborted,
+        google_exceptions.DeadlineExceeded,
+        google_exceptions.ServiceUnavailable,
+        google_exceptions.InternalServerError,
+    )
+
+
+# 文档不存在（update 不会创建文档）
+NOT_FOUND_ERRORS: Tuple[type, ...] = (NotFoundError,)
+if google_exceptions is not None:
+    NOT_FOUND_ERRORS += (google_exceptions.NotFound,)
+
+
+# 批次中的一个写操作：("set", ref, 完整文档) 以 merge 方式写入；("update", ref, {"metrics.score": ...}) 只改指定字段；("delete", ref, {}) 删除文档
+Write = Tuple[str, Any, Dict[str, Any]]
 
 
-def _max_updated_iso(armies: List[Dict[str, Any]]) -> Optional[str]:
-    max_ts = -1.0
-    max_iso = None
-    for a in armies:
-        for k in ('updatedTime', 'createdTime'):
-            ts = _parse_dt(a.get(k))
-            if ts is not None and ts > max_ts:
-                max_ts = ts
-                max_iso = a.get(k)
-    return max_iso
+class BatchCommitter:
+    # 并发提交 Firestore 批次：最多 max_in_flight 个批次同时在线程池中提交，主线程继续转换下一批
+    def __init__(
+        self,
+        db: Any,
+        max_in_flight: int = 4,
+        max_retries: int = 6,
+        base_delay: float = 0.5,
+        max_delay: float = 32.0,
+        metrics: Optional[SyncMetrics] = None,
+    ) -> None:
+        self.db = db
+        self.metrics = metrics
+        self.max_in_flight = max(1, max_in_flight)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.committed = 0
+        self.failed = 0
+        self.failed_batches = 0
+        self._pool = ThreadPoolExecutor(max_workers=self.max_in_flight, thread_name_prefix="commit")
+        self._pending: Deque[Tuple[Future, List[Write], Optional[Callable[[bool], None]]]] = deque()
+
+    def submit(self, writes: List[Write], on_done: Optional[Callable[[bool], None]] = None) -> None:
+        # 在线批次已满时阻塞等待，形成背压；等待时间计入 commit_wait，持续偏高说明瓶颈在 Firestore
+        t0 = time.perf_counter()
+        while len(self._pending) >= self.max_in_flight:
+            self._reap(block=True)
+        if self.metrics is not None:
+            self.metrics.observe("commit_wait", time.perf_counter() - t0)
+        future = self._pool.submit(self._commit_with_retry, writes)
+        self._pending.append((future, writes, on_done))
+        self._reap(block=False)
+
+    def close(self) -> None:
+        while self._pending:
+            self._reap(block=True)
+        self._pool.shutdown(wait=True)
+
+    def _commit_with_retry(self, writes: List[Write]) -> int:
+        attempt = 0
+        while True:
+            # 每次重试重新构建 batch，避免复用已提交失败的 WriteBatch
+            batch = self.db.batch()
+            for op, ref, data in writes:
+                if op == "update":
+                    batch.update(ref, data)
+                elif op == "delete":
+                    batch.delete(ref)
+                else:
+                    batch.set(ref, data, merge=True)
+            t0 = time.perf_counter()
+            try:
+                batch.commit()
+                return attempt
+            except RETRYABLE_COMMIT_ERRORS as e:
+                if attempt >= self.max_retries:
+                    raise
+                # 指数退避 + 抖动，避免并发批次同时重试
+                delay = min(self.max_delay, self.base_delay * (2 ** attempt)) * random.uniform(0.5, 1.0)
+                attempt += 1
+                logging.warning(f"Batch commit of {len(writes)} documents hit {type(e).__name__}, retry {attempt}/{self.max_retries} in {delay:.2f}s")
+                if self.metrics is not None:
+                    self.metrics.inc("commit_retries")
+            finally:
+                # 只记录提交请求本身的耗时，不含退避等待
+                if self.metrics is not None:
+                    self.metrics.observe("commit", time.perf_counter() - t0)
+            time.sleep(delay)
+
+    def _reap(self, block: bool) -> None:
+        if not self._pending:
+            return
+        if block:
+            wait([f for f, _, _ in self._pending], return_when=FIRST_COMPLETED)
+        still_pending: Deque[Tuple[Future, List[Write], Optional[Callable[[bool], None]]]] = deque()
+        for future, writes, on_done in self._pending:
+            if not future.done():
+                still_pending.append((future, writes, on_done))
+                continue
+            try:
+                retries = future.result()
+                self.committed += len(writes)
+                logging.info(f"Committed a batch of {len(writes)} documents (retries: {retries}, committed so far: {self.committed})")
+                ok = True
+            except Exception as e:
+                self.failed += len(writes)
+                self.failed_batches += 1
+                logging.error(f"Batch commit of {len(writes)} documents failed: {e}")
+                logging.debug("".join(traceback.format_exception(type(e), e, e.__traceback__)))
+                ok = False
+            if on_done:
+                on_done(ok)
+        self._pending = still_pending
+
+
+def _drop_not_newer(db: Any, writes: List[Tuple[ArmyRecord, Any, Dict[str, Any]]]) -> List[Tuple[ArmyRecord, Any, Dict[str, Any]]]:
+    # 批量读取整块文档已有的 updatedTime（只取该字段），一次往返代替逐条 ref.get()
+    try:
+        existing: Dict[str, Any] = {}
+        for snap in db.get_all([ref for _, ref, _ in writes], field_paths=["updatedTime"]):
+            if snap.exists:
+                existing[snap.id] = (snap.to_dict() or {}).get("updatedTime")
+    except Exception as e:
+        logging.warning(f"Check skip_not_newer failed for a chunk of {len(writes)} documents, writing all of them: {e}")
+        logging.debug(traceback.format_exc())
+        return writes
+
+    kept: List[Tuple[ArmyRecord, Any, Dict[str, Any]]] = []
+    for record, ref, doc in writes:
+        exist_updated = existing.get(ref.id)
+        if exist_updated and record.ts is not None:
+            # 新值的时间在 ArmyRecord 中已解析过，这里只需解析 Firestore 侧的值
+            if (_parse_dt(exist_updated) or 0) >= record.ts:
+                logging.debug(f"Skip not newer id={ref.id} exist={exist_updated} new={record.iso}")
+                continue
+        kept.append((record, ref, doc))
+    return kept
+
+
+def _stable_hash(value: Any) -> str:
+    # 稳定哈希：键排序后的紧凑 JSON，字段顺序变化不影响结果
+    payload = json.dumps(value, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.blake2b(payload.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def doc_hash(doc: Dict[str, Any]) -> str:
+    # 文档内容哈希不含 metrics：计数器变化频繁，单独用 metrics_hash 跟踪，只需字段级更新
+    return _stable_hash({k: v for k, v in doc.items() if k != "metrics"})
+
+
+def metrics_hash(metrics: Optional[Dict[str, Any]]) -> str:
+    return _stable_hash(metrics or {})
+
+
+# 清单格式版本：哈希口径变化时递增，旧清单会被清空（下次同步重写一遍，或用 --rebuild-manifest 从 Firestore 重建）
+MANIFEST_VERSION = 2
+
+
+class SyncManifest:
+    # 本地清单（SQLite）：army id -> 上次成功写入 Firestore 的文档哈希 / 计数器哈希，未变化的部分不再入队
+    # 清单只对一个写入目标（后端 + 集合，见 _sync_target）有效，meta 中记录该目标；目标不符时拒绝复用，
+    # 否则换一个集合或本地库时文档会被当作“未变化”跳过。retarget=True（--rebuild-manifest）时清空并改记新目标
+    def __init__(self, path: str, target: Optional[str] = None, retarget: bool = False) -> None:
+        self.path = path
+        self.target = target
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS docs (id TEXT PRIMARY KEY, hash TEXT NOT NULL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS metrics (id TEXT PRIMARY KEY, hash TEXT NOT NULL)")
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        version = int(row[0]) if row else 1
+        if version != MANIFEST_VERSION:
+            if self.conn.execute("SELECT 1 FROM docs LIMIT 1").fetchone():
+                logging.warning(
+                    f"Manifest {path} has version {version}, expected {MANIFEST_VERSION}; clearing it. "
+                    "The next sync rewrites every document once (or use --rebuild-manifest)."
+                )
+            self.conn.execute("DELETE FROM docs")
+            self.conn.execute("DELETE FROM metrics")
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('version', ?)", (str(MANIFEST_VERSION),))
+        if target:
+            row = self.conn.execute("SELECT value FROM meta WHERE key = 'target'").fetchone()
+            recorded = row[0] if row else None
+            if recorded != target:
+                has_docs = self.conn.execute("SELECT 1 FROM docs LIMIT 1").fetchone() is not None
+                if recorded and has_docs and not retarget:
+                    self.conn.close()
+                    raise RuntimeError(
+                        f"Manifest {path} was recorded for {recorded}, not {target}. "
+                        "Use the default manifest path (one per target), another --manifest, or --rebuild-manifest"
+                    )
+                if recorded and has_docs:
+                    logging.warning(f"Manifest {path} was recorded for {recorded}; clearing it for {target}")
+                    self.conn.execute("DELETE FROM docs")
+                    self.conn.execute("DELETE FROM metrics")
+                elif has_docs:
+                    # 旧版清单没有记录目标：沿用其内容，记为本次的目标
+                    logging.warning(f"Manifest {path} has no recorded target; assuming it belongs to {target}")
+                self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('target', ?)", (target,))
+        self.conn.commit()
+
+    def lookup(self, ids: List[str]) -> Dict[str, Tuple[str, Optional[str]]]:
+        # 返回 {id: (文档哈希, 计数器哈希)}；不在结果中的 id 表示 Firestore 中还没有该文档
+        found: Dict[str, Tuple[str, Optional[str]]] = {}
+        # SQLite 参数个数有上限，分块查询
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            query = f"SELECT d.id, d.hash, m.hash FROM docs d LEFT JOIN metrics m ON m.id = d.id WHERE d.id IN ({placeholders})"
+            for doc_id, h, mh in self.conn.execute(query, chunk):
+                found[doc_id] = (h, mh)
+        return found
+
+    def update(self, docs: List[Tuple[str, str]], metrics: List[Tuple[str, str]]) -> None:
+        self.conn.executemany("INSERT OR REPLACE INTO docs (id, hash) VALUES (?, ?)", docs)
+        self.conn.executemany("INSERT OR REPLACE INTO metrics (id, hash) VALUES (?, ?)", metrics)
+        self.conn.commit()
+
+    def remove(self, ids: List[str]) -> None:
+        self.conn.executemany("DELETE FROM docs WHERE id = ?", [(i,) for i in ids])
+        self.conn.executemany("DELETE FROM metrics WHERE id = ?", [(i,) for i in ids])
+        self.conn.commit()
+
+    def rebuild(self, snapshots: Iterable[Any]) -> int:
+        # 以 Firestore 集合的实际内容重建清单
+        count = 0
+        with self.conn:
+            self.conn.execute("DELETE FROM docs")
+            self.conn.execute("DELETE FROM metrics")
+            for snap in snapshots:
+                doc = snap.to_dict() or {}
+                self.conn.execute("INSERT OR REPLACE INTO docs (id, hash) VALUES (?, ?)", (snap.id, doc_hash(doc)))
+                self.conn.execute("INSERT OR REPLACE INTO metrics (id, hash) VALUES (?, ?)", (snap.id, metrics_hash(doc.get("metrics"))))
+                count += 1
+        return count
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+def _sync_target(db: Any, collection: str) -> str:
+    # 写入目标的标识：Firestore 项目或本地库文件 + 集合名
+    if isinstance(db, LocalFirestore):
+        if db.path == ":memory:":
+            # 内存库每个进程都是新的，标识不与其他进程共用
+            return f"local::memory:@{os.getpid()}.{id(db)}/{collection}"
+        return f"local:{os.path.abspath(db.path)}/{collection}"
+    return f"firestore:{getattr(db, 'project', None) or 'default'}/{collection}"
+
+
+def _default_manifest_path(state_file: Optional[str], target: str) -> str:
+    # 默认放在 state_file 旁边，每个写入目标一个文件：集合名便于辨认，目标哈希区分项目/本地库
+    directory = os.path.dirname(state_file) if state_file else ""
+    name = "".join(c if c.isalnum() or c in "-_" else "_" for c in target.rsplit("/", 1)[-1])[:40]
+    digest = hashlib.sha1(target.encode("utf-8")).hexdigest()[:10]
+    return os.path.join(directory, f".sync_manifest.{name}.{digest}.sqlite")
+
+
+def _open_manifest(db: Any, collection: str, path: Optional[str], state_file: Optional[str], retarget: bool = False) -> SyncManifest:
+    target = _sync_target(db, collection)
+    if path is None:
+        # 内存库的清单同样只放在内存中
+        in_memory = isinstance(db, LocalFirestore) and db.path == ":memory:"
+        path = ":memory:" if in_memory else _default_manifest_path(state_file, target)
+    return SyncManifest(path, target, retarget=retarget)
+
+
+def _default_snapshot_path(state_file: Optional[str]) -> str:
+    directory = os.path.dirname(state_file) if state_file else ""
+    return os.path.join(directory, ".sync_snapshot.json.gz")
+
+
+def _default_index_path(state_file: Optional[str]) -> str:
+    directory = os.path.dirname(state_file) if state_file else ""
+    return os.path.join(directory, ".sync_indexes.sqlite")
+
+
+def _open_indexes(db: Any, collection: str, path: str, top_n: int, rebuild: bool, metrics: SyncMetrics) -> ArmyIndexes:
+    # 本地榜单状态为空（首次启用或删除了状态文件）时先从 Firestore 集合构建，之后只按变化的军队增量更新
+    indexes = ArmyIndexes(path, top_n=top_n)
+    if rebuild or not len(indexes):
+        logging.info(f"Building army indexes {indexes.path} from collection '{collection}'...")
+        with metrics.timer("index_rebuild"):
+            count = indexes.rebuild(snap.to_dict() for snap in db.collection(collection).stream())
+        logging.info(f"Built army indexes from {count} documents")
+    return indexes
+
+
+def _observe_indexes(indexes: Optional[ArmyIndexes], update: Callable[[], Any], on_done: Callable[[bool], None]) -> Callable[[bool], None]:
+    # 批次提交成功后才更新榜单，失败的军队下次同步重写时再计入
+    if indexes is None:
+        return on_done
+
+    def done(ok: bool) -> None:
+        if ok:
+            update()
+        on_done(ok)
+
+    return done
+
+
+def _observe_columnar(
+    columnar: Optional[ColumnarSnapshot], update: Callable[[], Any], on_done: Callable[[bool], None], metrics: SyncMetrics
+) -> Callable[[bool], None]:
+    # 同样只把提交成功的批次记入列式快照；失败的军队在快照中保留旧行，下次同步重写时再更新
+    if columnar is None:
+        return on_done
+
+    def done(ok: bool) -> None:
+        if ok:
+            with metrics.timer("columnar"):
+                update()
+        on_done(ok)
+
+    return done
+
+
+def _close_columnar(columnar: ColumnarSnapshot, ok: bool, metrics: SyncMetrics) -> None:
+    # 把本次的变化与已有快照合并后替换；出错、导出未变化或没有变化时保留上一次的快照
+    with metrics.timer("columnar"):
+        written = columnar.close(ok)
+    if written:
+        logging.info(
+            f"Updated columnar snapshot {columnar.directory} ({columnar.fmt}): {columnar.updated} armies written, "
+            f"{columnar.refreshed} counters refreshed, {columnar.removed} removed; "
+            f"{columnar.armies} armies and {columnar.items} items in total"
+        )
+        metrics.inc("columnar_armies", columnar.armies)
+    elif ok:
+        logging.info(f"Columnar snapshot {columnar.directory} unchanged")
+
+
+def _publish_indexes(
+    db: Any,
+    indexes: ArmyIndexes,
+    collection: str,
+    batch_size: int,
+    concurrency: int,
+    max_retries: int,
+    metrics: SyncMetrics,
+) -> None:
+    # 把内容有变化的榜单文档写入 collection，分组已不存在的删除；写入失败的下次运行重新发布
+    with metrics.timer("index_flush"):
+        writes = indexes.flush()
+    if indexes.refills:
+        metrics.inc("index_refills", indexes.refills)
+    if not writes:
+        logging.info(f"Army indexes in '{collection}' are up to date")
+        return
+    col = db.collection(collection)
+    committer = BatchCommitter(db, max_in_flight=concurrency, max_retries=max_retries, metrics=metrics)
+    try:
+        for start in range(0, len(writes), batch_size):
+            part = writes[start:start + batch_size]
+            ops: List[Write] = [("delete" if doc is None else "set", col.document(key), doc or {}) for key, doc, _ in part]
+
+            def done(ok: bool, part: List[Tuple[str, Optional[Dict[str, Any]], str]] = part) -> None:
+                if ok:
+                    indexes.mark_published(part)
+
+            committer.submit(ops, done)
+    finally:
+        committer.close()
+    metrics.inc("index_docs_written", committer.committed)
+    metrics.inc("index_docs_failed", committer.failed)
+    logging.info(f"Published {committer.committed} army index documents to '{collection}', {committer.failed} failed")
 
 
 def _load_state_since(state_file: Optional[str]) -> Optional[str]:
@@ -274,7 +1052,7 @@ def _load_state_since(state_file: Optional[str]) -> Optional[str]:
         return None
     try:
         with open(state_file, 'r', encoding='utf-8') as f:
-            iso = f.read().strip()
+            iso = f.readline().strip()
             return iso or None
     except FileNotFoundError:
         return None
@@ -283,17 +1061,758 @@ def _load_state_since(state_file: Optional[str]) -> Optional[str]:
         return None
 
 
-def _save_state_since(state_file: Optional[str], iso_value: Optional[str]) -> None:
+def _save_state_since(state_file: Optional[str], iso_value: Optional[str], last_id: Optional[int] = None) -> None:
+    # 第一行为水位线时间，第二行为该时间下的最大 id；先写临时文件再替换，中断时不会留下半个文件
     if not state_file or not iso_value:
         return
+    tmp = f"{state_file}.tmp"
     try:
-        with open(state_file, 'w', encoding='utf-8') as f:
-            f.write(iso_value)
-        logging.info(f"Saved watermark to state file: {state_file} -> {iso_value}")
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(iso_value if last_id is None else f"{iso_value}\n{last_id}\n")
+        os.replace(tmp, state_file)
+        logging.debug(f"Saved watermark to state file: {state_file} -> {iso_value} (id {last_id})")
     except Exception as e:
         logging.warning(f"Failed to write state file '{state_file}': {e}")
 
 
+# ---------------------------------------------------------------------------
+# 流水线：source -> filter -> transform -> batcher -> sink(committer) -> checkpoint
+# 各阶段都是生成器，阶段之间用有界队列连接：下游跟不上时上游阻塞（背压），内存只与队列深度有关
+# ---------------------------------------------------------------------------
+
+_STAGE_END = object()
+
+
+class _StageError:
+    __slots__ = ("error",)
+
+    def __init__(self, error: BaseException) -> None:
+        self.error = error
+
+
+def threaded(items: Iterable[Any], maxsize: int = 256, name: str = "stage") -> Iterator[Any]:
+    # 在后台线程中驱动上游生成器，通过有界队列交给下游
+    q: "queue.Queue[Any]" = queue.Queue(maxsize=max(1, maxsize))
+    stop = threading.Event()
+
+    def put(item: Any) -> bool:
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def run() -> None:
+        it = iter(items)
+        try:
+            for item in it:
+                if not put(item):
+                    break
+            else:
+                put(_STAGE_END)
+        except BaseException as e:
+            put(_StageError(e))
+        finally:
+            close = getattr(it, "close", None)
+            if close:
+                close()
+
+    worker = threading.Thread(target=run, name=name, daemon=True)
+    worker.start()
+    try:
+        while True:
+            item = q.get()
+            if item is _STAGE_END:
+                return
+            if isinstance(item, _StageError):
+                raise item.error
+            yield item
+    finally:
+        # 下游提前结束（或出错）时通知上游停止
+        stop.set()
+        worker.join()
+
+
+def batched(items: Iterable[Any], size: int) -> Iterator[List[Any]]:
+    chunk: List[Any] = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class HttpExportSource:
+    # 数据源：Web 导出接口（分页 + 流式解析）
+    def __init__(
+        self,
+        export_url: str,
+        page_size: int = 1000,
+        stream: bool = True,
+        metrics: Optional[SyncMetrics] = None,
+        fields: Optional[str] = None,
+        client: Optional[ExportClient] = None,
+    ) -> None:
+        self.export_url = export_url
+        self.page_size = page_size
+        self.stream = stream
+        self.metrics = metrics
+        self.fields = fields
+        self.client = client
+
+    def __str__(self) -> str:
+        return self.export_url
+
+    @property
+    def not_modified(self) -> bool:
+        # 最近一次拉取的第一页是否命中 304（导出集自上一轮以来没有变化）
+        return self.client is not None and self.client.not_modified
+
+    def __call__(self, since_iso: Optional[str], after_id: Optional[int]) -> Iterator[Any]:
+        return iter_export_pages(
+            self.export_url,
+            since_iso,
+            after_id,
+            page_size=self.page_size,
+            stream=self.stream,
+            metrics=self.metrics,
+            fields=self.fields,
+            client=self.client,
+        )
+
+
+class FileSource:
+    # 数据源：本地 JSON 文件（与导出接口相同的数组格式），用于离线重放
+    not_modified = False
+
+    def __init__(self, path: str, metrics: Optional[SyncMetrics] = None) -> None:
+        self.path = path
+        self.metrics = metrics
+
+    def __str__(self) -> str:
+        return self.path
+
+    def __call__(self, since_iso: Optional[str], after_id: Optional[int]) -> Iterator[Any]:
+        # 文件源不支持游标下推，由 filter 阶段过滤；.gz 文件（如导出快照）直接解压读取
+        # 文件内容不保证有序：读入后按水位线顺序 (updatedTime, id) 排序，检查点才能在运行中途推进
+        opener: Callable[..., BinaryIO] = gzip.open if self.path.endswith(".gz") else open
+        with opener(self.path, "rb") as f:
+            items = list(iter_json_array_timed(f, self.metrics))
+        if all(isinstance(item, dict) for item in items):
+            records = sorted((ArmyRecord(item) for item in items), key=lambda r: (r.ts if r.ts is not None else -1.0, r.id))
+            items = [record.army for record in records]
+        yield from items
+
+
+def _cursor_covers(start_since: Optional[str], start_id: Optional[int], since_iso: Optional[str], after_id: Optional[int]) -> bool:
+    # 从 start 游标下载的数据是否包含 since/after_id 游标之后的全部记录（多出的记录由 filter 阶段过滤）
+    if start_since is None:
+        return True
+    if since_iso is None:
+        return False
+    start_ts, ts = _parse_dt(start_since), _parse_dt(since_iso)
+    if start_ts is None or ts is None:
+        return False
+    if start_ts != ts:
+        return start_ts < ts
+    return (start_id if start_id is not None else -1) <= (after_id if after_id is not None else -1)
+
+
+class ExportSnapshot:
+    # 数据源包装：把导出接口的记录边下载边写入 gzip 压缩的 JSON 数组（与导出同格式，可用 --source-file 重放），
+    # 旁边的 .meta.json 记录下载时的接口、游标、条数与时间。上一轮有批次失败、进程中断或只是 --dry-run 预览时，
+    # max_age 秒内的下一轮直接读快照，不再请求网站；本轮成功推进水位线后由 discard() 删除
+    def __init__(self, source: HttpExportSource, path: str, max_age: float, metrics: Optional[SyncMetrics] = None) -> None:
+        self.source = source
+        self.path = path
+        self.meta_path = f"{path}.meta.json"
+        self.max_age = max_age
+        self.metrics = metrics
+        self.reused = False
+
+    def __str__(self) -> str:
+        return str(self.source)
+
+    @property
+    def not_modified(self) -> bool:
+        return not self.reused and self.source.not_modified
+
+    def _load_meta(self, since_iso: Optional[str], after_id: Optional[int]) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self.meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if meta.get("url") != self.source.export_url or meta.get("fields") != self.source.fields:
+            return None
+        if time.time() - float(meta.get("downloadedAt", 0)) > self.max_age:
+            logging.info(f"Export snapshot {self.path} is older than {self.max_age:g}s; downloading again")
+            return None
+        if not _cursor_covers(meta.get("since"), meta.get("afterId"), since_iso, after_id) or not os.path.exists(self.path):
+            return None
+        return meta
+
+    def __call__(self, since_iso: Optional[str], after_id: Optional[int]) -> Iterator[Any]:
+        meta = self._load_meta(since_iso, after_id)
+        self.reused = meta is not None
+        if meta is not None:
+            logging.info(
+                f"Reusing export snapshot {self.path} ({meta.get('count')} armies from since={meta.get('since')} "
+                f"afterId={meta.get('afterId')}, downloaded {time.time() - float(meta['downloadedAt']):.0f}s ago)"
+            )
+            if self.metrics is not None:
+                self.metrics.inc("snapshot_reused")
+            with gzip.open(self.path, "rb") as f:
+                yield from iter_json_array_timed(f, self.metrics)
+            return
+        yield from self._download(since_iso, after_id)
+
+    def _download(self, since_iso: Optional[str], after_id: Optional[int]) -> Iterator[Any]:
+        # 先写临时文件，完整下载后才替换快照；中途出错或被中止时删除临时文件，旧快照作废
+        tmp = f"{self.path}.tmp"
+        downloaded_at = time.time()
+        count = 0
+        try:
+            with gzip.open(tmp, "wt", encoding="utf-8", compresslevel=5) as out:
+                out.write("[")
+                for item in self.source(since_iso, after_id):
+                    out.write(("," if count else "") + "\n" + json.dumps(item, ensure_ascii=False, separators=(",", ":")))
+                    count += 1
+                    yield item
+                out.write("\n]\n")
+        except BaseException:
+            _remove_quietly(tmp)
+            raise
+        if self.source.not_modified:
+            # 304：没有新数据，保留原快照
+            _remove_quietly(tmp)
+            return
+        # 先删 meta 再替换数据，任何时刻中断都不会出现 meta 与数据不匹配
+        _remove_quietly(self.meta_path)
+        os.replace(tmp, self.path)
+        meta = {
+            "url": self.source.export_url,
+            "fields": self.source.fields,
+            "since": since_iso,
+            "afterId": after_id,
+            "count": count,
+            "downloadedAt": downloaded_at,
+        }
+        with open(f"{self.meta_path}.tmp", "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(f"{self.meta_path}.tmp", self.meta_path)
+        logging.debug(f"Saved export snapshot {self.path} ({count} armies, {os.path.getsize(self.path)} bytes)")
+
+    def discard(self) -> None:
+        _remove_quietly(self.meta_path)
+        _remove_quietly(self.path)
+
+
+def _remove_quietly(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _metrics_update(metrics: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    # 字段路径更新：只改 metrics.*，不触碰 composition/copyLink 等其余字段
+    return {f"metrics.{k}": v for k, v in (metrics or {}).items()}
+
+
+class FirestoreSink:
+    # 写入端：Firestore（本地清单去重 + 可选 skip-not-newer + 并发批次提交）
+    def __init__(
+        self,
+        db: Any,
+        collection: str,
+        concurrency: int = 4,
+        max_retries: int = 6,
+        manifest: Optional[SyncManifest] = None,
+        skip_not_newer: bool = False,
+        metrics: Optional[SyncMetrics] = None,
+    ) -> None:
+        self.db = db
+        self.collection = collection
+        self.manifest = manifest
+        self.skip_not_newer = skip_not_newer
+        self.metrics = metrics
+        self.committer = BatchCommitter(db, max_in_flight=concurrency, max_retries=max_retries, metrics=metrics)
+        self.unchanged = 0
+        self.skipped = 0
+        self.missing = 0
+
+    @property
+    def committed(self) -> int:
+        return self.committer.committed
+
+    @property
+    def failed(self) -> int:
+        return self.committer.failed
+
+    @property
+    def failed_batches(self) -> int:
+        return self.committer.failed_batches
+
+    def write(self, chunk: List[Tuple[ArmyRecord, Dict[str, Any]]], on_done: Callable[[bool], None]) -> None:
+        col = self.db.collection(self.collection)
+        entries = [(record, col.document(str(doc.get("id"))), doc) for record, doc in chunk]
+        hashes: Dict[str, Tuple[str, str]] = {}
+        # 只有计数器变化的文档：字段级更新 metrics.*，不重写整个文档
+        metric_writes: List[Write] = []
+        if self.manifest:
+            t0 = time.perf_counter()
+            hashes = {ref.id: (doc_hash(doc), metrics_hash(doc.get("metrics"))) for _, ref, doc in entries}
+            known = self.manifest.lookup(list(hashes))
+            kept = []
+            for entry in entries:
+                ref, doc = entry[1], entry[2]
+                h, mh = hashes[ref.id]
+                old = known.get(ref.id)
+                if old is None or old[0] != h:
+                    kept.append(entry)
+                elif old[1] != mh:
+                    metric_writes.append(("update", ref, _metrics_update(doc.get("metrics"))))
+            self.unchanged += len(entries) - len(kept) - len(metric_writes)
+            if self.metrics is not None:
+                self.metrics.observe("manifest", time.perf_counter() - t0)
+                self.metrics.inc("docs_unchanged", len(entries) - len(kept) - len(metric_writes))
+                self.metrics.inc("metrics_updates", len(metric_writes))
+            entries = kept
+        if self.skip_not_newer and entries:
+            t0 = time.perf_counter()
+            kept = _drop_not_newer(self.db, entries)
+            self.skipped += len(entries) - len(kept)
+            if self.metrics is not None:
+                self.metrics.observe("skip_check", time.perf_counter() - t0)
+                self.metrics.inc("docs_skipped_not_newer", len(entries) - len(kept))
+            entries = kept
+        writes: List[Write] = [("set", ref, doc) for _, ref, doc in entries] + metric_writes
+        self._submit(writes, hashes, on_done)
+
+    def write_metrics(self, chunk: List[Tuple[ArmyRecord, Dict[str, Any]]], on_done: Callable[[bool], None]) -> None:
+        # --metrics-only：chunk 为 (记录, 计数器)；只更新清单中已存在且计数器有变化的文档（update 不存在的文档会让整批失败）
+        if not self.manifest:
+            raise RuntimeError("Metrics-only sync requires the manifest")
+        col = self.db.collection(self.collection)
+        t0 = time.perf_counter()
+        hashes = {str(record.id): ("", metrics_hash(m)) for record, m in chunk}
+        known = self.manifest.lookup(list(hashes))
+        writes: List[Write] = []
+        missing = 0
+        for record, m in chunk:
+            old = known.get(str(record.id))
+            if old is None:
+                missing += 1
+            elif old[1] != hashes[str(record.id)][1]:
+                writes.append(("update", col.document(str(record.id)), _metrics_update(m)))
+        self.unchanged += len(chunk) - len(writes) - missing
+        self.missing += missing
+        if self.metrics is not None:
+            self.metrics.observe("manifest", time.perf_counter() - t0)
+            self.metrics.inc("docs_unchanged", len(chunk) - len(writes) - missing)
+            self.metrics.inc("docs_not_in_manifest", missing)
+            self.metrics.inc("metrics_updates", len(writes))
+        self._submit(writes, hashes, on_done)
+
+    def delete(self, ids: List[str], on_done: Callable[[bool], None]) -> None:
+        # 对账删除：成功后把这些 id 从清单中移除，之后同一 id 重新出现时会被当作新文档写入
+        col = self.db.collection(self.collection)
+        writes: List[Write] = [("delete", col.document(doc_id), {}) for doc_id in ids]
+
+        def done(ok: bool) -> None:
+            if ok and self.manifest:
+                self.manifest.remove(ids)
+            on_done(ok)
+
+        self.committer.submit(writes, done)
+
+    def _submit(self, writes: List[Write], hashes: Dict[str, Tuple[str, str]], on_done: Callable[[bool], None]) -> None:
+        if not writes:
+            # 整块都无需写入，直接视为完成
+            on_done(True)
+            return
+
+        def done(ok: bool) -> None:
+            # 只有提交成功的文档才记入清单，失败的下次仍会重写
+            if ok and self.manifest:
+                self.manifest.update(
+                    [(ref.id, hashes[ref.id][0]) for op, ref, _ in writes if op == "set"],
+                    [(ref.id, hashes[ref.id][1]) for _, ref, _ in writes],
+                )
+            on_done(ok)
+
+        self.committer.submit(writes, done)
+
+    def close(self) -> None:
+        self.committer.close()
+        if self.manifest:
+            if self.unchanged:
+                logging.info(f"Skipped {self.unchanged} documents unchanged since the last sync (manifest: {self.manifest.path})")
+            if self.missing:
+                logging.info(f"Skipped {self.missing} metrics updates for documents not in the manifest; run a full sync to create them")
+            self.manifest.close()
+        if self.skip_not_newer:
+            logging.info(f"Skipped {self.skipped} documents that were not newer than Firestore")
+
+
+class JsonlSink:
+    # 写入端：本地 JSON Lines 文件（每行一个转换后的文档），用于离线调试与结果比对
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.committed = 0
+        self.failed = 0
+        self.failed_batches = 0
+        self._f = open(path, "w", encoding="utf-8")
+
+    def write(self, chunk: List[Tuple[ArmyRecord, Dict[str, Any]]], on_done: Callable[[bool], None]) -> None:
+        for _, doc in chunk:
+            self._f.write(json.dumps(doc, ensure_ascii=False))
+            self._f.write("\n")
+        self.committed += len(chunk)
+        on_done(True)
+
+    def close(self) -> None:
+        self._f.close()
+        logging.info(f"Wrote {self.committed} documents to {self.path}")
+
+
+def transform_stage(
+    records: Iterable[ArmyRecord],
+    errors: List[int],
+    metrics: Optional[SyncMetrics] = None,
+    icon_atlas: Optional[IconAtlas] = None,
+) -> Iterator[Tuple[ArmyRecord, Dict[str, Any]]]:
+    for record in records:
+        try:
+            t0 = time.perf_counter()
+            doc = transform_army(record.army, icon_atlas)
+            if metrics is not None:
+                metrics.observe("transform", time.perf_counter() - t0)
+            yield record, doc
+        except Exception as e:
+            errors.append(record.id)
+            logging.error(f"Failed to transform army id={record.id}: {e}")
+            logging.debug(traceback.format_exc())
+
+
+def _transform_chunk(armies: List[Dict[str, Any]], icon_atlas: Optional[IconAtlas] = None) -> Tuple[float, List[Tuple[bool, Any]]]:
+    # 进程池工作函数：返回 (耗时, [(成功?, 文档或错误信息)])，单条失败不影响整块
+    t0 = time.perf_counter()
+    results: List[Tuple[bool, Any]] = []
+    for army in armies:
+        try:
+            results.append((True, transform_army(army, icon_atlas)))
+        except Exception as e:
+            results.append((False, f"{type(e).__name__}: {e}"))
+    return time.perf_counter() - t0, results
+
+
+def parallel_transform_stage(
+    records: Iterable[ArmyRecord],
+    errors: List[int],
+    workers: int,
+    chunk_size: int = 256,
+    metrics: Optional[SyncMetrics] = None,
+    icon_atlas: Optional[IconAtlas] = None,
+) -> Iterator[Tuple[ArmyRecord, Dict[str, Any]]]:
+    # 多进程转换：按块提交到进程池，按提交顺序取回结果，输出顺序与输入一致
+    # 使用 spawn：父进程此时已有下载线程在运行，fork 可能继承到被占用的锁
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as pool:
+        inflight: Deque[Tuple[List[ArmyRecord], Future]] = deque()
+
+        def drain_one() -> Iterator[Tuple[ArmyRecord, Dict[str, Any]]]:
+            chunk, future = inflight.popleft()
+            seconds, results = future.result()
+            if metrics is not None:
+                # 子进程内的耗时，按块记录
+                metrics.observe("transform", seconds)
+            for record, (ok, value) in zip(chunk, results):
+                if ok:
+                    yield record, value
+                else:
+                    errors.append(record.id)
+                    logging.error(f"Failed to transform army id={record.id}: {value}")
+
+        for chunk in batched(records, chunk_size):
+            inflight.append((chunk, pool.submit(_transform_chunk, [r.army for r in chunk], icon_atlas)))
+            # 在途块数有上限，避免转换远远跑在提交前面
+            if len(inflight) >= workers * 2:
+                yield from drain_one()
+        while inflight:
+            yield from drain_one()
+
+
+def _write_metrics(metrics: SyncMetrics, report_path: Optional[str], prometheus_path: Optional[str]) -> None:
+    # 各阶段耗时汇总打印到日志；报告文件写入失败不影响同步结果
+    for name, hist in metrics.stages.items():
+        p95 = hist.quantile(0.95) or 0.0
+        logging.info(f"Stage {name}: {hist.count} obs, total {hist.sum:.3f}s, p95 {p95 * 1000:.2f}ms")
+    for path, write in ((report_path, metrics.write_report), (prometheus_path, metrics.write_prometheus)):
+        if not path:
+            continue
+        try:
+            write(path)
+            logging.info(f"Wrote sync metrics to {path}")
+        except Exception as e:
+            logging.error(f"Failed to write sync metrics to {path}: {e}")
+            logging.debug(traceback.format_exc())
+
+
+def _update_marker(db: Any, migration_collection: str, migration_doc: str, fields: Dict[str, Any]) -> None:
+    # 运行摘要只写入已有的 marker（update 而不是 set(merge=True)）：
+    # 否则会凭空创建一个没有 lastUpdatedTime 的 marker，之后不带 --since 的常规同步会绕过“没有 marker 拒绝上传”的保护而全量上传
+    try:
+        db.collection(migration_collection).document(migration_doc).update(fields)
+    except NOT_FOUND_ERRORS:
+        logging.info(f"Firestore migration marker {migration_collection}/{migration_doc} does not exist; run summary not recorded")
+    except Exception as e:
+        logging.error(f"Failed to update Firestore migration marker: {e}")
+        logging.debug(traceback.format_exc())
+
+
+def _sync_metrics_only(
+    db: Any,
+    source: Callable[[Optional[str], Optional[int]], Iterator[Any]],
+    collection: str,
+    manifest: Optional[SyncManifest],
+    batch_size: int,
+    concurrency: int,
+    max_retries: int,
+    queue_depth: int,
+    metrics: SyncMetrics,
+    dry_run: bool = False,
+    indexes: Optional[ArmyIndexes] = None,
+    columnar: Optional[ColumnarSnapshot] = None,
+) -> Tuple[int, int, int]:
+    # 只同步计数器：拉取 id + metrics，对计数器有变化的已有文档做 metrics.* 字段更新；不读写增量水位线
+    logging.info(f"Fetching army metrics from: {source}")
+    total = 0
+
+    def rows() -> Iterator[Tuple[ArmyRecord, Dict[str, Any]]]:
+        nonlocal total
+        for item in source(None, None):
+            if not isinstance(item, dict):
+                raise RuntimeError("Exported metrics JSON is not a list of objects")
+            total += 1
+            yield ArmyRecord(item), army_metrics(item)
+
+    if dry_run:
+        items = rows()
+        preview = [{"id": r.id, **_metrics_update(m)} for r, m in itertools.islice(items, 3)]
+        for _ in items:
+            pass
+        print(json.dumps(preview, ensure_ascii=False, indent=2))
+        return total, 0, 0
+
+    sink = FirestoreSink(
+        db,
+        collection,
+        concurrency=concurrency,
+        max_retries=max_retries,
+        manifest=manifest,
+        metrics=metrics,
+    )
+    fetched = threaded(rows(), maxsize=queue_depth, name="fetch")
+    try:
+        for chunk in batched(fetched, batch_size):
+            rows_metrics = [(record.id, m) for record, m in chunk]
+            on_done = _observe_columnar(columnar, lambda rows=rows_metrics: columnar.update_metrics(rows), lambda ok: None, metrics)
+            sink.write_metrics(chunk, _observe_indexes(indexes, lambda rows=rows_metrics: indexes.observe_metrics(rows), on_done))
+    finally:
+        fetched.close()
+        sink.close()
+    if getattr(source, "not_modified", False):
+        return 0, 0, 0
+    logging.info(f"Fetched metrics for {total} armies, {sink.committed} updated, {sink.failed} failed")
+    return total, sink.committed, sink.failed
+
+
+def _load_live_ids(source: Callable[[Optional[str], Optional[int]], Iterator[Any]]) -> "array[int]":
+    # 线上所有军队 id 存成有序的 array('l')（每个 id 8 字节），查找用二分
+    ids: "array[int]" = array("l")
+    ordered = True
+    last = None
+    for item in source(None, None):
+        if not isinstance(item, dict):
+            raise RuntimeError("Exported ids JSON is not a list of objects")
+        army_id = int(item["id"])
+        if last is not None and army_id < last:
+            ordered = False
+        ids.append(army_id)
+        last = army_id
+    if not ordered:
+        # 文件源按 (updatedTime, id) 排序，需要重新按 id 排序
+        ids = array("l", sorted(ids))
+    return ids
+
+
+def _contains(ids: "array[int]", value: int) -> bool:
+    i = bisect.bisect_left(ids, value)
+    return i < len(ids) and ids[i] == value
+
+
+def _reconcile_deletes(
+    db: Any,
+    source: Callable[[Optional[str], Optional[int]], Iterator[Any]],
+    collection: str,
+    manifest: Optional[SyncManifest],
+    batch_size: int,
+    concurrency: int,
+    max_retries: int,
+    metrics: SyncMetrics,
+    dry_run: bool = False,
+    max_delete_ratio: float = 0.5,
+    indexes: Optional[ArmyIndexes] = None,
+    columnar: Optional[ColumnarSnapshot] = None,
+) -> Tuple[int, int, int]:
+    # 删除对账：Firestore 集合中 id 不在导出 id 集合里的文档（MariaDB 中已删除的军队）批量删除
+    logging.info(f"Fetching live army ids from: {source}")
+    with metrics.timer("reconcile_ids"):
+        live = _load_live_ids(source)
+    if getattr(source, "not_modified", False):
+        return 0, 0, 0
+    metrics.inc("live_ids", len(live))
+    if not live:
+        # 导出为空多半是接口/数据源出错，绝不能据此清空集合
+        raise RuntimeError("Export returned no army ids; refusing to reconcile deletes")
+    logging.info(f"Loaded {len(live)} live army ids")
+
+    # list_documents 只列出文档引用，不读取文档内容
+    scanned = 0
+    orphans: "array[int]" = array("l")
+    foreign = 0
+    with metrics.timer("reconcile_scan"):
+        for ref in db.collection(collection).list_documents(page_size=1000):
+            scanned += 1
+            try:
+                doc_id = int(ref.id)
+            except ValueError:
+                # 非数字 id 不是本工具写入的文档，不处理
+                foreign += 1
+                continue
+            if not _contains(live, doc_id):
+                orphans.append(doc_id)
+    metrics.inc("firestore_docs", scanned)
+    metrics.inc("orphan_docs", len(orphans))
+    logging.info(f"Scanned {scanned} documents in '{collection}', {len(orphans)} no longer exist in the export")
+    if foreign:
+        logging.warning(f"Ignored {foreign} documents with non-numeric ids")
+
+    if dry_run or not orphans:
+        if orphans:
+            logging.info("Dry-run: would delete ids %s%s", ", ".join(str(i) for i in orphans[:20]), " ..." if len(orphans) > 20 else "")
+        return scanned, 0, 0
+    if len(orphans) > scanned * max_delete_ratio:
+        raise RuntimeError(
+            f"Refusing to delete {len(orphans)} of {scanned} documents (more than {max_delete_ratio:.0%}); "
+            "check the export, or raise --max-delete-ratio if this is intended"
+        )
+
+    sink = FirestoreSink(db, collection, concurrency=concurrency, max_retries=max_retries, manifest=manifest, metrics=metrics)
+    try:
+        for start in range(0, len(orphans), batch_size):
+            ids = orphans[start:start + batch_size]
+            on_done = _observe_columnar(columnar, lambda ids=ids: columnar.remove(ids), lambda ok: None, metrics)
+            sink.delete([str(i) for i in ids], _observe_indexes(indexes, lambda ids=ids: indexes.remove(ids), on_done))
+    finally:
+        sink.close()
+    metrics.inc("docs_deleted", sink.committed)
+    logging.info(f"Deleted {sink.committed} orphaned documents, {sink.failed} failed")
+    return scanned, sink.committed, sink.failed
+
+
+class Checkpoint:
+    # 检查点：批次按提交顺序编号，完成后水位线只推进到"连续完成"的批次前缀（并发提交时后面的批次可能先完成）
+    # 输入按 (updatedTime, id) 升序时，前缀水位线之前的军队都已写入，每次推进都可以立即持久化（on_advance）；
+    # 某个批次最终失败后水位线停在它之前，失败或中断的运行下次从该处继续。检测到输入无序时不再中途持久化；
+    # 若无序的军队落在已持久化的水位线之前（它还没提交，下次运行会被水位线跳过），立即恢复运行开始时的水位线（on_restore）
+    def __init__(
+        self,
+        on_advance: Optional[Callable[[str, int], None]] = None,
+        on_restore: Optional[Callable[[], None]] = None,
+    ) -> None:
+        self.tracker = _WatermarkTracker()
+        self.failed = False
+        self.ordered = True
+        self.restored = False
+        self.on_advance = on_advance
+        self.on_restore = on_restore
+        # 运行中最近一次持久化的水位线
+        self.saved: Optional[Tuple[float, int]] = None
+        self.saved_iso: Optional[str] = None
+        self.saved_id: Optional[int] = None
+        self._next_seq = 0
+        self._prefix_seq = 0
+        self._done: Dict[int, List[ArmyRecord]] = {}
+        self._last: Optional[Tuple[float, int]] = None
+
+    def track(self, records: List[ArmyRecord]) -> Callable[[bool], None]:
+        # 为批次分配序号，返回提交完成时的回调
+        seq = self._next_seq
+        self._next_seq += 1
+        for record in records:
+            if record.ts is None:
+                continue
+            key = (record.ts, record.id)
+            if self._last is not None and key < self._last:
+                if self.ordered:
+                    logging.warning(
+                        f"Army {record.id} is out of (updatedTime, id) order; "
+                        "the watermark will only be saved after the whole run succeeds"
+                    )
+                self.ordered = False
+                if self.saved is not None and key <= self.saved:
+                    self._restore(record)
+            else:
+                self._last = key
+        return lambda ok: self._on_batch_done(seq, records, ok)
+
+    def _on_batch_done(self, seq: int, records: List[ArmyRecord], ok: bool) -> None:
+        if not ok:
+            self.failed = True
+            return
+        self._done[seq] = records
+        advanced = False
+        while self._prefix_seq in self._done:
+            for record in self._done.pop(self._prefix_seq):
+                self.tracker.observe(record)
+            self._prefix_seq += 1
+            advanced = True
+        if advanced and self.ordered and self.on_advance is not None and self.tracker.max_iso:
+            self.on_advance(self.tracker.max_iso, self.tracker.max_id)
+            self.saved = (self.tracker.max_ts, self.tracker.max_id)
+            self.saved_iso, self.saved_id = self.tracker.max_iso, self.tracker.max_id
+
+    def _restore(self, record: ArmyRecord) -> None:
+        logging.warning(
+            f"Army {record.id} ({record.iso}) is behind the checkpoint already saved at {self.saved_iso} (id {self.saved_id}); "
+            "restoring the watermark this run started from"
+        )
+        if self.on_restore is not None:
+            self.on_restore()
+        self.restored = True
+        self.saved = None
+        self.saved_iso = self.saved_id = None
+
+
+def _init_firestore(service_account: str) -> Any:
+    if firebase_admin is None:
+        raise RuntimeError("firebase_admin is not installed; install it or use --local-db / --sink-file")
+    logging.info(f"Initializing Firebase app with service account: {service_account}")
+    cred = credentials.Certificate(service_account)
+    try:
+        firebase_admin.get_app()
+    except ValueError:
+        firebase_admin.initialize_app(cred)
+    return firestore.client()
+
+
 def upload_armies(
     base_url: str,
     service_account: str,
@@ -307,26 +1826,184 @@ def upload_armies(
     migration_collection: str = "migration",
     migration_doc: str = "cocarmies",
     init_migration: bool = False,
+    stream: bool = True,
+    page_size: int = 1000,
+    concurrency: int = 4,
+    max_retries: int = 6,
+    use_manifest: bool = True,
+    manifest_path: Optional[str] = None,
+    rebuild_manifest: bool = False,
+    source_file: Optional[str] = None,
+    source_db: Optional[Dict[str, Any]] = None,
+    sink_file: Optional[str] = None,
+    queue_depth: int = 1000,
+    workers: int = 1,
+    db: Any = None,
+    report_path: Optional[str] = None,
+    prometheus_path: Optional[str] = None,
+    metrics_only: bool = False,
+    reconcile: bool = False,
+    max_delete_ratio: float = 0.5,
+    http_client: Optional[ExportClient] = None,
+    use_snapshot: bool = True,
+    snapshot_path: Optional[str] = None,
+    snapshot_max_age: float = 6 * 3600,
+    icon_atlas: Optional[IconAtlas] = None,
+    use_indexes: bool = False,
+    index_collection: str = "army_indexes",
+    index_path: Optional[str] = None,
+    index_top_n: int = 50,
+    rebuild_indexes: bool = False,
+    columnar_dir: Optional[str] = None,
+    columnar_format: str = "parquet",
 ) -> Tuple[int, int, int]:
-    # 初始化 Firebase
-    logging.info(f"Initializing Firebase app with service account: {service_account}")
-    cred = credentials.Certificate(service_account)
-    try:
-        firebase_admin.get_app()
-    except ValueError:
-        firebase_admin.initialize_app(cred)
-    db = firestore.client()
+    metrics = SyncMetrics()
+    # db 可由调用方注入（如 LocalFirestore 本地后端、--watch 常驻进程复用的客户端），为 None 时按服务账号初始化 Firebase
+    # http_client 传入时复用 keep-alive 连接并对导出接口发条件请求；导出未变化（304）时本轮直接返回 (0, 0, 0)
+    # source_db 为 MariaDB 连接参数（host/port/user/password/database）时直接读数据库，不经过导出接口
+    if sink_file:
+        # 本地 sink 不需要 Firestore：也就没有 migration marker，按 --since 过滤
+        if fs_migration:
+            logging.info("Local sink selected, Firestore migration marker is not used")
+        fs_migration = False
+        db = None
+    elif db is None:
+        db = _init_firestore(service_account)
+
+    if source_file:
+        source: Callable[[Optional[str], Optional[int]], Iterator[Any]] = FileSource(source_file, metrics=metrics)
+    elif source_db:
+        source = MariaDBSource(
+            **source_db,
+            batch_size=page_size or 1000,
+            fields="ids" if reconcile else "metrics" if metrics_only else None,
+            metrics=metrics,
+        )
+    else:
+        source = HttpExportSource(
+            base_url.rstrip("/") + "/api/export/armies",
+            page_size=page_size,
+            stream=stream,
+            metrics=metrics,
+            fields="ids" if reconcile else "metrics" if metrics_only else None,
+            client=http_client,
+        )
+        if use_snapshot and not reconcile and not metrics_only:
+            # 对账与计数器同步需要最新数据，不使用快照
+            source = ExportSnapshot(source, snapshot_path or _default_snapshot_path(state_file), snapshot_max_age, metrics=metrics)
+
+    # 榜单索引只随 Firestore 写入维护：--dry-run / --sink-file / --init-migration 不读写本地榜单状态
+    indexes: Optional[ArmyIndexes] = None
+    if use_indexes and (dry_run or db is None):
+        logging.info("Army indexes are only maintained when writing to Firestore; skipped for this run")
+        use_indexes = False
+
+    def open_indexes() -> ArmyIndexes:
+        return _open_indexes(db, collection, index_path or _default_index_path(state_file), index_top_n, rebuild_indexes, metrics)
+
+    def publish_indexes() -> None:
+        if indexes is not None and not source.not_modified:
+            _publish_indexes(db, indexes, index_collection, batch_size, concurrency, max_retries, metrics)
 
-    export_url = base_url.rstrip("/") + "/api/export/armies"
-    logging.info(f"Fetching armies from: {export_url}")
-    armies = http_get_json(export_url)
-    if not isinstance(armies, list):
-        raise RuntimeError("Exported armies JSON is not a list")
+    # 列式快照随三种写入 Firestore 的运行合并更新：常规同步重写军队，--metrics-only 刷新计数器，--reconcile 删除军队
+    columnar: Optional[ColumnarSnapshot] = None
+
+    if reconcile:
+        if db is None:
+            raise RuntimeError("--reconcile deletes Firestore documents and cannot be used with --sink-file")
+        manifest: Optional[SyncManifest] = None
+        if use_manifest and not dry_run:
+            manifest = _open_manifest(db, collection, manifest_path, state_file)
+        if use_indexes:
+            indexes = open_indexes()
+        if columnar_dir and not dry_run:
+            columnar = ColumnarSnapshot(columnar_dir, columnar_format)
+        completed = False
+        try:
+            scanned, deleted, failed = _reconcile_deletes(
+                db,
+                source,
+                collection,
+                manifest,
+                batch_size=batch_size,
+                concurrency=concurrency,
+                max_retries=max_retries,
+                metrics=metrics,
+                dry_run=dry_run,
+                max_delete_ratio=max_delete_ratio,
+                indexes=indexes,
+                columnar=columnar,
+            )
+            completed = True
+            publish_indexes()
+        finally:
+            if indexes is not None:
+                indexes.close()
+            if columnar is not None:
+                _close_columnar(columnar, completed and not source.not_modified, metrics)
+        if dry_run or source.not_modified:
+            return scanned, 0, 0
+        metrics.finish()
+        _write_metrics(metrics, report_path, prometheus_path)
+        if fs_migration:
+            marker_update = {
+                'lastReconcileAt': datetime.now(timezone.utc).isoformat(),
+                'lastReconcileDeleted': deleted,
+            }
+            _update_marker(db, migration_collection, migration_doc, marker_update)
+        return scanned, deleted, failed
+
+    if metrics_only:
+        if db is None:
+            raise RuntimeError("--metrics-only updates Firestore documents and cannot be used with --sink-file")
+        if not use_manifest:
+            raise RuntimeError("--metrics-only needs the manifest to know which documents exist in Firestore")
+        manifest = None if dry_run else _open_manifest(db, collection, manifest_path, state_file)
+        if use_indexes:
+            indexes = open_indexes()
+        if columnar_dir and not dry_run:
+            columnar = ColumnarSnapshot(columnar_dir, columnar_format)
+        completed = False
+        try:
+            total, updated, failed = _sync_metrics_only(
+                db,
+                source,
+                collection,
+                manifest,
+                batch_size=batch_size,
+                concurrency=concurrency,
+                max_retries=max_retries,
+                queue_depth=queue_depth,
+                metrics=metrics,
+                dry_run=dry_run,
+                indexes=indexes,
+                columnar=columnar,
+            )
+            completed = True
+            publish_indexes()
+        finally:
+            if indexes is not None:
+                indexes.close()
+            if columnar is not None:
+                _close_columnar(columnar, completed and not source.not_modified, metrics)
+        if dry_run or source.not_modified:
+            return total, 0, 0
+        metrics.inc("armies_fetched", total)
+        metrics.inc("docs_written", updated)
+        metrics.inc("docs_failed", failed)
+        metrics.finish()
+        _write_metrics(metrics, report_path, prometheus_path)
+        if fs_migration:
+            marker_update = {
+                'lastMetricsRunAt': datetime.now(timezone.utc).isoformat(),
+                'lastMetricsRunMetrics': metrics.summary(),
+            }
+            _update_marker(db, migration_collection, migration_doc, marker_update)
+        return total, updated, failed
 
-    # since/state_file/Firestore migration 处理
-    watermark = None
     # Firestore migration 优先，其次本地 state_file
     fs_marker: Optional[Dict[str, Any]] = None
+    marker_ref = None
     if fs_migration:
         try:
             marker_ref = db.collection(migration_collection).document(migration_doc)
@@ -341,158 +2018,251 @@ def upload_armies(
             logging.debug(traceback.format_exc())
             fs_marker = None
 
-        if init_migration:
-            # 初始化：写入当前导出集的最新水位线，不执行上传
-            max_iso = _max_updated_iso(armies)
-            # 若相同时间有多条，选择最大的 id 作为最后游标
-            last_id = -1
-            if max_iso is not None:
-                # 找到该时间的最大 id
-                candidates = []
-                for a in armies:
-                    iso = a.get('updatedTime') or a.get('createdTime')
-                    if iso == max_iso:
-                        candidates.append(int(a.get('id', -1)))
-                last_id = max(candidates) if candidates else -1
-            marker_payload = {
-                'lastUpdatedTime': max_iso,
-                'lastId': last_id,
-                'lastRunAt': datetime.now(timezone.utc).isoformat(),
-                'note': 'Initialized without uploading. Future runs will sync newer only.'
-            }
-            marker_ref.set(marker_payload, merge=True)
-            logging.info(f"Initialized Firestore migration marker at {migration_collection}/{migration_doc}: {marker_payload}")
-            return len(armies), 0, 0
-
-        # 若启用 Firestore migration 但没有 marker，且未显式指定 since，则拒绝上传
-        if fs_marker is None and not since:
+        # 若启用 Firestore migration 但没有 marker，且未显式指定 since，则拒绝上传（无需先下载导出数据）
+        if fs_marker is None and not since and not init_migration:
             logging.error(
                 "Firestore migration marker not found. Refusing to upload. "
                 f"Create it first using --init-migration or provide --since. Path: {migration_collection}/{migration_doc}"
             )
-            return len(armies), 0, 0
+            return 0, 0, 0
 
-    total = len(armies)
-    # 计算过滤条件：优先 Firestore marker，否则 --since，否则不过滤
-    if fs_marker:
+    # 计算过滤条件：优先 Firestore marker，否则 --since，否则不过滤。同样的条件作为游标下推给导出接口
+    marker_iso: Optional[str] = None
+    marker_id = -1
+    if fs_marker and not init_migration:
         marker_iso = fs_marker.get('lastUpdatedTime')
         marker_id = int(fs_marker.get('lastId') or -1)
-        if marker_iso:
-            # 先按时间过滤
-            pre = len(armies)
-            armies = _filter_armies_since(armies, marker_iso)
-            logging.info(f"Filtered by Firestore marker time={marker_iso}, remaining {len(armies)}/{pre}")
-            # 对于等于 marker 时间的记录，再按 id 做二次过滤：> lastId 才处理
-            filtered: List[Dict[str, Any]] = []
-            for a in armies:
-                iso = a.get('updatedTime') or a.get('createdTime')
-                if iso == marker_iso:
-                    aid = int(a.get('id', -1))
-                    if aid > marker_id:
-                        filtered.append(a)
-                else:
-                    filtered.append(a)
-            logging.info(
-                f"Applied Firestore marker id>{marker_id} on same timestamp, remaining {len(filtered)}/{len(armies)}"
-            )
-            armies = filtered
-        else:
+        if not marker_iso:
             logging.warning("Firestore marker has no lastUpdatedTime. No time filter applied; consider setting --init-migration.")
+    if marker_iso:
+        cursor_since, cursor_id = marker_iso, marker_id
+    elif since and not init_migration:
+        cursor_since, cursor_id = since, None
+    else:
+        cursor_since, cursor_id = None, None
+
+    logging.info(f"Fetching armies from: {source} (since={cursor_since}, afterId={cursor_id})")
+    total = 0
+    selected = 0
+
+    def counted(items: Iterable[Any]) -> Iterator[ArmyRecord]:
+        nonlocal total
+        for item in items:
+            if not isinstance(item, dict):
+                raise RuntimeError("Exported armies JSON is not a list of objects")
+            total += 1
+            yield ArmyRecord(item)
+
+    def selected_counter(items: Iterable[ArmyRecord]) -> Iterator[ArmyRecord]:
+        nonlocal selected
+        for record in items:
+            selected += 1
+            yield record
+
+    # source + filter 阶段
+    records: Iterator[ArmyRecord] = counted(source(cursor_since, cursor_id))
+
+    if fs_migration and init_migration:
+        # 初始化：写入当前导出集的最新水位线（相同时间取最大 id），不执行上传
+        tracker = _WatermarkTracker()
+        for r in records:
+            tracker.observe(r)
+        marker_payload = {
+            'lastUpdatedTime': tracker.max_iso,
+            'lastId': tracker.max_id,
+            'lastRunAt': datetime.now(timezone.utc).isoformat(),
+            'note': 'Initialized without uploading. Future runs will sync newer only.'
+        }
+        marker_ref.set(marker_payload, merge=True)
+        logging.info(f"Initialized Firestore migration marker at {migration_collection}/{migration_doc}: {marker_payload}")
+        if isinstance(source, ExportSnapshot):
+            source.discard()
+        return total, 0, 0
+
+    def timed_filter(items: Iterable[ArmyRecord], since_iso: str, after_id: Optional[int] = None) -> Iterator[ArmyRecord]:
+        # 按块过滤并计时（计时不含上游下载/解析）
+        for chunk in batched(items, 256):
+            with metrics.timer("filter"):
+                kept = list(_filter_armies_since(chunk, since_iso, after_id))
+            yield from kept
+
+    # 导出接口已按游标过滤；客户端再校验一遍（时间 + 同时间的 id 一次遍历完成），兼容不支持分页参数的旧接口和文件源
+    if marker_iso:
+        logging.info(f"Filtering by Firestore marker time={marker_iso}, id>{marker_id} on same timestamp")
+        records = timed_filter(records, marker_iso, marker_id)
+    elif fs_marker:
+        logging.info("Processing all armies (marker has no cursor).")
     elif since:
-        armies = _filter_armies_since(armies, since)
-        logging.info(f"Filtered by since={since}, remaining {len(armies)}/{total}")
+        logging.info(f"Filtering by since={since}")
+        records = timed_filter(records, since)
     else:
-        logging.info(f"No since filter provided. Processing all {total} armies.")
-    uploaded = 0
-    failed = 0
-    logging.info(f"Fetched {total} armies")
+        logging.info("No since filter provided. Processing all armies.")
+    records = selected_counter(records)
+
     if dry_run:
-        # 仅打印示例
+        # 仅打印示例；其余数据只计数，不驻留内存
         logging.info("Dry-run mode: transforming first 3 armies for preview...")
-        preview = [transform_army(a) for a in armies[:3]]
+        preview = [transform_army(r.army, icon_atlas) for r in itertools.islice(records, 3)]
+        for _ in records:
+            pass
         logging.info("Preview doc IDs: %s", ", ".join(str(x.get("id")) for x in preview))
         print(json.dumps(preview, ensure_ascii=False, indent=2))
         return total, 0, 0
 
-    batch = db.batch()
-    in_batch = 0
-    for idx, army in enumerate(armies, start=1):
-        try:
-            doc = transform_army(army)
-            doc_id = str(doc.get("id"))
-            ref = db.collection(collection).document(doc_id)
-            if skip_not_newer:
-                try:
-                    existing = ref.get()
-                    if existing.exists:
-                        exist_updated = existing.to_dict().get("updatedTime")
-                        new_updated = doc.get("updatedTime")
-                        if exist_updated and new_updated:
-                            exist_ts = _parse_dt(exist_updated) or 0
-                            new_ts = _parse_dt(new_updated) or 0
-                            if exist_ts >= new_ts:
-                                logging.debug(f"Skip not newer id={doc_id} exist={exist_updated} new={new_updated}")
-                                continue
-                except Exception as e:
-                    logging.debug(f"Check skip_not_newer failed for id={doc_id}: {e}")
-            batch.set(ref, doc, merge=True)
-            uploaded += 1
-            in_batch += 1
-        except Exception as e:
-            failed += 1
-            logging.error(f"Failed to enqueue army id={army.get('id')}: {e}")
-            logging.debug(traceback.format_exc())
+    if sink_file:
+        sink: Any = JsonlSink(sink_file)
+    else:
+        manifest = None
+        if use_manifest:
+            manifest = _open_manifest(db, collection, manifest_path, state_file, retarget=rebuild_manifest)
+            if rebuild_manifest:
+                logging.info(f"Rebuilding manifest {manifest.path} from collection '{collection}'...")
+                count = manifest.rebuild(db.collection(collection).stream())
+                logging.info(f"Rebuilt manifest with {count} documents")
+        sink = FirestoreSink(
+            db,
+            collection,
+            concurrency=concurrency,
+            max_retries=max_retries,
+            manifest=manifest,
+            skip_not_newer=skip_not_newer,
+            metrics=metrics,
+        )
+        if use_indexes:
+            indexes = open_indexes()
+    if columnar_dir:
+        columnar = ColumnarSnapshot(columnar_dir, columnar_format)
+        if columnar.previous is None and marker_iso:
+            # 按水位线增量运行时只选中新变化的军队，新建的快照不是全量
+            logging.warning(
+                f"No columnar snapshot in {columnar_dir} yet; it will only contain the armies selected by this incremental run. "
+                "Seed it once with a full run (--since 2000-01-01T00:00:00Z)"
+            )
 
-        if in_batch >= batch_size:
+    # 下载/解析与转换分别在独立线程中运行，主线程负责分批并交给 sink 提交
+    transform_errors: List[int] = []
+    def save_checkpoint(iso: str, last_id: int) -> None:
+        # 每推进一次就持久化水位线：中断或失败后下次运行从这里继续
+        _save_state_since(state_file, iso, last_id)
+        if fs_migration:
             try:
-                batch.commit()
-                logging.info(f"Committed a batch of {in_batch} documents (progress: {idx}/{total})")
+                db.collection(migration_collection).document(migration_doc).set(
+                    {'lastUpdatedTime': iso, 'lastId': last_id, 'lastCheckpointAt': datetime.now(timezone.utc).isoformat()}, merge=True
+                )
             except Exception as e:
-                logging.error(f"Batch commit failed after {idx} processed: {e}")
+                logging.warning(f"Failed to save checkpoint to Firestore migration marker: {e}")
                 logging.debug(traceback.format_exc())
-                raise
-            finally:
-                batch = db.batch()
-                in_batch = 0
-                time.sleep(0.1)
+                return
+        logging.debug(f"Checkpoint saved: lastUpdatedTime={iso} lastId={last_id}")
+        metrics.inc("checkpoints")
 
-    if in_batch:
+    def restore_checkpoint() -> None:
+        # 回到本次运行开始时的游标；开始时没有游标（全量）则删除中途写入的 state 文件，marker 清空游标，下次全量处理
+        if cursor_since:
+            _save_state_since(state_file, cursor_since, cursor_id)
+        elif state_file:
+            _remove_quietly(state_file)
+        if fs_migration:
+            try:
+                db.collection(migration_collection).document(migration_doc).set(
+                    {'lastUpdatedTime': cursor_since, 'lastId': cursor_id, 'lastCheckpointAt': datetime.now(timezone.utc).isoformat()}, merge=True
+                )
+            except Exception as e:
+                logging.error(f"Failed to restore the Firestore migration marker: {e}")
+                logging.debug(traceback.format_exc())
+        metrics.inc("checkpoint_restores")
+
+    checkpoint = Checkpoint(on_advance=save_checkpoint, on_restore=restore_checkpoint)
+    fetched = threaded(records, maxsize=queue_depth, name="fetch")
+    if workers > 1:
+        logging.info(f"Transforming on a process pool with {workers} workers")
+        transform_iter = parallel_transform_stage(fetched, transform_errors, workers, metrics=metrics, icon_atlas=icon_atlas)
+    else:
+        transform_iter = transform_stage(fetched, transform_errors, metrics=metrics, icon_atlas=icon_atlas)
+    transformed = threaded(transform_iter, maxsize=queue_depth, name="transform")
+    completed = False
+    try:
+        for chunk in batched(transformed, batch_size):
+            docs = [doc for _, doc in chunk]
+            on_done = _observe_columnar(columnar, lambda docs=docs: columnar.write(docs), checkpoint.track([record for record, _ in chunk]), metrics)
+            sink.write(chunk, _observe_indexes(indexes, lambda docs=docs: indexes.observe(docs), on_done))
+        completed = True
+    finally:
+        transformed.close()
+        sink.close()
+        if columnar is not None:
+            # sink.close 已等待所有在途批次，提交成功的都已记入快照
+            _close_columnar(columnar, completed and not source.not_modified, metrics)
+    if indexes is not None:
+        # 提交失败的批次不影响已提交军队的榜单，照常发布
         try:
-            batch.commit()
-            logging.info(f"Committed final batch of {in_batch} documents (uploaded: {uploaded}/{total}, failed: {failed})")
-        except Exception as e:
-            logging.error(f"Final batch commit failed: {e}")
-            logging.debug(traceback.format_exc())
-            raise
+            publish_indexes()
+        finally:
+            indexes.close()
+    if source.not_modified:
+        return 0, 0, 0
+
+    uploaded = sink.committed
+    failed = sink.failed + len(transform_errors)
+    logging.info(f"Fetched {total} armies, {selected} selected for sync, {uploaded} committed, {failed} failed")
+
+    metrics.inc("armies_fetched", total)
+    metrics.inc("armies_selected", selected)
+    metrics.inc("docs_written", uploaded)
+    metrics.inc("docs_failed", sink.failed)
+    metrics.inc("transform_errors", len(transform_errors))
+    metrics.finish()
+    _write_metrics(metrics, report_path, prometheus_path)
 
-    # 保存新的 watermark（取本次处理集合的最大时间）
-    watermark = _max_updated_iso(armies)
+    if checkpoint.failed:
+        # 有批次最终失败：持久化的水位线是第一个失败批次之前最后一次保存的检查点（或已恢复为运行开始时的游标），
+        # 下次运行从那里重新处理；本次的指标摘要仍写入已有的 marker 便于排查
+        if checkpoint.saved_iso:
+            logging.error(
+                f"{sink.failed_batches} batch(es) failed after retries; watermark saved at {checkpoint.saved_iso} "
+                f"(id {checkpoint.saved_id}), before the first failed batch, so they are retried next run"
+            )
+        elif checkpoint.restored:
+            logging.error(
+                f"{sink.failed_batches} batch(es) failed after retries; the watermark was restored to where this run started "
+                f"({cursor_since or 'no cursor'}), so the whole run is retried next run"
+            )
+        else:
+            logging.error(
+                f"{sink.failed_batches} batch(es) failed after retries; no checkpoint was saved this run, "
+                f"so the watermark stays where this run started ({cursor_since or 'no cursor'}) and they are retried next run"
+            )
+        if fs_migration:
+            _update_marker(db, migration_collection, migration_doc, {'lastRunMetrics': metrics.summary()})
+        return total, uploaded, failed
+
+    # 保存新的 watermark（取本次处理集合的最大时间，以及该时间下的最大 id）
+    watermark = checkpoint.tracker.max_iso
+    marker_saved = True
     if watermark:
-        _save_state_since(state_file, watermark)
+        _save_state_since(state_file, watermark, checkpoint.tracker.max_id)
+        if state_file:
+            logging.info(f"Saved watermark to state file: {state_file} -> {watermark}")
         if fs_migration:
             try:
-                # 更新 Firestore marker：使用本次处理集合的最大时间和该时间下的最大 id
-                max_iso = watermark
-                max_id = -1
-                for a in armies:
-                    iso = a.get('updatedTime') or a.get('createdTime')
-                    if iso == max_iso:
-                        aid = int(a.get('id', -1))
-                        if aid > max_id:
-                            max_id = aid
                 marker_update = {
-                    'lastUpdatedTime': max_iso,
-                    'lastId': max_id,
+                    'lastUpdatedTime': watermark,
+                    'lastId': checkpoint.tracker.max_id,
                     'lastRunAt': datetime.now(timezone.utc).isoformat(),
                     'uploaded': uploaded,
                     'failed': failed,
+                    'lastRunMetrics': metrics.summary(),
                 }
                 marker_ref = db.collection(migration_collection).document(migration_doc)
                 marker_ref.set(marker_update, merge=True)
                 logging.info(f"Updated Firestore migration marker: {marker_update}")
             except Exception as e:
+                marker_saved = False
                 logging.error(f"Failed to update Firestore migration marker: {e}")
                 logging.debug(traceback.format_exc())
+    if marker_saved and isinstance(source, ExportSnapshot):
+        # 快照中的军队已全部同步，下一轮从新水位线重新下载
+        source.discard()
     return total, uploaded, failed
 
 
@@ -509,8 +2279,59 @@ def main(argv: List[str]) -> int:
     parser.add_argument("--migration-collection", default="migration", help="Firestore 迁移集合名")
     parser.add_argument("--migration-doc", default="cocarmies", help="Firestore 迁移文档ID")
     parser.add_argument("--init-migration", action="store_true", help="仅初始化迁移标记（按当前导出最大时间与ID），不执行上传")
+    parser.add_argument("--batch-size", type=int, default=400, help="每个 Firestore 批次的文档数（上限 500）")
+    parser.add_argument("--concurrency", type=int, default=4, help="同时在途提交的批次数")
+    parser.add_argument("--max-retries", type=int, default=6, help="批次遇到配额/争用错误时的最大重试次数（指数退避）")
+    parser.add_argument("--manifest", default=None, help="本地内容哈希清单（SQLite）路径，默认放在 --state-file 同目录的 .sync_manifest.<集合>.<目标哈希>.sqlite，每个项目/本地库 + 集合一个；清单记录的目标不符时拒绝使用")
+    parser.add_argument("--no-manifest", action="store_true", help="不使用本地清单，所有通过过滤的文档都重新写入")
+    parser.add_argument("--rebuild-manifest", action="store_true", help="同步前先读取整个 Firestore 集合重建本地清单")
+    parser.add_argument("--source-file", default=None, help="从本地 JSON 文件（导出接口同格式的数组）读取军队，代替 HTTP 导出接口")
+    parser.add_argument("--source-db", action="store_true", help="直接从 MariaDB 读取军队（服务端游标 + 批量查询子表，结果与导出接口相同），不经过网站；需要 pip install pymysql")
+    parser.add_argument("--db-host", default=os.environ.get("DB_HOST", "127.0.0.1"), help="--source-db 的数据库地址（默认环境变量 DB_HOST）")
+    parser.add_argument("--db-port", type=int, default=int(os.environ.get("DB_PORT") or 3306), help="--source-db 的数据库端口（默认环境变量 DB_PORT）")
+    parser.add_argument("--db-user", default=os.environ.get("DB_USER", ""), help="--source-db 的数据库用户（默认环境变量 DB_USER）")
+    parser.add_argument("--db-password", default=None, help="--source-db 的数据库密码（默认环境变量 DB_PASSWORD，避免出现在命令行中）")
+    parser.add_argument("--db-name", default="clash-armies", help="--source-db 的数据库名")
+    parser.add_argument("--sink-file", default=None, help="把转换后的文档写入本地 JSON Lines 文件，代替 Firestore（不读写迁移标记）")
+    parser.add_argument("--queue-depth", type=int, default=1000, help="流水线阶段之间的队列深度（条），决定内存上限")
+    parser.add_argument("--workers", type=int, default=1, help="转换阶段的进程数，>1 时使用进程池并行转换（输出顺序不变）")
+    parser.add_argument("--page-size", type=int, default=1000, help="导出接口分页大小（按 updatedTime,id 游标翻页），0 表示不分页一次拉取；--source-db 时为每批查询子表的军队数")
+    parser.add_argument("--snapshot", default=None, help="导出快照路径（gzip JSON，附 .meta.json），默认放在 --state-file 同目录的 .sync_snapshot.json.gz")
+    parser.add_argument("--no-snapshot", action="store_true", help="不保存也不复用导出快照，每次都从网站下载")
+    parser.add_argument("--snapshot-max-age", type=float, default=6 * 3600, help="快照的最长复用时间（秒）：上一轮失败/中断或 --dry-run 后，该时间内的下一轮直接读快照")
+    parser.add_argument(
+        "--icon-atlas",
+        default=None,
+        help="图集索引路径（build_assets.py 生成的 static/atlases/index.json），部队/宠物/装备图标改为输出图集引用而不是单个文件路径",
+    )
+    parser.add_argument("--indexes", action="store_true", help="维护榜单索引文档：每个大本营等级、每个标签以及全部军队按 score/votes/最近更新各取前 N 个军队摘要，只按本次变化的军队增量更新")
+    parser.add_argument("--index-collection", default="army_indexes", help="榜单索引文档所在的 Firestore 集合名")
+    parser.add_argument("--index-top-n", type=int, default=50, help="每个榜单保留的军队数")
+    parser.add_argument("--index-state", default=None, help="本地榜单状态（SQLite）路径，默认放在 --state-file 同目录的 .sync_indexes.sqlite")
+    parser.add_argument("--rebuild-indexes", action="store_true", help="同步前先读取整个 Firestore 集合重建榜单状态（本地状态为空时自动重建）")
+    parser.add_argument("--columnar", default=None, metavar="DIR", help="维护全部军队的列式快照（armies + 展开的 army_items 两张表），每次运行把提交成功的变化按 id 合并进去，供 army_report.py 离线分析；需要 pip install pyarrow")
+    parser.add_argument("--columnar-format", default="parquet", choices=["parquet", "arrow"], help="列式快照格式：parquet（zstd 压缩）或 arrow（不压缩，可内存映射）")
+    parser.add_argument("--no-stream", action="store_true", help="关闭流式解析，先完整下载导出数据再处理（排查问题用）")
+    parser.add_argument("--metrics-only", action="store_true", help="只同步计数器（score/votes/pageViews/openLinkClicks/copyLinkClicks）：拉取轻量导出并对已有文档做 metrics.* 字段更新")
+    parser.add_argument("--reconcile", action="store_true", help="删除对账：删除 Firestore 集合中在导出接口里已不存在的军队文档（加 --dry-run 只统计不删除）")
+    parser.add_argument("--max-delete-ratio", type=float, default=0.5, help="--reconcile 待删除文档占集合的比例超过该值时拒绝执行（防止导出异常时误删）")
+    parser.add_argument("--watch", type=float, default=None, metavar="SECONDS", help="常驻模式：每隔 SECONDS 秒同步一次，复用 Firestore 客户端和 keep-alive 连接；导出接口返回 304（未变化）时跳过本轮")
+    parser.add_argument("--report", default=None, help="把本次运行的各阶段耗时直方图与计数器写入 JSON 文件")
+    parser.add_argument("--prometheus", default=None, help="把指标写成 Prometheus textfile（node_exporter textfile collector 格式）")
+    parser.add_argument("--local-db", default=None, help="使用本地 Firestore 替身代替真实 Firestore：SQLite 文件路径，或 :memory: 仅保存在内存")
+    parser.add_argument("--local-latency-ms", type=float, default=0.0, help="本地后端每个请求模拟的往返延迟（毫秒）")
+    parser.add_argument("--local-max-batch", type=int, default=500, help="本地后端单批次写入上限，超过时整批失败（与 Firestore 一致为 500）")
+    parser.add_argument("--local-failure-rate", type=float, default=0.0, help="本地后端写入请求按此概率返回瞬时错误（0~1），用于验证重试")
     parser.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"], help="日志级别")
     args = parser.parse_args(argv)
+    if args.watch is not None and args.watch <= 0:
+        parser.error("--watch must be a positive number of seconds")
+    if args.watch is not None and args.init_migration:
+        parser.error("--watch cannot be combined with --init-migration")
+    if args.index_top_n <= 0:
+        parser.error("--index-top-n must be positive")
+    if args.source_db and args.source_file:
+        parser.error("--source-db cannot be combined with --source-file")
 
     logging.basicConfig(
         level=getattr(logging, args.log_level.upper(), logging.INFO),
@@ -518,29 +2339,139 @@ def main(argv: List[str]) -> int:
         datefmt="%H:%M:%S",
     )
 
-    try:
-        total, uploaded, failed = upload_armies(
-            base_url=args.base_url,
-            service_account=args.service_account,
-            collection=args.collection,
-            dry_run=args.dry_run,
-            since=args.since,
-            state_file=args.state_file,
-            skip_not_newer=args.skip_not_newer,
-            fs_migration=args.fs_migration,
-            migration_collection=args.migration_collection,
-            migration_doc=args.migration_doc,
-            init_migration=args.init_migration,
+    icon_atlas = None
+    if args.icon_atlas:
+        try:
+            icon_atlas = IconAtlas.load(args.icon_atlas)
+        except Exception as e:
+            logging.error(f"Failed to load icon atlas index {args.icon_atlas}: {e}")
+            logging.debug(traceback.format_exc())
+            return 1
+        logging.info(f"Using icon atlas index {args.icon_atlas} ({len(icon_atlas)} icons)")
+
+    source_db = None
+    if args.source_db:
+        source_db = {
+            "host": args.db_host,
+            "port": args.db_port,
+            "user": args.db_user,
+            "password": args.db_password if args.db_password is not None else os.environ.get("DB_PASSWORD", ""),
+            "database": args.db_name,
+        }
+
+    local_db = None
+    if args.local_db:
+        local_db = LocalFirestore(
+            args.local_db,
+            latency_ms=args.local_latency_ms,
+            max_batch_size=args.local_max_batch,
+            failure_rate=args.local_failure_rate,
         )
-        if args.dry_run:
-            logging.info(f"Dry run complete. Total armies available: {total}")
-        else:
-            logging.info(f"Uploaded {uploaded}/{total} armies to collection '{args.collection}'. Failed: {failed}. ✅")
+        logging.info(f"Using local Firestore backend: {local_db}")
+
+    # --watch：Firestore 客户端与导出连接在各轮之间复用
+    http_client = ExportClient() if args.watch is not None else None
+
+    def run_once(db: Any) -> Optional[int]:
+        # 执行一轮同步，返回失败文档数；出错时返回 None
+        try:
+            total, uploaded, failed = upload_armies(
+                base_url=args.base_url,
+                service_account=args.service_account,
+                collection=args.collection,
+                dry_run=args.dry_run,
+                since=args.since,
+                state_file=args.state_file,
+                skip_not_newer=args.skip_not_newer,
+                fs_migration=args.fs_migration,
+                migration_collection=args.migration_collection,
+                migration_doc=args.migration_doc,
+                init_migration=args.init_migration,
+                stream=not args.no_stream,
+                page_size=args.page_size,
+                batch_size=args.batch_size,
+                concurrency=args.concurrency,
+                max_retries=args.max_retries,
+                use_manifest=not args.no_manifest,
+                manifest_path=args.manifest,
+                rebuild_manifest=args.rebuild_manifest,
+                source_file=args.source_file,
+                source_db=source_db,
+                sink_file=args.sink_file,
+                queue_depth=args.queue_depth,
+                workers=args.workers,
+                db=db,
+                report_path=args.report,
+                prometheus_path=args.prometheus,
+                metrics_only=args.metrics_only,
+                reconcile=args.reconcile,
+                max_delete_ratio=args.max_delete_ratio,
+                http_client=http_client,
+                use_snapshot=not args.no_snapshot,
+                snapshot_path=args.snapshot,
+                snapshot_max_age=args.snapshot_max_age,
+                icon_atlas=icon_atlas,
+                use_indexes=args.indexes,
+                index_collection=args.index_collection,
+                index_path=args.index_state,
+                index_top_n=args.index_top_n,
+                rebuild_indexes=args.rebuild_indexes,
+                columnar_dir=args.columnar,
+                columnar_format=args.columnar_format,
+            )
+            if local_db is not None:
+                logging.info(f"Local backend: {local_db.requests} requests, {local_db.commits} commits, {local_db.failures} simulated failures")
+            if http_client is not None and http_client.not_modified:
+                logging.info("Export not modified since the last poll; nothing to do")
+            elif args.dry_run:
+                logging.info(f"Dry run complete. Total armies available: {total}")
+            elif args.reconcile:
+                logging.info(f"Reconciled collection '{args.collection}': {uploaded}/{total} documents deleted. Failed: {failed}. " + ("✅" if failed == 0 else "❌"))
+            elif args.metrics_only:
+                logging.info(f"Updated metrics of {uploaded}/{total} armies in collection '{args.collection}'. Failed: {failed}. " + ("✅" if failed == 0 else "❌"))
+            else:
+                logging.info(f"Uploaded {uploaded}/{total} armies to collection '{args.collection}'. Failed: {failed}. " + ("✅" if failed == 0 else "❌"))
+            return failed
+        except Exception as e:
+            logging.error(f"Error: {e}")
+            logging.debug(traceback.format_exc())
+            return None
+
+    try:
+        if http_client is None:
+            # 有批次在重试后仍失败时返回非 0，cron / CI 能发现只上传了一部分
+            return 0 if run_once(local_db) == 0 else 1
+
+        db = local_db
+        if db is None and not args.sink_file:
+            try:
+                db = _init_firestore(args.service_account)
+            except Exception as e:
+                logging.error(f"Error: {e}")
+                logging.debug(traceback.format_exc())
+                return 1
+        logging.info(f"Watching {args.base_url} every {args.watch:g}s (Ctrl+C to stop)")
+        while True:
+            t0 = time.monotonic()
+            failed = run_once(db)
+            # 只有完全成功的一轮才记住导出的 ETag；否则下一轮重新拉取，重试失败的批次
+            if failed == 0:
+                http_client.commit()
+            else:
+                http_client.discard()
+            logging.debug(
+                f"Export client: {http_client.requests} requests, {http_client.connections} connections, "
+                f"{http_client.not_modified_count} not modified"
+            )
+            time.sleep(max(0.0, args.watch - (time.monotonic() - t0)))
+    except KeyboardInterrupt:
+        logging.info("Stopped watching")
         return 0
-    except Exception as e:
-        logging.error(f"Error: {e}")
-        logging.debug(traceback.format_exc())
-        return 1
+    finally:
+        if http_client is not None:
+            http_client.close()
+        if local_db is not None:
+            local_db.close()
 
 
 if __name__ == "__main__":
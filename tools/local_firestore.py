@@ -0,0 +1,242 @@
+import json
+import random
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+
+# 本地 Firestore 替身：实现上传流程用到的客户端子集
+#   db.collection(name).document(id) -> 文档引用（id / get / set）
+#   db.collection(name).stream()     -> 全集合快照
+#   db.collection(name).list_documents(page_size) -> 全集合文档引用（不读内容）
+#   db.batch() -> set(ref, doc, merge) / update(ref, {"a.b": v}) / delete(ref) / commit()
+#   db.get_all(refs, field_paths)    -> 快照列表
+# 数据可放在内存（path=None 或 ":memory:"）或 SQLite 文件中（多次运行之间保留，包括迁移标记）。
+# 可模拟每个请求的延迟、单批次写入上限以及批次提交按概率出现的瞬时失败，用于离线压测 batch_size / concurrency。
+
+
+class TransientWriteError(Exception):
+    # 模拟配额/争用类瞬时错误，上传工具把它与 Firestore 的同类错误一样退避重试
+    pass
+
+
+class BatchTooLargeError(Exception):
+    # 与 Firestore 一致：单个批次超过写入上限时整批被拒绝，重试也不会成功
+    pass
+
+
+class NotFoundError(Exception):
+    # 与 Firestore 一致：update 不存在的文档时整批失败
+    pass
+
+
+def _merge(current: Dict[str, Any], update: Dict[str, Any]) -> Dict[str, Any]:
+    # set(merge=True) 语义：嵌套 map 逐层合并，其余字段直接覆盖
+    merged = dict(current)
+    for key, value in update.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = _merge(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def _apply_field_paths(current: Dict[str, Any], update: Dict[str, Any]) -> Dict[str, Any]:
+    # update() 语义：键为点分字段路径，只替换路径指向的字段
+    updated = json.loads(json.dumps(current))
+    for path, value in update.items():
+        target = updated
+        *parents, leaf = path.split(".")
+        for key in parents:
+            if not isinstance(target.get(key), dict):
+                target[key] = {}
+            target = target[key]
+        target[leaf] = value
+    return updated
+
+
+class LocalFirestore:
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        latency_ms: float = 0.0,
+        max_batch_size: int = 500,
+        failure_rate: float = 0.0,
+        seed: Optional[int] = None,
+    ) -> None:
+        self.path = path or ":memory:"
+        self.latency_ms = latency_ms
+        self.max_batch_size = max_batch_size
+        self.failure_rate = failure_rate
+        self.requests = 0
+        self.commits = 0
+        self.failures = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS docs (collection TEXT NOT NULL, id TEXT NOT NULL, data TEXT NOT NULL, PRIMARY KEY (collection, id))"
+        )
+        self._conn.commit()
+
+    def __str__(self) -> str:
+        return f"local:{self.path}"
+
+    def collection(self, name: str) -> "LocalCollection":
+        return LocalCollection(self, name)
+
+    def batch(self) -> "LocalBatch":
+        return LocalBatch(self)
+
+    def get_all(self, refs: List["LocalDocument"], field_paths: Optional[List[str]] = None) -> Iterator["LocalSnapshot"]:
+        self._request()
+        keys = [(ref.collection, ref.id) for ref in refs]
+        found = self._read(keys)
+        for ref in refs:
+            data = found.get((ref.collection, ref.id))
+            if data is not None and field_paths is not None:
+                data = {k: data[k] for k in field_paths if k in data}
+            yield LocalSnapshot(ref, data)
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def _request(self, fail: bool = False) -> None:
+        # 每个请求一次往返延迟；延迟在锁外等待，多个批次并发提交时可以重叠
+        with self._lock:
+            self.requests += 1
+            failed = fail and self.failure_rate > 0 and self._rng.random() < self.failure_rate
+            if failed:
+                self.failures += 1
+            jitter = self._rng.uniform(0.8, 1.2)
+        if self.latency_ms > 0:
+            time.sleep(self.latency_ms * jitter / 1000.0)
+        if failed:
+            raise TransientWriteError("Simulated transient write failure")
+
+    def _read(self, keys: List[Tuple[str, str]]) -> Dict[Tuple[str, str], Dict[str, Any]]:
+        found: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        with self._lock:
+            for collection, doc_id in keys:
+                row = self._conn.execute("SELECT data FROM docs WHERE collection = ? AND id = ?", (collection, doc_id)).fetchone()
+                if row:
+                    found[(collection, doc_id)] = json.loads(row[0])
+        return found
+
+    def _write(self, writes: List[Tuple[str, "LocalDocument", Dict[str, Any]]]) -> None:
+        # 整批在一个 SQLite 事务中写入，与 Firestore 批次的原子性一致（任一写入失败则整批回滚）
+        with self._lock:
+            with self._conn:
+                for op, ref, doc in writes:
+                    if op == "delete":
+                        self._conn.execute("DELETE FROM docs WHERE collection = ? AND id = ?", (ref.collection, ref.id))
+                        continue
+                    data = doc
+                    if op != "set":
+                        row = self._conn.execute(
+                            "SELECT data FROM docs WHERE collection = ? AND id = ?", (ref.collection, ref.id)
+                        ).fetchone()
+                        if op == "update":
+                            if not row:
+                                raise NotFoundError(f"No document to update: {ref.path}")
+                            data = _apply_field_paths(json.loads(row[0]), doc)
+                        elif row:
+                            data = _merge(json.loads(row[0]), doc)
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO docs (collection, id, data) VALUES (?, ?, ?)",
+                        (ref.collection, ref.id, json.dumps(data, ensure_ascii=False)),
+                    )
+            self.commits += 1
+
+
+class LocalCollection:
+    def __init__(self, db: LocalFirestore, name: str) -> None:
+        self.db = db
+        self.name = name
+
+    def document(self, doc_id: str) -> "LocalDocument":
+        return LocalDocument(self.db, self.name, doc_id)
+
+    def stream(self) -> Iterator["LocalSnapshot"]:
+        self.db._request()
+        with self.db._lock:
+            rows = self.db._conn.execute("SELECT id, data FROM docs WHERE collection = ? ORDER BY id", (self.name,)).fetchall()
+        for doc_id, data in rows:
+            yield LocalSnapshot(self.document(doc_id), json.loads(data))
+
+    def list_documents(self, page_size: int = 1000) -> Iterator["LocalDocument"]:
+        # 按页列出文档 id，每页一次请求
+        last = ""
+        while True:
+            self.db._request()
+            with self.db._lock:
+                rows = self.db._conn.execute(
+                    "SELECT id FROM docs WHERE collection = ? AND id > ? ORDER BY id LIMIT ?", (self.name, last, page_size)
+                ).fetchall()
+            for (doc_id,) in rows:
+                yield self.document(doc_id)
+            if len(rows) < page_size:
+                return
+            last = rows[-1][0]
+
+
+class LocalDocument:
+    def __init__(self, db: LocalFirestore, collection: str, doc_id: str) -> None:
+        self.db = db
+        self.collection = collection
+        self.id = doc_id
+
+    @property
+    def path(self) -> str:
+        return f"{self.collection}/{self.id}"
+
+    def get(self) -> "LocalSnapshot":
+        self.db._request()
+        return LocalSnapshot(self, self.db._read([(self.collection, self.id)]).get((self.collection, self.id)))
+
+    def set(self, doc: Dict[str, Any], merge: bool = False) -> None:
+        # 单文档写入（迁移标记）不注入失败：真实客户端会在内部重试单次写入
+        self.db._request()
+        self.db._write([("merge" if merge else "set", self, doc)])
+
+    def update(self, fields: Dict[str, Any]) -> None:
+        # 与 Firestore 一致：文档不存在时抛出 NotFoundError，不会创建文档
+        self.db._request()
+        self.db._write([("update", self, fields)])
+
+
+class LocalSnapshot:
+    def __init__(self, ref: LocalDocument, data: Optional[Dict[str, Any]]) -> None:
+        self.reference = ref
+        self.id = ref.id
+        self.exists = data is not None
+        self._data = data
+
+    def get(self, field: str) -> Any:
+        return (self._data or {}).get(field)
+
+    def to_dict(self) -> Optional[Dict[str, Any]]:
+        return dict(self._data) if self._data is not None else None
+
+
+class LocalBatch:
+    def __init__(self, db: LocalFirestore) -> None:
+        self.db = db
+        self._writes: List[Tuple[str, LocalDocument, Dict[str, Any]]] = []
+
+    def set(self, ref: LocalDocument, doc: Dict[str, Any], merge: bool = False) -> None:
+        self._writes.append(("merge" if merge else "set", ref, doc))
+
+    def update(self, ref: LocalDocument, fields: Dict[str, Any]) -> None:
+        self._writes.append(("update", ref, fields))
+
+    def delete(self, ref: LocalDocument) -> None:
+        self._writes.append(("delete", ref, {}))
+
+    def commit(self) -> None:
+        if len(self._writes) > self.db.max_batch_size:
+            raise BatchTooLargeError(f"Batch has {len(self._writes)} writes, maximum {self.db.max_batch_size} allowed per request")
+        self.db._request(fail=True)
+        self.db._write(self._writes)
@@ -0,0 +1,263 @@
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from sync_metrics import SyncMetrics
+
+try:
+    import pymysql
+    import pymysql.cursors
+except ImportError:
+    # 只有 --source-db 需要 pymysql
+    pymysql = None
+
+
+# 数据源：直接读取 MariaDB（schema.sql 的表结构），不经过网站的 /api/export/armies
+#   主查询只读 armies + users，用非缓冲的服务端游标（SSCursor）按 (updatedTime, id) 升序流式读取，内存与军队总数无关
+#   每读出 batch_size 个军队，用第二个连接按 armyId IN (...) 批量查询子表（兵种/装备/宠物/标签/评论/攻略/投票/计数器），
+#   在 Python 中拼成与 ArmyAPI.getArmies 导出完全相同的结构（字段顺序、日期格式、0/1 布尔值），transform_army 无需区分来源
+#   非缓冲游标读取期间同一连接不能执行其他查询，所以子表查询使用独立连接
+#   fields="metrics" / "ids" 与导出接口的 ?fields= 相同：按 id 升序只返回计数器 / 只返回 id
+
+# 与 ArmyMetricsAPI 中的计数器名称一致
+METRIC_NAMES = {"page-view": "pageViews", "open-link-click": "openLinkClicks", "copy-link-click": "copyLinkClicks"}
+
+ARMY_COLUMNS = "a.id, a.name, a.townHall, a.banner, a.createdBy, a.createdTime, a.updatedTime, u.username"
+
+UNITS_QUERY = """
+    SELECT au.armyId, au.id, au.home, au.unitId, au.amount, un.name, un.type, un.clashId, un.housingSpace,
+           un.productionBuilding, un.isSuper, un.isFlying, un.isJumper, un.airTargets, un.groundTargets
+    FROM army_units au
+    JOIN units un ON un.id = au.unitId
+    WHERE au.armyId IN ({ids})
+    ORDER BY au.armyId, au.id
+"""
+
+EQUIPMENT_QUERY = """
+    SELECT ae.armyId, ae.id, eq.id, eq.hero, eq.name, eq.clashId, eq.epic
+    FROM army_equipment ae
+    JOIN equipment eq ON eq.id = ae.equipmentId
+    WHERE ae.armyId IN ({ids})
+    ORDER BY ae.armyId, ae.id
+"""
+
+PETS_QUERY = """
+    SELECT ap.armyId, ap.id, ap.hero, p.id, p.name, p.clashId
+    FROM army_pets ap
+    JOIN pets p ON p.id = ap.petId
+    WHERE ap.armyId IN ({ids})
+    ORDER BY ap.armyId, ap.id
+"""
+
+TAGS_QUERY = "SELECT armyId, tag FROM army_tags WHERE armyId IN ({ids}) ORDER BY armyId, tag"
+
+COMMENTS_QUERY = """
+    SELECT ac.armyId, ac.id, ac.comment, ac.replyTo, u.username, ac.createdBy, ac.createdTime, ac.updatedTime
+    FROM army_comments ac
+    LEFT JOIN users u ON u.id = ac.createdBy
+    WHERE ac.armyId IN ({ids})
+    ORDER BY ac.armyId, ac.id
+"""
+
+GUIDES_QUERY = "SELECT armyId, id, textContent, youtubeUrl FROM army_guides WHERE armyId IN ({ids})"
+
+VOTES_QUERY = "SELECT armyId, SUM(vote) FROM army_votes WHERE armyId IN ({ids}) GROUP BY armyId"
+
+METRICS_QUERY = "SELECT armyId, name, value FROM army_metrics WHERE armyId IN ({ids})"
+
+
+def _iso(value: Optional[datetime]) -> Optional[str]:
+    # 与 JSON.stringify(Date) 相同：UTC、毫秒、Z 结尾（连接时区设为 UTC，TIMESTAMP 读出即为 UTC）
+    if value is None:
+        return None
+    return value.strftime("%Y-%m-%dT%H:%M:%S.") + f"{value.microsecond // 1000:03d}Z"
+
+
+def _db_time(iso_value: str) -> datetime:
+    if iso_value.endswith("Z"):
+        iso_value = iso_value[:-1] + "+00:00"
+    dt = datetime.fromisoformat(iso_value)
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt
+
+
+class MariaDBSource:
+    # 数据源：MariaDB 直连（服务端游标 + 按块批量查询子表）
+    not_modified = False
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 3306,
+        user: str = "",
+        password: str = "",
+        database: str = "clash-armies",
+        batch_size: int = 1000,
+        fields: Optional[str] = None,
+        metrics: Optional[SyncMetrics] = None,
+    ) -> None:
+        if pymysql is None:
+            raise RuntimeError("Reading directly from MariaDB requires pymysql: pip install pymysql")
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.database = database
+        self.batch_size = max(1, batch_size)
+        self.fields = fields
+        self.metrics = metrics
+
+    def __str__(self) -> str:
+        return f"mariadb://{self.user}@{self.host}:{self.port}/{self.database}" + (f"?fields={self.fields}" if self.fields else "")
+
+    def __call__(self, since_iso: Optional[str], after_id: Optional[int]) -> Iterator[Any]:
+        stream = self._connect(pymysql.cursors.SSCursor)
+        lookup = self._connect(pymysql.cursors.Cursor)
+        try:
+            if self.fields in ("ids", "metrics"):
+                # 与导出接口相同：按 id 升序，不做游标过滤
+                sql, params = "SELECT a.id FROM armies a ORDER BY a.id ASC", ()
+            else:
+                sql, params = self._armies_query(since_iso, after_id)
+            weights = self._metric_weights(lookup) if self.fields != "ids" else {}
+            cursor = stream.cursor()
+            cursor.execute(sql, params)
+            while True:
+                t0 = time.perf_counter()
+                rows = cursor.fetchmany(self.batch_size)
+                if self.metrics is not None:
+                    self.metrics.observe("fetch", time.perf_counter() - t0)
+                    self.metrics.inc("db_rows", len(rows))
+                if not rows:
+                    break
+                if self.fields == "ids":
+                    yield from ({"id": row[0]} for row in rows)
+                    continue
+                t0 = time.perf_counter()
+                ids = [row[0] for row in rows]
+                scores = self._scores(lookup, ids, weights)
+                if self.fields == "metrics":
+                    items = [{"id": army_id, **scores[army_id]} for army_id in ids]
+                else:
+                    items = self._assemble(lookup, rows, scores)
+                if self.metrics is not None:
+                    self.metrics.observe("db_lookup", time.perf_counter() - t0)
+                yield from items
+        finally:
+            # 不关闭 SSCursor：提前结束（下游出错/中断）时它会先读完剩余结果，直接断开连接即可
+            stream.close()
+            lookup.close()
+
+    def _connect(self, cursorclass: Any) -> Any:
+        return pymysql.connect(
+            host=self.host,
+            port=self.port,
+            user=self.user,
+            password=self.password,
+            database=self.database,
+            charset="utf8mb4",
+            cursorclass=cursorclass,
+            autocommit=True,
+            # TIMESTAMP 按 UTC 读出（与网站连接的 timezone: 'Z' 一致）；下游写入 Firestore 时会暂停读取，放宽服务端写超时，避免长时间不读被断开
+            init_command="SET time_zone = '+00:00', net_write_timeout = 3600",
+        )
+
+    def _armies_query(self, since_iso: Optional[str], after_id: Optional[int]) -> Tuple[str, Tuple[Any, ...]]:
+        # 与 getArmies(sort: 'updated', updatedSince, afterId) 相同的游标条件与排序
+        sql = f"SELECT {ARMY_COLUMNS} FROM armies a LEFT JOIN users u ON u.id = a.createdBy"
+        params: Tuple[Any, ...] = ()
+        if since_iso:
+            since = _db_time(since_iso)
+            if after_id is not None:
+                sql += " WHERE (a.updatedTime > %s OR (a.updatedTime = %s AND a.id > %s))"
+                params = (since, since, after_id)
+            else:
+                sql += " WHERE a.updatedTime >= %s"
+                params = (since,)
+        return sql + " ORDER BY a.updatedTime ASC, a.id ASC", params
+
+    def _metric_weights(self, conn: Any) -> Dict[str, int]:
+        # 与 ArmyMetricsAPI.getMetricWeights 相同，权重来自 metrics 表
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT name, weight FROM metrics")
+            weights = {name: weight for name, weight in cursor.fetchall()}
+        for name in ("vote", *METRIC_NAMES):
+            if name not in weights:
+                raise RuntimeError(f'Invalid metric "{name}"')
+        return weights
+
+    def _query(self, conn: Any, template: str, ids: List[int]) -> List[Tuple[Any, ...]]:
+        with conn.cursor() as cursor:
+            cursor.execute(template.format(ids=",".join(["%s"] * len(ids))), ids)
+            return list(cursor.fetchall())
+
+    def _scores(self, conn: Any, ids: List[int], weights: Dict[str, int]) -> Dict[int, Dict[str, Any]]:
+        # 与 getArmyScoresQuery 相同的计分：投票和 + 各计数器 × 权重
+        scores = {army_id: {"score": 0, "votes": 0, "pageViews": 0, "openLinkClicks": 0, "copyLinkClicks": 0} for army_id in ids}
+        for army_id, votes in self._query(conn, VOTES_QUERY, ids):
+            scores[army_id]["votes"] = int(votes or 0)
+        for army_id, name, value in self._query(conn, METRICS_QUERY, ids):
+            if name in METRIC_NAMES:
+                scores[army_id][METRIC_NAMES[name]] = value
+        for entry in scores.values():
+            entry["score"] = (
+                entry["votes"] * weights["vote"]
+                + entry["pageViews"] * weights["page-view"]
+                + entry["copyLinkClicks"] * weights["copy-link-click"]
+                + entry["openLinkClicks"] * weights["open-link-click"]
+            )
+        return scores
+
+    def _assemble(self, conn: Any, rows: List[Tuple[Any, ...]], scores: Dict[int, Dict[str, Any]]) -> List[Dict[str, Any]]:
+        ids = [row[0] for row in rows]
+        units: Dict[int, List[Dict[str, Any]]] = {}
+        for r in self._query(conn, UNITS_QUERY, ids):
+            units.setdefault(r[0], []).append({
+                "id": r[1], "home": r[2], "armyId": r[0], "unitId": r[3], "amount": r[4], "name": r[5], "type": r[6],
+                "clashId": r[7], "housingSpace": r[8], "productionBuilding": r[9], "isSuper": r[10], "isFlying": r[11],
+                "isJumper": r[12], "airTargets": r[13], "groundTargets": r[14],
+            })
+        equipment: Dict[int, List[Dict[str, Any]]] = {}
+        for r in self._query(conn, EQUIPMENT_QUERY, ids):
+            equipment.setdefault(r[0], []).append(
+                {"id": r[1], "armyId": r[0], "equipmentId": r[2], "hero": r[3], "name": r[4], "clashId": r[5], "epic": r[6]}
+            )
+        pets: Dict[int, List[Dict[str, Any]]] = {}
+        for r in self._query(conn, PETS_QUERY, ids):
+            pets.setdefault(r[0], []).append({"id": r[1], "hero": r[2], "armyId": r[0], "petId": r[3], "name": r[4], "clashId": r[5]})
+        tags: Dict[int, List[str]] = {}
+        for army_id, tag in self._query(conn, TAGS_QUERY, ids):
+            tags.setdefault(army_id, []).append(tag)
+        comments: Dict[int, List[Dict[str, Any]]] = {}
+        for r in self._query(conn, COMMENTS_QUERY, ids):
+            comments.setdefault(r[0], []).append({
+                "id": r[1], "armyId": r[0], "comment": r[2], "replyTo": r[3], "username": r[4], "createdBy": r[5],
+                "createdTime": _iso(r[6]), "updatedTime": _iso(r[7]),
+            })
+        guides = {r[0]: {"id": r[1], "textContent": r[2], "youtubeUrl": r[3]} for r in self._query(conn, GUIDES_QUERY, ids)}
+
+        armies = []
+        for army_id, name, town_hall, banner, created_by, created_time, updated_time, username in rows:
+            armies.append({
+                "id": army_id,
+                "name": name,
+                "townHall": town_hall,
+                "banner": banner,
+                "createdBy": created_by,
+                "createdTime": _iso(created_time),
+                "updatedTime": _iso(updated_time),
+                **scores[army_id],
+                "username": username,
+                # 与导出一致：没有兵种时为 null，其余子表为空数组
+                "units": units.get(army_id),
+                "equipment": equipment.get(army_id, []),
+                "pets": pets.get(army_id, []),
+                "tags": tags.get(army_id, []),
+                "comments": comments.get(army_id, []),
+                "guide": guides.get(army_id),
+                # 导出请求没有登录用户
+                "userVote": 0,
+                "userBookmarked": False,
+            })
+        return armies
@@ -0,0 +1,166 @@
+import bisect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, List, Optional
+
+
+# 延迟直方图的桶上界（秒），覆盖单条转换的微秒级到整页下载/批次提交的数十秒
+DEFAULT_BUCKETS: List[float] = [
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+]
+
+# 各阶段的含义，写入报告便于对照
+STAGES: Dict[str, str] = {
+    "fetch": "export request: time to response plus network reads, per page",
+    "parse": "JSON decoding of the export, per page",
+    "filter": "client-side since/afterId filter, per chunk of records",
+    "transform": "army -> Firestore document, per army (per chunk with --workers)",
+    "manifest": "content hashing and manifest lookup, per batch",
+    "skip_check": "--skip-not-newer Firestore reads, per batch",
+    "commit_wait": "main thread blocked on in-flight commits (backpressure), per batch",
+    "commit": "Firestore batch commit, per attempt",
+}
+
+
+class Histogram:
+    def __init__(self, buckets: Optional[List[float]] = None) -> None:
+        self.bounds = list(buckets or DEFAULT_BUCKETS)
+        # 最后一个桶为 +Inf
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min: Optional[float] = None
+        self.max: Optional[float] = None
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def quantile(self, q: float) -> Optional[float]:
+        # 由桶计数估算分位数（桶内线性插值），最后一个桶用观测到的最大值封顶
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, c in enumerate(self.counts):
+            if c and seen + c >= rank:
+                lower = self.bounds[i - 1] if i > 0 else 0.0
+                upper = self.bounds[i] if i < len(self.bounds) else (self.max or lower)
+                lower = max(lower, self.min or 0.0)
+                upper = min(upper, self.max if self.max is not None else upper)
+                return lower + (upper - lower) * ((rank - seen) / c)
+            seen += c
+        return self.max
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "min": round(self.min, 6) if self.min is not None else None,
+            "max": round(self.max, 6) if self.max is not None else None,
+            "p50": _round(self.quantile(0.5)),
+            "p95": _round(self.quantile(0.95)),
+            "p99": _round(self.quantile(0.99)),
+            "buckets": {str(b): c for b, c in zip(self.bounds + ["+Inf"], self.counts)},
+        }
+
+
+def _round(value: Optional[float]) -> Optional[float]:
+    return round(value, 6) if value is not None else None
+
+
+class SyncMetrics:
+    # 一次同步运行的指标：各阶段延迟直方图 + 计数器；下载、转换、提交线程会并发写入，统一加锁
+    def __init__(self) -> None:
+        self.started_at = datetime.now(timezone.utc)
+        self._t0 = time.perf_counter()
+        self.finished_seconds: Optional[float] = None
+        self.stages: Dict[str, Histogram] = {}
+        self.counters: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            hist = self.stages.get(stage)
+            if hist is None:
+                hist = self.stages[stage] = Histogram()
+            hist.observe(seconds)
+
+    def inc(self, counter: str, value: int = 1) -> None:
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    @contextmanager
+    def timer(self, stage: str) -> Iterator[None]:
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - t0)
+
+    def finish(self) -> None:
+        self.finished_seconds = time.perf_counter() - self._t0
+
+    @property
+    def elapsed(self) -> float:
+        return self.finished_seconds if self.finished_seconds is not None else time.perf_counter() - self._t0
+
+    def to_report(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "startedAt": self.started_at.isoformat(),
+                "elapsedSeconds": round(self.elapsed, 3),
+                "counters": dict(sorted(self.counters.items())),
+                "stages": {name: dict(hist.to_dict(), description=STAGES.get(name)) for name, hist in self.stages.items()},
+            }
+
+    def summary(self) -> Dict[str, Any]:
+        # 写入 migration marker 的精简版：总耗时、计数器、各阶段累计秒数与 p95
+        with self._lock:
+            return {
+                "elapsedSeconds": round(self.elapsed, 3),
+                "counters": dict(sorted(self.counters.items())),
+                "stageSeconds": {name: round(hist.sum, 3) for name, hist in self.stages.items()},
+                "stageP95": {name: _round(hist.quantile(0.95)) for name, hist in self.stages.items()},
+            }
+
+    def write_report(self, path: str) -> None:
+        _atomic_write(path, json.dumps(self.to_report(), ensure_ascii=False, indent=2) + "\n")
+
+    def write_prometheus(self, path: str, prefix: str = "cocarmies_sync") -> None:
+        # node_exporter textfile collector 格式；先写临时文件再替换，避免被采集到半个文件
+        lines: List[str] = []
+        with self._lock:
+            lines.append(f"# HELP {prefix}_stage_seconds Per-stage latency of the Firestore army sync.")
+            lines.append(f"# TYPE {prefix}_stage_seconds histogram")
+            for name, hist in sorted(self.stages.items()):
+                cumulative = 0
+                for bound, c in zip(hist.bounds + ["+Inf"], hist.counts):
+                    cumulative += c
+                    lines.append(f'{prefix}_stage_seconds_bucket{{stage="{name}",le="{bound}"}} {cumulative}')
+                lines.append(f'{prefix}_stage_seconds_sum{{stage="{name}"}} {hist.sum:.6f}')
+                lines.append(f'{prefix}_stage_seconds_count{{stage="{name}"}} {hist.count}')
+            for name, value in sorted(self.counters.items()):
+                lines.append(f"# TYPE {prefix}_{name}_total counter")
+                lines.append(f"{prefix}_{name}_total {value}")
+        lines.append(f"# TYPE {prefix}_duration_seconds gauge")
+        lines.append(f"{prefix}_duration_seconds {self.elapsed:.3f}")
+        lines.append(f"# TYPE {prefix}_last_run_timestamp_seconds gauge")
+        lines.append(f"{prefix}_last_run_timestamp_seconds {self.started_at.timestamp():.0f}")
+        _atomic_write(path, "\n".join(lines) + "\n")
+
+
+def _atomic_write(path: str, content: str) -> None:
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(content)
+    os.replace(tmp, path)